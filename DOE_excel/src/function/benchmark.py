@@ -0,0 +1,628 @@
+"""
+Benchmark of the data preparation against the previous implementation,
+of the typed schema against the plain prepped frames, and of the incremental
+evaluator against a full flow run.
+
+With --suite, every check of flow/module.py, `prep_data` and every flow are
+measured on data from flow/generator.py, for each of the --sizes (number of aliens).
+
+With --rules, `evaluate_all_rules` of flow/rules.py is measured against flow 1, 2
+and 4 run one after the other on a shared plan, and against flow 4 alone.
+
+With --cases, the generated batch is split into --n-cases cases (by alien) and
+each flow is run once with a case key against once per case, as test_script did.
+
+With --cli, the time to first result of `python -m flow.cli` is measured for a cold
+command and for commands answered by a --serve process, for each of the --sizes.
+
+With --report, the anomaly report writer of flow/report.py is measured on the results
+of flow 1 and flow 4, as XLSX and CSV, for each of the --sizes.
+
+With --as-of, a batch is evaluated against the history as of --n-dates dates by filtering
+the history for each date, with `AsOfEvaluator.evaluate` and with `AsOfEvaluator.backfill`.
+
+With --engines, the history lookups and the flows are run on the pandas and the
+SQLite engine of flow/engine.py, for each of the --sizes, and each result of the
+SQLite engine is compared with the pandas one ("matches").
+
+Usage:
+    python benchmark.py --rows 200000
+    python benchmark.py --suite --sizes 10000 100000 1000000
+    python benchmark.py --engines --sizes 10000 100000
+    python benchmark.py --parallel --sizes 100000 --workers 0 1 2 4 8
+    python benchmark.py --rules --sizes 10000 100000
+    python benchmark.py --cases --sizes 100000 --n-cases 1000
+    python benchmark.py --cli --sizes 10000 100000
+    python benchmark.py --report --sizes 10000 100000
+    python benchmark.py --as-of --sizes 100000 --n-dates 30
+
+The raw sheet is generated in memory with the same headers as the Testcase workbook,
+so the numbers measure `prep_data` itself and not the Excel parser.
+Each result is printed as one JSON object per line.
+"""
+import argparse
+import gc
+import importlib.util
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from flow.flow1 import flow_1
+from flow.flow2 import flow_2
+from flow.flow4 import flow_4
+from flow.engine import PandasEngine, SQLiteEngine
+from flow.engine_parity import comparable, engine_cases
+from flow.expiry_index import ExpiryIndex
+from flow.generator import generate, to_raw
+from flow.incremental import IncrementalEvaluator
+from flow.module import *
+from flow.parallel import ParallelRunner
+from flow.plan import ExecutionPlan, run_flows
+from flow.prep_data import prep_data, selected_cols
+from flow.report import ReportWriter
+from flow.rules import evaluate_all_rules, rule_codes, rule_frame
+from flow.schema import apply_schema, share_categories
+from flow.temporal_index import AsOfEvaluator, TemporalIndex
+
+
+def prep_data_baseline(df):
+    """
+    Previous `prep_data` implementation (three explodes, ffill and per-cell quote removal), kept for comparison.
+    """
+    df.rename(columns={
+                'CREATED_TIMESTAMP\n(วันที่ยื่นคำขอ)': 'CREATED_TIMESTAMP',
+                'FORM_ID\n(รหัสฟอร์ม)': 'FORM_ID',
+                'FORM_ID_SEQ\n(ลำดับรหัสฟอร์ม)': 'FORM_ID_SEQ',
+                'ALIEN_ID\n(รหัสคนต่างด้าว)': 'ALIEN_ID',
+                'ALIEN_SEQ\n(ลำดับรหัสคนต่างด้าว)': 'ALIEN_SEQ',
+                'EMPLOYER_ID\n(รหัสนายจ้าง)': 'EMPLOYER_ID',
+                'COMPANYNAME_TH\n(ชื่อนายจ้างไทย/สถานประกอบการ)': 'COMPANYNAME_TH',
+                'COMPANYNAME_EN\n(ชื่อบริษัท (อังกฤษ))': 'COMPANYNAME_EN',
+                'BUS_TYPE_ID\n(รหัสประเภทกิจการ)': 'BUS_TYPE_ID',
+                'Job Description\n(ตำแหน่งงานลูกจ้าง)': 'Job_Description',
+                'EMPLOYER_NO\n(เลขปชช./นิติบุคคล)': 'EMPLOYER_NO',
+                'Master_Form_Type\n(FORM_TYPE_ID)': 'Master_Form_Type',
+                'Master_Form_Status\n(Tracking_Status)': 'Master_Form_Status',
+                   }, inplace=True)
+    df.columns = [x.upper() for x in df.columns]
+    df['CREATED_TIMESTAMP'] = pd.to_datetime(df['CREATED_TIMESTAMP'])
+    df['ALIEN_ID'] = df['ALIEN_ID'].str.split(',')
+    df['ALIEN_SEQ'] = df['ALIEN_SEQ'].apply(lambda x: x.split(',') if isinstance(x, str) and ',' in x else [x])
+    df['JOB_DESCRIPTION'] = df['JOB_DESCRIPTION'].str.split(',')
+    exploded_A = df.explode('ALIEN_ID').reset_index(drop=True)
+    exploded_B = df.explode('ALIEN_SEQ').reset_index(drop=True)
+    exploded_C = df.explode('JOB_DESCRIPTION').reset_index(drop=True)
+    exploded_df = exploded_A.copy()
+    exploded_df['ALIEN_SEQ'] = exploded_B['ALIEN_SEQ']
+    exploded_df['JOB_DESCRIPTION'] = exploded_C['JOB_DESCRIPTION']
+    exploded_df = exploded_df.ffill()
+
+    def remove_quote(x):
+        return x.replace('"', '') if isinstance(x, str) else x
+
+    columns_to_process = [
+        'ALIEN_ID', 'FORM_ID', 'EMPLOYER_ID',
+        'COMPANYNAME_TH', 'COMPANYNAME_EN',
+        'BUS_TYPE_ID', 'EMPLOYER_NO', 'JOB_DESCRIPTION'
+    ]
+    for column in columns_to_process:
+        exploded_df[column] = exploded_df[column].apply(remove_quote)
+    return exploded_df
+
+
+def make_raw_sheet(n_rows, max_aliens=5, seed=0):
+    """
+    Generate a raw sheet with the Testcase workbook headers.
+
+    Parameters:
+    - n_rows (int): Number of form rows.
+    - max_aliens (int): Maximum number of aliens per form.
+    - seed (int): Random seed.
+
+    Returns:
+    - pd.DataFrame: Raw sheet, one form per row with comma separated alien columns.
+    """
+    rng = np.random.default_rng(seed)
+    jobs = np.array(['"กรรมกร"', '"งานขายของหน้าร้าน"', '"งานทํามือ"', '"งานทํารองเท้า"'])
+    n_aliens = rng.integers(1, max_aliens + 1, n_rows)
+    alien_codes = pd.Series(np.arange(n_aliens.sum())).map('"{:07d}"'.format).to_numpy()
+    job_codes = jobs[rng.integers(0, len(jobs), n_aliens.sum())]
+    seq_codes = (np.arange(n_aliens.sum()) - np.repeat(np.cumsum(n_aliens) - n_aliens, n_aliens) + 1).astype(str)
+    row_id = np.repeat(np.arange(n_rows), n_aliens)
+
+    def join(values):
+        return pd.Series(values).groupby(row_id).agg(','.join).to_numpy()
+
+    alien_seq = join(seq_codes).astype(object)
+    alien_seq[n_aliens == 1] = 1
+    return pd.DataFrame({
+        'CREATED_TIMESTAMP\n(วันที่ยื่นคำขอ)': pd.Timestamp('2024-01-01') + pd.to_timedelta(rng.integers(0, 180, n_rows), unit='D'),
+        'FORM_ID\n(รหัสฟอร์ม)': pd.Series(np.arange(n_rows)).map('"{:07d}"'.format),
+        'FORM_ID_SEQ\n(ลำดับรหัสฟอร์ม)': np.arange(n_rows),
+        'ALIEN_ID\n(รหัสคนต่างด้าว)': join(alien_codes),
+        'ALIEN_SEQ\n(ลำดับรหัสคนต่างด้าว)': alien_seq,
+        'EMPLOYER_ID\n(รหัสนายจ้าง)': '"010"',
+        'COMPANYNAME_TH\n(ชื่อนายจ้างไทย/สถานประกอบการ)': '"เจ๋ง ไม่ จำกัด"',
+        'COMPANYNAME_EN\n(ชื่อบริษัท (อังกฤษ))': '"Jeng Mai Co., Ltd."',
+        'BUS_TYPE_ID\n(รหัสประเภทกิจการ)': rng.integers(1, 20, n_rows),
+        'Job Description\n(ตำแหน่งงานลูกจ้าง)': join(job_codes),
+        'EMPLOYER_NO\n(เลขปชช./นิติบุคคล)': pd.Series(rng.integers(0, n_rows // 50 + 1, n_rows)).map('"{:08d}"'.format),
+        'Master_Form_Type\n(FORM_TYPE_ID)': rng.choice(['MT_59', 'MT_13_EXIT'], n_rows),
+        'Master_Form_Status\n(Tracking_Status)': 'Consider request round1',
+        'Valid_Until': pd.Timestamp('2026-01-01'),
+    })
+
+
+def measure(function, *args, trace_memory=True, **kwargs):
+    """
+    Run a function once and measure its wall time and peak traced allocation.
+
+    Tracing allocations slows down allocation-heavy code, use `trace_memory=False` for time only.
+
+    Returns:
+    - dict: 'seconds', 'peak_mb' (None without tracing) and the 'output' of the function.
+    """
+    gc.collect()
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    output = function(*args, **kwargs)
+    seconds = time.perf_counter() - start
+    peak = None
+    if trace_memory:
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return {'seconds': seconds, 'peak_mb': None if peak is None else peak / 2**20, 'output': output}
+
+
+def benchmark_prep_data(n_rows, seed=0):
+    """
+    Compare `prep_data` with the previous implementation on a generated raw sheet.
+
+    Returns:
+    - list of dict: One record per implementation with time, peak memory and output size.
+    """
+    raw = make_raw_sheet(n_rows, seed=seed)
+    records = []
+    for name, function in [('prep_data_baseline', prep_data_baseline), ('prep_data', prep_data)]:
+        result = measure(function, raw.copy())
+        records.append({
+            'function': name,
+            'input_rows': n_rows,
+            'output_rows': len(result['output']),
+            'seconds': round(result['seconds'], 3),
+            'peak_mb': round(result['peak_mb'], 1),
+        })
+    return records
+
+
+def benchmark_schema(n_rows, seed=0):
+    """
+    Compare memory and ALIEN_ID merge time of plain prepped frames and typed frames.
+
+    Returns:
+    - list of dict: One record per representation.
+    """
+    data = prep_data(make_raw_sheet(n_rows, seed=seed))[selected_cols]
+    db = prep_data(make_raw_sheet(n_rows, seed=seed + 1))[selected_cols]
+    typed_data, typed_db = share_categories(apply_schema(data), apply_schema(db))
+
+    def merge(data, db):
+        return pd.merge(data[data['MASTER_FORM_TYPE'] == 'MT_59'], db[db['MASTER_FORM_TYPE'] == 'MT_13_EXIT'], on='ALIEN_ID')
+
+    records = []
+    for name, (d, b) in [('prepped', (data, db)), ('typed', (typed_data, typed_db))]:
+        # Warm-up run: the first merge of a categorical builds the category hash tables
+        merge(d, b)
+        result = measure(merge, d, b)
+        records.append({
+            'function': f'schema_{name}',
+            'input_rows': len(d) + len(b),
+            'output_rows': len(result['output']),
+            'memory_mb': round(float(d.memory_usage(deep=True).sum() + b.memory_usage(deep=True).sum()) / 2**20, 1),
+            'seconds': round(result['seconds'], 3),
+            'peak_mb': round(result['peak_mb'], 1),
+        })
+    return records
+
+
+def benchmark_incremental(n_rows, seed=0, batch_rows=1000):
+    """
+    Compare flow 4 on a batch of new applications with the full history and with `IncrementalEvaluator`.
+
+    Returns:
+    - list of dict: One record per evaluation.
+    """
+    db = prep_data(make_raw_sheet(n_rows, seed=seed))[selected_cols]
+    data = prep_data(make_raw_sheet(batch_rows, seed=seed + 1))[selected_cols]
+    # Applications of aliens already in the history
+    data['ALIEN_ID'] = db['ALIEN_ID'].sample(len(data), random_state=seed).to_numpy()
+    config_case = {"number": 50, "day": 20}
+    evaluator = IncrementalEvaluator(db, {"flow4": config_case})
+
+    records = []
+    for name, function in [('flow_4', lambda: flow_4(data, db, config_case)),
+                           ('incremental_flow_4', lambda: evaluator.evaluate(data)['flow4'])]:
+        result = measure(function)
+        records.append({
+            'function': name,
+            'input_rows': len(data),
+            'history_rows': len(db),
+            'status': result['output']['status'],
+            'seconds': round(result['seconds'], 3),
+            'peak_mb': round(result['peak_mb'], 1),
+        })
+    return records
+
+
+config_flow1 = [
+    {"job": "กรรมกร", "number": 10},
+    {"job": "งานขายของหน้าร้าน", "number": 10},
+    {"job": "งานทํามือ", "number": 10},
+    {"job": "N/A", "number": 10}
+]
+config_flow2 = {"number": 20, "day": 14}
+config_flow4 = {"number": 50, "day": 20}
+
+
+def suite_cases(data, db):
+    """
+    Get the (name, function) pairs measured by `benchmark_suite` for one generated data set.
+    """
+    raw = to_raw(data)
+    relocations = pd.concat([db, data]).groupby(['CREATED_TIMESTAMP', 'EMPLOYER_NO', 'FORM_ID']).agg(ALIEN_COUNT=('ALIEN_ID', 'count')).reset_index()
+    # The pair with the most relocations, for the A to B checks
+    pairs = TransitionMatrix(data, db).to_frame()
+    pair = pairs.groupby(['EMPLOYER_NO_A', 'EMPLOYER_NO_B'], observed=True)['ALIEN_COUNT'].sum().idxmax() if len(pairs) else (None, None)
+    expiry_index = ExpiryIndex(db)
+    today = data['CREATED_TIMESTAMP'].min()
+
+    return [
+        ('prep_data', lambda: prep_data(raw)),
+        ('check_inform_exit', lambda: check_inform_exit(data, db)),
+        ('check_job_limits', lambda: check_job_limits(data, config_flow1)),
+        ('check_expire_condition', lambda: check_expire_condition(data, db)),
+        ('ExpiryIndex', lambda: ExpiryIndex(db)),
+        ('check_expire_condition_indexed', lambda: check_expire_condition(data, db, expiry_index=expiry_index)),
+        ('ExpiryIndex.expiring_within', lambda: expiry_index.expiring_within(30, today=today)),
+        ('check_status_resign_a', lambda: check_status_resign_a(data, db)),
+        ('check_status_resign_b', lambda: check_status_resign_b(db)),
+        ('check_relocate_condition_from_B', lambda: check_relocate_condition_from_B(data, relocations, config_flow4["number"], config_flow4["day"], by=['EMPLOYER_NO'])),
+        ('check_relocate_condition_from_A_to_B', lambda: check_relocate_condition_from_A_to_B(data, db, config_flow2, *pair)),
+        ('check_relocate_condition_all_pairs', lambda: check_relocate_condition_all_pairs(data, db, config_flow2)),
+        ('flow_1', lambda: flow_1(data, db, config_flow1)),
+        ('flow_2', lambda: flow_2(data, db, config_flow2, *pair)),
+        ('flow_4', lambda: flow_4(data, db, config_flow4)),
+    ]
+
+
+def benchmark_suite(sizes, seed=0, trace_memory=True, **generator_options):
+    """
+    Measure `prep_data`, every check of flow/module.py and every flow on generated data of several sizes.
+
+    Parameters:
+    - sizes (list of int): Numbers of aliens in the history, there is one employer for 10 aliens.
+    - seed (int): Random seed of the generator.
+    - trace_memory (bool): Measure the peak traced allocation (slower).
+    - generator_options: Other parameters of `flow.generator.generate` (skew, shares, ...).
+
+    Returns:
+    - generator of dict: One record per function and size, yielded as soon as it is measured.
+    """
+    for n_aliens in sizes:
+        n_employers = max(n_aliens // 10, 1)
+        data, db = generate(n_aliens, n_employers, seed=seed, **generator_options)
+        for name, function in suite_cases(data, db):
+            result = measure(function, trace_memory=trace_memory)
+            yield {
+                'function': name,
+                'aliens': n_aliens,
+                'employers': n_employers,
+                'data_rows': len(data),
+                'db_rows': len(db),
+                'seconds': round(result['seconds'], 3),
+                'peak_mb': None if result['peak_mb'] is None else round(result['peak_mb'], 1),
+            }
+
+
+def benchmark_engines(sizes, seed=0):
+    """
+    Run the history lookups and the flows on the pandas and the SQLite engine, and compare their results.
+
+    The SQLite database is in memory, the 'load' record is the time to build it with its indexes.
+
+    Returns:
+    - generator of dict: One record per function, engine and size, with 'matches' (SQLite result equal to the pandas one).
+    """
+    config = {'flow1': config_flow1, 'flow2': config_flow2, 'flow4': config_flow4}
+    for n_aliens in sizes:
+        data, db = generate(n_aliens, max(n_aliens // 10, 1), seed=seed)
+        record = {'aliens': n_aliens, 'data_rows': len(data), 'db_rows': len(db)}
+        load = measure(SQLiteEngine.from_frame, db, trace_memory=False)
+        yield {'function': 'load', 'engine': 'sqlite', **record, 'seconds': round(load['seconds'], 3)}
+        engines = {'pandas': PandasEngine(db), 'sqlite': load['output']}
+        expected = {}
+        for name, engine in engines.items():
+            for function, case in engine_cases(data, db, engine, config):
+                result = measure(case, trace_memory=False)
+                value = comparable(result['output'])
+                expected.setdefault(function, value)
+                yield {
+                    'function': function, 'engine': name, **record,
+                    'seconds': round(result['seconds'], 3), 'matches': value == expected[function],
+                }
+
+
+def flow2_pairs(data, db) -> list:
+    """
+    Get the (EMPLOYER_NO_A, EMPLOYER_NO_B) pairs of the applications: employer of the latest exit of the alien, employer of the application.
+    """
+    exits = db[db['MASTER_FORM_TYPE'] == 'MT_13_EXIT'].sort_values('CREATED_TIMESTAMP', kind='mergesort')
+    employer_a = exits.drop_duplicates('ALIEN_ID', keep='last').set_index('ALIEN_ID')['EMPLOYER_NO']
+    applications = data[data['MASTER_FORM_TYPE'] == 'MT_59']
+    pairs = pd.DataFrame({'A': applications['ALIEN_ID'].map(employer_a), 'B': applications['EMPLOYER_NO']}).dropna()
+    return list(pairs.drop_duplicates().itertuples(index=False, name=None))
+
+
+def benchmark_parallel(sizes, workers, seed=0):
+    """
+    Run flow 1, 2 and 4 per employer group with `ParallelRunner` on several numbers of workers.
+
+    Returns:
+    - generator of dict: One record per size and number of workers, with the 'start' time of the pool,
+      the 'seconds' of the run, the 'speedup' over the first number of workers (0 runs the shards in
+      this process), 'matches' and the number of 'cpus' of the machine, the speedup is bounded by it.
+    """
+    config = {'flow1': config_flow1, 'flow2': config_flow2, 'flow4': config_flow4}
+    for n_aliens in sizes:
+        data, db = generate(n_aliens, max(n_aliens // 10, 1), seed=seed)
+        pairs = flow2_pairs(data, db)
+        first = None
+        for n_workers in workers:
+            start = time.perf_counter()
+            with ParallelRunner(db, workers=n_workers) as runner:
+                started = time.perf_counter() - start
+                result = measure(runner.run, data, config, pairs, trace_memory=False)
+            groups = {flow: merged['groups'] for flow, merged in result['output'].items()}
+            if first is None:
+                first = (result['seconds'], groups)
+            yield {
+                'function': 'ParallelRunner.run', 'workers': n_workers, 'aliens': n_aliens,
+                'data_rows': len(data), 'db_rows': len(db), 'groups': sum(len(g) for g in groups.values()),
+                'start': round(started, 3), 'seconds': round(result['seconds'], 3),
+                'speedup': round(first[0] / result['seconds'], 2),
+                'matches': all(groups[flow].equals(first[1][flow]) for flow in groups), 'cpus': os.cpu_count(),
+            }
+
+
+def benchmark_rules(sizes, seed=0):
+    """
+    Measure the evaluation of every rule in one pass against the flows, each on a new plan.
+
+    Returns:
+    - generator of dict: One record per function and size. The 'evaluate_all_rules' record has the
+      number of rows violating each rule ('violations') and 'matches': its R1/1 and R1/2 rows are
+      the rows reported abnormal by the inform exit and job limits checks.
+    """
+    config = {'flow1': config_flow1, 'flow2': config_flow2, 'flow4': config_flow4}
+    for n_aliens in sizes:
+        data, db = generate(n_aliens, max(n_aliens // 10, 1), seed=seed)
+        pairs = TransitionMatrix(data, db).to_frame()
+        pair = pairs.groupby(['EMPLOYER_NO_A', 'EMPLOYER_NO_B'], observed=True)['ALIEN_COUNT'].sum().idxmax() if len(pairs) else (None, None)
+        record = {'aliens': n_aliens, 'data_rows': len(data), 'db_rows': len(db)}
+
+        rules = measure(lambda: evaluate_all_rules(ExecutionPlan(data, db), config), trace_memory=False)
+        violations = rule_frame(rules['output']['bits'])
+        inform_exit = check_inform_exit(data, db)
+        data_case = data[~data['ALIEN_ID'].isin(data['ALIEN_ID'].take(inform_exit['rows']))]
+        job_limits = check_job_limits(data_case, config_flow1)
+        matches = bool(np.array_equal(np.flatnonzero(violations['R1/1']), np.sort(inform_exit['rows']))) and \
+            int(violations['R1/2'].sum()) == job_limits['count_abnormal']
+        yield {'function': 'evaluate_all_rules', **record, 'seconds': round(rules['seconds'], 3),
+               'violations': {code: int(violations[code].sum()) for code in rule_codes}, 'matches': matches}
+
+        for name, flows in [('run_flows', config), ('flow_4', {'flow4': config_flow4})]:
+            result = measure(lambda: run_flows(ExecutionPlan(data, db), flows, *pair), trace_memory=False)
+            yield {'function': name, **record, 'seconds': round(result['seconds'], 3)}
+
+
+def benchmark_cases(sizes, n_cases, seed=0):
+    """
+    Measure each flow run once over many cases with a case key against the same flow run once per case.
+
+    The aliens are spread over `n_cases` cases, with their current and historical rows.
+
+    Returns:
+    - generator of dict: One record per flow, size and mode ('grouped' or 'per_case'), the 'per_case'
+      record has 'matches': the status and count_abnormal of every case are those of the grouped run.
+    """
+    for n_aliens in sizes:
+        data, db = generate(n_aliens, max(n_aliens // 10, 1), seed=seed)
+        aliens = pd.Index(pd.unique(pd.concat([data['ALIEN_ID'], db['ALIEN_ID']])))
+        data['CASE_ID'] = aliens.get_indexer(data['ALIEN_ID']) % n_cases
+        db['CASE_ID'] = aliens.get_indexer(db['ALIEN_ID']) % n_cases
+        cases = pd.DataFrame({'CASE_ID': np.arange(n_cases)})
+        pairs = TransitionMatrix(data, db).to_frame()
+        pair = pairs.groupby(['EMPLOYER_NO_A', 'EMPLOYER_NO_B'], observed=True)['ALIEN_COUNT'].sum().idxmax() if len(pairs) else (None, None)
+        record = {'aliens': n_aliens, 'cases': n_cases, 'data_rows': len(data), 'db_rows': len(db)}
+
+        flows = [
+            ('flow_1', flow_1, pd.merge(cases, pd.DataFrame(config_flow1), how='cross'), lambda d, b: flow_1(d, b, config_flow1)),
+            ('flow_2', flow_2, cases.assign(**config_flow2, EMPLOYER_NO_A=pair[0], EMPLOYER_NO_B=pair[1]),
+             lambda d, b: flow_2(d, b, config_flow2, *pair)),
+            ('flow_4', flow_4, cases.assign(**config_flow4), lambda d, b: flow_4(d, b, config_flow4)),
+        ]
+        for name, flow, config_case, flow_per_case in flows:
+            grouped = measure(flow, data, db, config_case, case_key='CASE_ID', trace_memory=False)
+            yield {'function': name, 'mode': 'grouped', **record, 'seconds': round(grouped['seconds'], 3)}
+
+            def per_case():
+                return [flow_per_case(data[data['CASE_ID'] == case], db[db['CASE_ID'] == case]) for case in range(n_cases)]
+            looped = measure(per_case, trace_memory=False)
+            expected = grouped['output']['cases']
+            matches = [r['status'] for r in looped['output']] == expected['status'].tolist() and \
+                [int(r['count_abnormal']) for r in looped['output']] == expected['count_abnormal'].astype(int).tolist()
+            yield {'function': name, 'mode': 'per_case', **record, 'seconds': round(looped['seconds'], 3), 'matches': matches}
+
+
+def run_command(args, cwd) -> dict:
+    """
+    Run a `python -m flow.cli` command and get its output and its --timing record (the last line of stderr).
+    """
+    start = time.perf_counter()
+    process = subprocess.run([sys.executable, '-m', 'flow.cli', *args, '--timing'], cwd=cwd, capture_output=True, check=True)
+    wall = time.perf_counter() - start
+    return {'output': process.stdout, 'wall_seconds': wall, **json.loads(process.stderr.decode('utf-8').strip().splitlines()[-1])}
+
+
+def benchmark_cli(sizes, seed=0):
+    """
+    Measure the time to first result of `python -m flow.cli` commands, cold and against a --serve process.
+
+    The generated data and history are written as raw CSV files. The modes are 'cold' (the files are
+    parsed), 'cold_snapshot' (read from the snapshot cache of the previous command), 'warm_first'
+    (the first command sent to the server, which shares the categories of the files and runs the flow)
+    and 'warm' (the same command again, answered from the result cache of the server).
+
+    Returns:
+    - generator of dict: One record per size and mode with the 'time_to_first_result' measured by the
+      command, the 'wall_seconds' of its process and 'matches' (the output is the one of the cold command).
+    """
+    function_dir = os.path.dirname(os.path.abspath(__file__))
+    for n_aliens in sizes:
+        data, db = generate(n_aliens, max(n_aliens // 10, 1), seed=seed)
+        with tempfile.TemporaryDirectory() as tmp:
+            data_path, db_path, socket_path = [os.path.join(tmp, name) for name in ['data.csv', 'db.csv', 'cli.sock']]
+            to_raw(data).to_csv(data_path, index=False)
+            to_raw(db).to_csv(db_path, index=False)
+            files = ['flow4', '--data', data_path, '--db', db_path, '--cache-dir', os.path.join(tmp, 'snapshots'), '--socket', socket_path]
+            record = {'function': 'cli flow4', 'aliens': n_aliens, 'data_rows': len(data), 'db_rows': len(db)}
+
+            runs = [('cold', run_command(files + ['--cold'], function_dir)), ('cold_snapshot', run_command(files + ['--cold'], function_dir))]
+            server = subprocess.Popen([sys.executable, '-m', 'flow.cli', '--serve', '--data', data_path, '--db', db_path, *files[5:]],
+                                      cwd=function_dir, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+            try:
+                # The server prints a line once the files are loaded
+                started = json.loads(server.stdout.readline())
+                yield {**record, 'mode': 'serve_start', 'seconds': started['seconds']}
+                runs += [('warm_first', run_command(files, function_dir)), ('warm', run_command(files, function_dir))]
+            finally:
+                server.terminate()
+                server.wait()
+
+            expected = runs[0][1]['output']
+            for mode, run in runs:
+                yield {**record, 'mode': mode, 'measured_mode': run['mode'], 'time_to_first_result': run['time_to_first_result'],
+                       'wall_seconds': round(run['wall_seconds'], 3), 'matches': run['output'] == expected}
+
+
+def benchmark_report(sizes, seed=0):
+    """
+    Measure the anomaly report writer of flow/report.py on the results of flow 1 and flow 4, for each format and size.
+
+    The peak traced allocation of the writer does not include the results, which are computed before,
+    so it should stay flat when the size grows.
+
+    Returns:
+    - generator of dict: One record per size and format with the rows written, the 'seconds' of a run
+      without tracing and the 'peak_mb' of a traced run.
+    """
+    for n_aliens in sizes:
+        data, db = generate(n_aliens, max(n_aliens // 10, 1), seed=seed)
+        results = [('flow1', flow_1(data, db, config_flow1)), ('flow4', flow_4(data, db, config_flow4))]
+        with tempfile.TemporaryDirectory() as tmp:
+            for path, engine in [('report.xlsx', 'xlsxwriter'), ('report.xlsx', 'openpyxl'), ('report.csv', None)]:
+                if engine == 'xlsxwriter' and importlib.util.find_spec('xlsxwriter') is None:
+                    continue
+
+                def write_report():
+                    with ReportWriter(os.path.join(tmp, path), engine=engine) as report:
+                        return sum(report.add(flow, result) for flow, result in results)
+                timed = measure(write_report, trace_memory=False)
+                traced = measure(write_report)
+                yield {'function': 'ReportWriter', 'format': path.split('.')[-1], 'engine': engine, 'aliens': n_aliens,
+                       'rows': timed['output'], 'seconds': round(timed['seconds'], 3), 'peak_mb': round(traced['peak_mb'], 1)}
+
+
+def benchmark_as_of(sizes, n_dates, seed=0):
+    """
+    Measure the evaluation of a batch against the history as of a range of dates (flow/temporal_index.py).
+
+    A twentieth of the generated data is evaluated at `n_dates` dates spread over the history, by
+    filtering `db` and running the flows for each date, with `AsOfEvaluator.evaluate` for each date,
+    and with one `AsOfEvaluator.backfill` over all of them.
+
+    Returns:
+    - generator of dict: One record per size and mode ('filtered', 'as_of' or 'backfill'), with 'matches':
+      the status and count_abnormal of every flow and date are those of the 'filtered' run.
+    """
+    config = {'flow1': config_flow1, 'flow4': config_flow4}
+    for n_aliens in sizes:
+        data, db = generate(n_aliens, max(n_aliens // 10, 1), seed=seed)
+        batch = data.iloc[:max(len(data) // 20, 1)]
+        created = pd.to_datetime(db['CREATED_TIMESTAMP'])
+        dates = pd.date_range(created.min(), created.max(), periods=n_dates)
+        record = {'function': 'as_of', 'aliens': n_aliens, 'batch_rows': len(batch), 'db_rows': len(db), 'dates': n_dates}
+
+        index = measure(TemporalIndex, db, trace_memory=False)
+        evaluator = AsOfEvaluator(index['output'], config)
+        yield {**record, 'mode': 'index', 'seconds': round(index['seconds'], 3)}
+
+        runs = {
+            'filtered': measure(lambda: [run_flows(ExecutionPlan(batch, db[created <= date]), config) for date in dates], trace_memory=False),
+            'as_of': measure(lambda: [evaluator.evaluate(batch, date) for date in dates], trace_memory=False),
+            'backfill': measure(lambda: [results for _, results in evaluator.backfill(batch, dates)], trace_memory=False),
+        }
+        expected = [[(r['status'], int(r['count_abnormal'])) for r in results.values()] for results in runs['filtered']['output']]
+        for mode, run in runs.items():
+            statuses = [[(r['status'], int(r['count_abnormal'])) for r in results.values()] for results in run['output']]
+            yield {**record, 'mode': mode, 'seconds': round(run['seconds'], 3), 'matches': statuses == expected}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=200_000, help="number of form rows in the generated sheet")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--suite", action="store_true", help="measure every check and flow on generated data")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000], help="numbers of aliens for --suite")
+    parser.add_argument("--engines", action="store_true", help="compare the pandas and the SQLite engine on generated data")
+    parser.add_argument("--rules", action="store_true", help="measure the evaluation of every rule against the flows on generated data")
+    parser.add_argument("--cases", action="store_true", help="run each flow over many cases with a case key and once per case")
+    parser.add_argument("--n-cases", type=int, default=1000, help="number of cases for --cases")
+    parser.add_argument("--cli", action="store_true", help="measure the time to first result of flow/cli.py, cold and warm")
+    parser.add_argument("--report", action="store_true", help="measure the streaming anomaly report writer on generated results")
+    parser.add_argument("--as-of", action="store_true", help="evaluate a batch against the history as of a range of dates")
+    parser.add_argument("--n-dates", type=int, default=30, help="number of dates for --as-of")
+    parser.add_argument("--parallel", action="store_true", help="run the flows per employer group on several numbers of workers")
+    parser.add_argument("--workers", type=int, nargs="+", default=[0, 1, 2, 4], help="numbers of worker processes for --parallel (0 runs in this process)")
+    parser.add_argument("--no-trace-memory", action="store_true", help="only measure wall time")
+    args = parser.parse_args()
+
+    if args.as_of:
+        records = benchmark_as_of(args.sizes, args.n_dates, args.seed)
+    elif args.report:
+        records = benchmark_report(args.sizes, args.seed)
+    elif args.cli:
+        records = benchmark_cli(args.sizes, args.seed)
+    elif args.cases:
+        records = benchmark_cases(args.sizes, args.n_cases, args.seed)
+    elif args.rules:
+        records = benchmark_rules(args.sizes, args.seed)
+    elif args.parallel:
+        records = benchmark_parallel(args.sizes, args.workers, args.seed)
+    elif args.engines:
+        records = benchmark_engines(args.sizes, args.seed)
+    elif args.suite:
+        records = benchmark_suite(args.sizes, args.seed, trace_memory=not args.no_trace_memory)
+    else:
+        records = benchmark_prep_data(args.rows, args.seed) + benchmark_schema(args.rows, args.seed) + \
+            benchmark_incremental(args.rows, args.seed)
+    for record in records:
+        print(json.dumps(record, ensure_ascii=False), flush=True)
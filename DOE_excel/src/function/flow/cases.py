@@ -0,0 +1,293 @@
+import numpy as np
+import pandas as pd
+
+from .expiry_index import ExpiryIndex
+from .module import reasons
+from .relocation import find_relocation_windows, window_columns
+from .result import ResultRows
+from .status_index import AlienStatusIndex
+
+
+def case_table(config_case, case_key, data) -> pd.DataFrame:
+    """
+    Get the config of a grouped flow as a lookup table with the `case_key` column.
+
+    Parameters:
+    - config_case (pd.DataFrame, list of dict or dict): Config entries. Without a `case_key` column,
+      every entry applies to every case of `data`, in order of first appearance.
+    - case_key (str): Case key column of the data, the history and the table.
+    - data (pd.DataFrame): Current data with the `case_key` column.
+
+    Returns:
+    - pd.DataFrame: Config entries of each case.
+    """
+    config_case = pd.DataFrame([config_case] if isinstance(config_case, dict) else config_case)
+    if case_key not in config_case.columns:
+        cases = pd.DataFrame({case_key: data[case_key].dropna().unique()})
+        config_case = pd.merge(cases, config_case, how='cross')
+    return config_case
+
+
+def case_history(data, db, case_key, employer_cases=()) -> pd.DataFrame:
+    """
+    Get the history rows of each case of `data` for the grouped flows, tagged with their case in the `case_key` column.
+
+    The rows of a case are those of its aliens, and of its employers for the cases of `employer_cases` (flow 4),
+    as `HistoryStore.rows_for` on the rows of the case alone. A row of several cases is repeated for each of them.
+
+    Parameters:
+    - data (pd.DataFrame): Current data with the `case_key` column.
+    - db (pd.DataFrame): Historical data.
+    - case_key (str): Case key column.
+    - employer_cases (list-like): Cases that also get the rows of their employers.
+
+    Returns:
+    - pd.DataFrame: Rows of `db` with the `case_key` column, in history order within a case.
+    """
+    history_keys = pd.DataFrame({'ALIEN_ID': db['ALIEN_ID'].astype(object).to_numpy(), 'EMPLOYER_NO': db['EMPLOYER_NO'].astype(object).to_numpy(),
+                                 'ROW': np.arange(len(db))})
+    cases = data[case_key].to_numpy()
+    pairs = []
+    for column, rows in [('ALIEN_ID', np.ones(len(data), dtype=bool)), ('EMPLOYER_NO', np.isin(cases, list(employer_cases)))]:
+        keys = pd.DataFrame({'CASE': cases[rows], column: data[column].astype(object).to_numpy()[rows]}).drop_duplicates()
+        pairs.append(pd.merge(keys, history_keys[[column, 'ROW']], on=column)[['CASE', 'ROW']])
+    pairs = pd.concat(pairs, ignore_index=True).drop_duplicates().sort_values(['CASE', 'ROW'])
+
+    history = db.take(pairs['ROW'].to_numpy()).reset_index(drop=True)
+    history[case_key] = pairs['CASE'].to_numpy()
+    return history
+
+
+class CaseBatch:
+    """
+    Rows of several cases (e.g. test cases or application batches), evaluated by the grouped flows in one pass.
+
+    A case is the set of rows of `data` and `db` with the same value in the `case_key` column, and
+    is checked as if its rows were given to a flow on their own. ALIEN_ID (and EMPLOYER_NO, see `codes`)
+    are replaced by integer codes of their (case, value) pairs, so the latest-status index, the expiry
+    index, the merges and the relocation windows keep the cases apart while running over all of
+    them at once. Rows are reported as positions in `data` (see `check_rows`).
+
+    Parameters:
+    - data (pd.DataFrame): Current data with the `case_key` column.
+    - db (pd.DataFrame): Historical data with the `case_key` column.
+    - case_key (str): Case key column.
+    - cases (list-like): Cases to evaluate, in the order of the results. Rows of other cases are left out.
+
+    Example:
+        batch = CaseBatch(data, db, "CASE_ID", ["TC01", "TC02"])
+        inform_exit = batch.inform_exit()
+        inform_exit['normal']  # per case
+    """
+
+    def __init__(self, data: pd.DataFrame, db: pd.DataFrame, case_key, cases):
+        self.case_key = case_key
+        self.cases = pd.Index(cases)
+        self.data = data[data[case_key].isin(self.cases)]
+        self.db = db[db[case_key].isin(self.cases)]
+        self.data_case = self.cases.get_indexer(self.data[case_key])
+        self.db_case = self.cases.get_indexer(self.db[case_key])
+        self.data_alien, self.db_alien = self.codes('ALIEN_ID')
+        self.is_application = (self.data['MASTER_FORM_TYPE'] == 'MT_59').to_numpy()
+
+    def __len__(self):
+        return len(self.cases)
+
+    def codes(self, column) -> tuple:
+        """
+        Get the integer code of the (case, value) pair of each row of `data` and `db` (missing values are a value of their own, as in the merges).
+        """
+        pairs = pd.DataFrame({
+            'CASE': np.concatenate([self.data_case, self.db_case]),
+            'VALUE': pd.concat([self.data[column].astype(object), self.db[column].astype(object)], ignore_index=True),
+        })
+        codes = pairs.groupby(['CASE', 'VALUE'], sort=False, dropna=False).ngroup().to_numpy()
+        return codes[:len(self.data)], codes[len(self.data):]
+
+    def count(self, positions) -> np.ndarray:
+        """
+        Count the rows of `data` at `positions` in each case.
+        """
+        return np.bincount(self.data_case[positions], minlength=len(self.cases))
+
+    def per_case(self, values) -> np.ndarray:
+        """
+        Get the value of the case of each row of `data`.
+        """
+        return np.asarray(values)[self.data_case]
+
+    def without_aliens(self, mask, rows) -> np.ndarray:
+        """
+        Get the rows of `mask` whose alien has no row at `rows` in the same case.
+        """
+        return mask & ~np.isin(self.data_alien, self.data_alien[rows])
+
+    def inform_exit(self) -> dict:
+        """
+        Run `check_inform_exit` on every case.
+
+        Returns:
+        - dict: 'normal' and 'count_abnormal' (np.ndarray per case), and the abnormal MT_59 rows as 'rows' (positions in `data`).
+        """
+        positions = np.flatnonzero(self.is_application)
+        index = AlienStatusIndex(pd.DataFrame({
+            'ALIEN_ID': self.db_alien,
+            'MASTER_FORM_TYPE': self.db['MASTER_FORM_TYPE'].to_numpy(),
+            'CREATED_TIMESTAMP': self.db['CREATED_TIMESTAMP'].to_numpy(),
+        }))
+        latest_form_type = index.latest_form_type(self.data_alien[positions])
+
+        # Aliens without history are neither normal nor abnormal
+        is_exit = latest_form_type.str.contains('MT_13_EXIT', regex=False, na=False).to_numpy()
+        rows = positions[~is_exit & latest_form_type.notna().to_numpy()]
+        count_abnormal = self.count(rows)
+        return {'normal': count_abnormal < self.count(positions), 'count_abnormal': count_abnormal, 'rows': rows}
+
+    def job_limits(self, mask, config_case: pd.DataFrame) -> dict:
+        """
+        Run `check_job_limits` on the rows of `mask` of every case, each case with its own limits.
+
+        Parameters:
+        - mask (np.ndarray): Rows of `data` given to the check.
+        - config_case (pd.DataFrame): 'job' and 'number' of each case (see `case_table`).
+
+        Returns:
+        - dict: 'normal', 'count_abnormal' and 'job_abnormal' (list of jobs) per case, and the rows of
+          `mask` as 'rows' with their 'abnormal' mask.
+        """
+        case_of_config = self.cases.get_indexer(config_case[self.case_key])
+        limits = pd.Series(config_case['number'].to_numpy(), index=pd.MultiIndex.from_arrays([case_of_config, config_case['job']]))
+        # Strictest limit of each job, in config order
+        limits = limits.groupby(level=[0, 1], sort=False).min()
+        specific_jobs = limits.index[limits.index.get_level_values(1) != "N/A"]
+
+        positions = np.flatnonzero(mask)
+        case = self.data_case[positions]
+        jobs = self.data['JOB_DESCRIPTION'].to_numpy(dtype=object)[positions]
+        employers = self.data['EMPLOYER_NO'].to_numpy(dtype=object)[positions]
+        job_key = np.where(pd.MultiIndex.from_arrays([case, jobs]).isin(specific_jobs), jobs, "N/A")
+        is_case = self.is_application[positions]
+
+        counts = pd.DataFrame({
+            'CASE': case[is_case], 'EMPLOYER_NO': employers[is_case], 'JOB': job_key[is_case],
+            'ALIEN_ID': self.data['ALIEN_ID'].to_numpy(dtype=object)[positions][is_case],
+        }).groupby(['CASE', 'EMPLOYER_NO', 'JOB'], sort=False, dropna=False)['ALIEN_ID'].count().rename('ALIEN_COUNT').reset_index()
+        counts['LIMIT'] = limits.reindex(pd.MultiIndex.from_arrays([counts['CASE'], counts['JOB']])).to_numpy()
+        over = counts[counts['ALIEN_COUNT'] > counts['LIMIT']]
+
+        row_keys = pd.MultiIndex.from_arrays([case, employers, job_key])
+        is_abnormal = row_keys.isin(pd.MultiIndex.from_frame(over[['CASE', 'EMPLOYER_NO', 'JOB']]))
+        count_abnormal = self.count(positions[is_abnormal])
+
+        # Jobs over their limit in config order, followed by the "N/A" jobs of the employers over the "N/A" limit
+        job_abnormal = [[] for _ in range(len(self.cases))]
+        over_jobs = set(zip(over['CASE'], over['JOB']))
+        for i, job in limits.index:
+            if (i, job) in over_jobs:
+                job_abnormal[i].append(job)
+        na_employers = pd.MultiIndex.from_frame(over.loc[over['JOB'] == "N/A", ['CASE', 'EMPLOYER_NO']])
+        na_rows = is_case & (job_key == "N/A") & pd.MultiIndex.from_arrays([case, employers]).isin(na_employers)
+        na_jobs = pd.DataFrame({'CASE': case[na_rows], 'JOB': jobs[na_rows]}).dropna().drop_duplicates()
+        for i, job in zip(na_jobs['CASE'], na_jobs['JOB']):
+            if "N/A" in job_abnormal[i]:
+                job_abnormal[i].append(job)
+
+        return {'normal': count_abnormal < self.count(positions), 'count_abnormal': count_abnormal, 'job_abnormal': job_abnormal,
+                'rows': positions, 'abnormal': is_abnormal}
+
+    def expire(self, mask) -> dict:
+        """
+        Run `check_expire_condition` on the rows of `mask` of every case.
+
+        Returns:
+        - dict: 'normal' and 'count_abnormal' per case, the rows of `mask` of the aliens of the abnormal pairs
+          as 'rows' and the case codes of those aliens as 'aliens'.
+        """
+        positions = np.flatnonzero(mask & self.is_application)
+        index = ExpiryIndex(pd.DataFrame({
+            'ALIEN_ID': self.db_alien,
+            'EMPLOYER_NO': self.db['EMPLOYER_NO'].to_numpy(),
+            'MASTER_FORM_TYPE': self.db['MASTER_FORM_TYPE'].to_numpy(),
+            'VALID_UNTIL': self.db['VALID_UNTIL'].to_numpy(),
+        }))
+        # One match per (application, exit record) pair
+        target, valid_until = index.permits(self.data_alien[positions])
+        matched = positions[target]
+        created = self.data['CREATED_TIMESTAMP'].to_numpy(dtype='datetime64[ns]')[matched]
+        is_abnormal = (created + np.timedelta64(30, 'D')) > valid_until
+
+        aliens = np.unique(self.data_alien[matched[is_abnormal]])
+        count_abnormal = self.count(matched[is_abnormal])
+        rows = np.flatnonzero(mask & np.isin(self.data_alien, aliens))
+        return {'normal': (self.count(matched) - count_abnormal) > 0, 'count_abnormal': count_abnormal, 'rows': rows, 'aliens': aliens}
+
+    def relocation_counts(self, exits, applications) -> pd.DataFrame:
+        """
+        Count the aliens of the exit records (mask of `db`) who applied (mask of `data`) in the same case, per case and exit CREATED_TIMESTAMP.
+
+        Returns:
+        - pd.DataFrame: 'CASE' (position of the case), 'CREATED_TIMESTAMP' of the exit and 'ALIEN_COUNT'.
+        """
+        merged = pd.merge(
+            pd.DataFrame({'KEY': self.db_alien[exits], 'CASE': self.db_case[exits],
+                          'CREATED_TIMESTAMP': self.db['CREATED_TIMESTAMP'].to_numpy()[exits]}),
+            pd.DataFrame({'KEY': self.data_alien[applications], 'ALIEN_ID': self.data['ALIEN_ID'].to_numpy(dtype=object)[applications]}),
+            on='KEY',
+        )
+        return merged.groupby(['CASE', 'CREATED_TIMESTAMP'])['ALIEN_ID'].count().rename('ALIEN_COUNT').reset_index()
+
+    def worst_windows(self, counts: pd.DataFrame, limits: pd.DataFrame, by=()) -> pd.DataFrame:
+        """
+        Find the relocation windows of every case with its own limits and keep the worst one of each case (see `worst_window`).
+
+        Parameters:
+        - counts (pd.DataFrame): Relocation counts with 'CASE' (position of the case), the `by` columns,
+          'CREATED_TIMESTAMP' and 'ALIEN_COUNT'.
+        - limits (pd.DataFrame): 'number' and 'day' of each case, in case order.
+        - by (list of str): Group columns evaluated separately within a case, e.g. ['EMPLOYER_NO'].
+
+        Returns:
+        - pd.DataFrame: The worst window of each case (missing values for the cases without offending window), indexed by case position.
+        """
+        frames = []
+        # One pass per distinct limit, usually a single one
+        for (number, day), cases in limits.groupby(['number', 'day'], sort=False).indices.items():
+            frames.append(find_relocation_windows(counts[counts['CASE'].isin(cases)], number, day, by=['CASE'] + list(by)))
+        windows = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=['CASE'] + window_columns)
+        worst = windows.sort_values(['CASE', 'ALIEN_COUNT', 'WINDOW_END'], kind='mergesort').drop_duplicates('CASE', keep='last')
+        # Float counts, missing for the cases without window (the empty frame has object columns)
+        return worst.set_index('CASE').reindex(range(len(self.cases))).astype({'ALIEN_COUNT': float})
+
+    def result_rows(self, parts) -> ResultRows:
+        """
+        Materialize the rows of the checks of a grouped flow, case after case, as `flow_rows` does for one case.
+
+        Parameters:
+        - parts (list of tuple): (rows, abnormal, status, reason, case_code) of each check: positions in `data`,
+          the mask of the rows abnormal for the check, the mask of the rows reported as abnormal,
+          the reason code (see `reasons`) and the case code of each row (a single value applies to every row).
+
+        Returns:
+        - ResultRows: Rows of all the checks, ordered by case, then check, then row.
+        """
+        def column(i, dtype):
+            # Per-row values of each part, a single value applies to every row of its part
+            return np.concatenate([np.broadcast_to(np.asarray(p[i], dtype=dtype), (len(p[0]),)) for p in parts])[order]
+
+        rows = np.concatenate([p[0] for p in parts]).astype(np.int64)
+        part = np.repeat(np.arange(len(parts)), [len(p[0]) for p in parts])
+        order = np.lexsort((rows, part, self.data_case[rows]))
+        abnormal, status, case_code = column(1, bool), column(2, bool), column(4, object)
+        description = np.concatenate([np.full(len(p[0]), reasons[p[3]], dtype=object) for p in parts])[order]
+
+        frame = self.data.take(rows[order])
+        frame['status'] = np.where(status, 'abnormal', 'normal')
+        frame['abnormal_desc'] = np.where(abnormal, description, 'pass')
+        frame['case_code'] = np.where(status, case_code, 'pass')
+        return ResultRows(frame)
+
+    def result_frame(self, columns) -> pd.DataFrame:
+        """
+        Get the results of the cases as a frame, one row per case with the `case_key` and `columns` (dict of per-case arrays).
+        """
+        return pd.DataFrame({self.case_key: self.cases, **columns})
@@ -0,0 +1,350 @@
+"""
+Evaluate flow 1, 2 or 4 on the applications of a CSV/XLSX file against a history file.
+
+Each result is printed as one JSON object per line (the body of flow/service.py): one line for
+the whole file, or one line per case with --cases, a JSON file of the FORM_IDs of each case
+(as `flow_id_config` of test_script.py), checked by the grouped flows in one pass.
+
+pandas and the flows are only imported once a flow is evaluated. With --serve, the process
+keeps the prepped files (and the results of the flows) in memory and answers the commands run
+later, which connect to its socket instead of reading the files again; a command runs cold,
+in its own process, when no server listens on the socket (or with --cold). --timing reports
+the time to the first result line, measured from the start of the command.
+
+Usage (from the function directory):
+    python -m flow.cli flow4 --data Testcase_DOE_2-7-2024.xlsx --db Testcase_DOE_2-7-2024.xlsx
+    python -m flow.cli flow1 --data Testcase_DOE_2-7-2024.xlsx --db Testcase_DOE_2-7-2024.xlsx --cases cases.json --config flow1.json
+    python -m flow.cli flow2 --data applications.csv --db history.csv --employer-a 0105500000001 --employer-b 0105500000002
+    python -m flow.cli --serve --db Testcase_DOE_2-7-2024.xlsx &
+    python -m flow.cli flow4 --data Testcase_DOE_2-7-2024.xlsx --db Testcase_DOE_2-7-2024.xlsx --timing
+"""
+import argparse
+import json
+import os
+import signal
+import socket
+import socketserver
+import sys
+import time
+
+# Start of the command, the time to first result is measured from here
+started = time.perf_counter()
+
+flow_names = ['flow1', 'flow2', 'flow4']
+
+default_socket = os.path.join(os.environ.get('TMPDIR', '/tmp'), f"doe-flow-{os.getuid()}.sock")
+
+
+def load_json(path):
+    if path is None:
+        return None
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def case_inputs(data, db, cases, config, employer_no_a=None, employer_no_b=None) -> tuple:
+    """
+    Give the rows of each case a CASE_ID from the FORM_IDs of the case, and build the config table of the grouped flows.
+
+    Parameters:
+    - data (pd.DataFrame): Current data.
+    - db (pd.DataFrame): Historical data.
+    - cases (dict): FORM_IDs of each case, e.g. {"TC01": ["00001"], "TC02": ["00002", "00003"]}.
+    - config (dict or list of dict): Config case of the flow, the same for every case unless its entries have a CASE_ID.
+    - employer_no_a (str, optional): Employer A of every case (flow 2), when the config does not give one per case.
+    - employer_no_b (str, optional): Employer B of every case (flow 2).
+
+    Returns:
+    - tuple: (data, db, config_case (pd.DataFrame) with one or more entries per CASE_ID, in the order of `cases`).
+    """
+    import pandas as pd
+
+    case_of_form = {str(form_id): str(case) for case, form_ids in cases.items() for form_id in form_ids}
+    data = data.assign(CASE_ID=data['FORM_ID'].astype(object).map(case_of_form))
+    db = db.assign(CASE_ID=db['FORM_ID'].astype(object).map(case_of_form))
+
+    table = pd.DataFrame({'CASE_ID': [str(case) for case in cases]})
+    config = pd.DataFrame([config] if isinstance(config, dict) else config)
+    if 'CASE_ID' in config.columns:
+        config_case = pd.merge(table, config.astype({'CASE_ID': str}), on='CASE_ID')
+    else:
+        config_case = pd.merge(table, config, how='cross')
+    if employer_no_a is not None:
+        config_case = config_case.assign(EMPLOYER_NO_A=employer_no_a, EMPLOYER_NO_B=employer_no_b)
+    return data, db, config_case
+
+
+def case_results(result) -> list:
+    """
+    Split the result of a grouped flow into one result per case, with the rows of the case.
+    """
+    from .result import ResultRows
+
+    rows = result['data'].to_frame()
+    positions = rows.groupby('CASE_ID', sort=False).indices
+    return [
+        {**case, 'data': ResultRows(rows.iloc[positions.get(case['CASE_ID'], [])].drop(columns='CASE_ID'))}
+        for case in result['cases'].to_dict(orient='records')
+    ]
+
+
+class Workspace:
+    """
+    Prepped frames of the files of the commands, kept in memory between the commands of a `--serve` process.
+
+    A file is read once, in the typed schema, and again only when its size or mtime changes. With
+    `cache_dir`, sheets are read through a `SnapshotCache`, so a cold command on an unchanged workbook
+    skips the openpyxl parse. With `result_cache`, each history keeps a `ResultCache` of the results
+    of the flows, and a case run again on the same history and config is not evaluated again.
+
+    Parameters:
+    - cache_dir (str, optional): Directory of the snapshot cache of the prepped sheets.
+    - result_cache (bool): Keep the results of the flows of each history.
+
+    Example:
+        workspace = Workspace(".snapshot_cache")
+        lines = workspace.evaluate({"flow": "flow4", "data": "Testcase_DOE_2-7-2024.xlsx", "data_sheet": "Test_Case",
+                                    "db": "Testcase_DOE_2-7-2024.xlsx", "db_sheet": "Prerequisite"})
+    """
+
+    def __init__(self, cache_dir=None, result_cache=False):
+        self.cache_dir = cache_dir
+        self.use_result_cache = result_cache
+        self.frames = {}
+        self.shared = None
+        self.result_caches = {}
+
+    def load(self, path, sheet) -> tuple:
+        """
+        Get the version (size and mtime) and the typed prepped frame of a sheet, read again when the file changed.
+        """
+        stat = os.stat(path)
+        version = (stat.st_size, stat.st_mtime_ns)
+        if self.frames.get((path, sheet), (None,))[0] != version:
+            from .prep_data import selected_cols
+
+            if self.cache_dir is not None:
+                from .snapshot_cache import SnapshotCache
+                frame = SnapshotCache(self.cache_dir).load_sheet(path, sheet, selected_cols, typed=True)
+            else:
+                from .ingest import read_prepped
+                frame = read_prepped(path, selected_cols, sheet_name=sheet, typed=True)
+            self.frames[(path, sheet)] = (version, frame)
+        return self.frames[(path, sheet)]
+
+    def frames_of(self, request) -> tuple:
+        """
+        Get the data and the history of a request, with shared categories (kept for the next request on the same files).
+
+        Returns:
+        - tuple: (data, db, history version (str)).
+        """
+        data_version, data = self.load(request['data'], request['data_sheet'])
+        db_version, db = self.load(request['db'], request['db_sheet'])
+        key = (request['data'], request['data_sheet'], data_version, request['db'], request['db_sheet'], db_version)
+        if self.shared is None or self.shared[0] != key:
+            from .schema import share_categories
+            self.shared = (key, *share_categories(data, db))
+        return self.shared[1], self.shared[2], json.dumps([request['db'], request['db_sheet'], db_version])
+
+    def runner(self, request, history_version):
+        """
+        Get the function running a flow: through the `ResultCache` of the history of the request, or directly.
+        """
+        if not self.use_result_cache:
+            return lambda flow, *args, **kwargs: flow(*args, **kwargs)
+        from .result_cache import ResultCache
+
+        history = (request['db'], request['db_sheet'])
+        if history not in self.result_caches or self.result_caches[history].version != history_version:
+            self.result_caches[history] = ResultCache(history_version)
+        return self.result_caches[history].run
+
+    def evaluate(self, request) -> list:
+        """
+        Evaluate the flow of a command.
+
+        Parameters:
+        - request (dict): 'flow', 'data', 'data_sheet', 'db', 'db_sheet' (absolute paths and sheets), 'config'
+          (None for the default config of the flow), 'cases' (None or the FORM_IDs of each case),
+          'employer_no_a' and 'employer_no_b'.
+
+        Returns:
+        - list of bytes: JSON line of each result, without the newline.
+        """
+        from .flow1 import flow_1
+        from .flow2 import flow_2
+        from .flow4 import flow_4
+        from .service import default_config, result_body
+
+        flow = {'flow1': flow_1, 'flow2': flow_2, 'flow4': flow_4}[request['flow']]
+        config = request['config'] if request['config'] is not None else default_config[request['flow']]
+        data, db, history_version = self.frames_of(request)
+        run = self.runner(request, history_version)
+
+        if request['cases']:
+            data, db, config_case = case_inputs(data, db, request['cases'], config, request['employer_no_a'], request['employer_no_b'])
+            if request['flow'] == 'flow2' and not {'EMPLOYER_NO_A', 'EMPLOYER_NO_B'} <= set(config_case.columns):
+                raise ValueError('flow2 needs --employer-a and --employer-b, or EMPLOYER_NO_A and EMPLOYER_NO_B in the config of each case.')
+            return [result_body(result) for result in case_results(run(flow, data, db, config_case, case_key='CASE_ID'))]
+
+        args = ()
+        if request['flow'] == 'flow2':
+            if request['employer_no_a'] is None or request['employer_no_b'] is None:
+                raise ValueError('flow2 needs --employer-a and --employer-b.')
+            args = (request['employer_no_a'], request['employer_no_b'])
+        return [result_body(run(flow, data, db, config, *args))]
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    """
+    Answer one command of a client: a header line ('results' and 'seconds', or 'error'), then the result lines.
+    """
+
+    def handle(self):
+        start = time.perf_counter()
+        try:
+            lines = self.server.workspace.evaluate(json.loads(self.rfile.readline()))
+        except Exception as error:
+            self.wfile.write(json.dumps({'error': f"{type(error).__name__}: {error}"}, ensure_ascii=False).encode('utf-8') + b'\n')
+            return
+        self.wfile.write(json.dumps({'results': len(lines), 'seconds': round(time.perf_counter() - start, 6)}).encode('utf-8') + b'\n')
+        for line in lines:
+            self.wfile.write(line + b'\n')
+
+
+def connect(socket_path):
+    """
+    Connect to the socket of a `--serve` process, None if none listens on it.
+    """
+    if not os.path.exists(socket_path):
+        return None
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path)
+    except (ConnectionRefusedError, FileNotFoundError):
+        client.close()
+        return None
+    return client
+
+
+def warm_lines(client, request):
+    """
+    Send a command to a `--serve` process and yield its result lines as they arrive.
+    """
+    with client, client.makefile('rb') as reader:
+        client.sendall(json.dumps(request, ensure_ascii=False).encode('utf-8') + b'\n')
+        header = json.loads(reader.readline() or b'{"error": "The server closed the connection."}')
+        if 'error' in header:
+            raise RuntimeError(header['error'])
+        for line in reader:
+            yield line.rstrip(b'\n')
+
+
+def write_results(lines, output) -> tuple:
+    """
+    Write the result lines, the first one as soon as it is available.
+
+    Returns:
+    - tuple: (number of results, seconds from the start of the command to the first result or None).
+    """
+    count, first = 0, None
+    for line in lines:
+        output.write(line + b'\n')
+        count += 1
+        if first is None:
+            output.flush()
+            first = time.perf_counter() - started
+    output.flush()
+    return count, first
+
+
+def serve(socket_path, workspace, preload=()):
+    """
+    Answer the commands sent to `socket_path` until interrupted, keeping the files of `workspace` in memory.
+
+    Parameters:
+    - socket_path (str): Unix socket of the server.
+    - workspace (Workspace): Frames (and results) kept between the commands.
+    - preload (list of tuple): (path, sheet) of the files to read before the first command, e.g. the history.
+    """
+    if connect(socket_path) is not None:
+        raise SystemExit(f"A server already listens on {socket_path}")
+    if os.path.exists(socket_path):
+        # Left by a server that did not stop cleanly
+        os.remove(socket_path)
+    for path, sheet in preload:
+        workspace.load(path, sheet)
+
+    server = socketserver.UnixStreamServer(socket_path, RequestHandler)
+    server.workspace = workspace
+    print(json.dumps({'listening': socket_path, 'files': [f"{path}:{sheet}" for path, sheet in preload],
+                      'seconds': round(time.perf_counter() - started, 3)}), flush=True)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.remove(socket_path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m flow.cli", description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("flow", nargs="?", choices=flow_names, help="flow to evaluate")
+    parser.add_argument("--data", help="CSV or XLSX file of the applications")
+    parser.add_argument("--data-sheet", default="Test_Case", help="sheet of the applications for XLSX files")
+    parser.add_argument("--db", help="CSV or XLSX file of the history")
+    parser.add_argument("--db-sheet", default="Prerequisite", help="sheet of the history for XLSX files")
+    parser.add_argument("--config", help="JSON file with the config case of the flow (the default config of flow/service.py otherwise)")
+    parser.add_argument("--cases", help="JSON file with the FORM_IDs of each case, every case is checked on its own rows")
+    parser.add_argument("--employer-a", help="employer A of flow 2")
+    parser.add_argument("--employer-b", help="employer B of flow 2")
+    parser.add_argument("--cache-dir", default=".snapshot_cache", help="snapshot cache of the prepped sheets, '' to read the files every time")
+    parser.add_argument("--socket", default=default_socket, help="Unix socket of the --serve process")
+    parser.add_argument("--serve", action="store_true", help="keep the files in memory and answer the commands sent to --socket")
+    parser.add_argument("--cold", action="store_true", help="evaluate in this process even when a server listens on --socket")
+    parser.add_argument("--timing", nargs="?", const="-", metavar="FILE",
+                        help="report the time to first result on stderr, or append it as a JSON line to FILE")
+    args = parser.parse_args(argv)
+
+    client = None if args.serve or args.cold else connect(args.socket)
+
+    if args.serve:
+        # SIGTERM stops the server like Ctrl-C, so the socket is removed
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        preload = [(os.path.abspath(path), sheet) for path, sheet in [(args.db, args.db_sheet), (args.data, args.data_sheet)] if path]
+        try:
+            serve(args.socket, Workspace(args.cache_dir or None, result_cache=True), preload)
+        except KeyboardInterrupt:
+            pass
+        return
+
+    if args.flow is None or args.data is None or args.db is None:
+        parser.error("a flow, --data and --db are needed (or --serve)")
+    request = {
+        'flow': args.flow,
+        'data': os.path.abspath(args.data), 'data_sheet': args.data_sheet,
+        'db': os.path.abspath(args.db), 'db_sheet': args.db_sheet,
+        'config': load_json(args.config), 'cases': load_json(args.cases),
+        'employer_no_a': args.employer_a, 'employer_no_b': args.employer_b,
+    }
+
+    mode = 'cold' if client is None else 'warm'
+    try:
+        lines = Workspace(args.cache_dir or None).evaluate(request) if client is None else warm_lines(client, request)
+        count, first = write_results(lines, sys.stdout.buffer)
+    except (RuntimeError, ValueError) as error:
+        raise SystemExit(f"error: {error}")
+
+    if args.timing:
+        timing = {'flow': args.flow, 'mode': mode, 'results': count,
+                  'time_to_first_result': None if first is None else round(first, 6),
+                  'seconds': round(time.perf_counter() - started, 6)}
+        if args.timing == '-':
+            print(json.dumps(timing), file=sys.stderr)
+        else:
+            with open(args.timing, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(timing) + '\n')
+
+
+if __name__ == "__main__":
+    main()
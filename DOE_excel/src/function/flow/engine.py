@@ -0,0 +1,303 @@
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+from .expiry_index import ExpiryIndex
+from .schema import decode
+from .status_index import AlienStatusIndex
+
+# Group columns of the relocation counts (see flow/plan.py)
+relocation_keys = ['CREATED_TIMESTAMP', 'EMPLOYER_NO', 'FORM_ID']
+
+
+class PandasEngine:
+    """
+    Execution of the history lookups of the checks on an in-memory DataFrame.
+
+    An engine answers the questions the checks ask about the history: the latest form of
+    some aliens (`status_index`), their work permit expiry dates (`expiry_index`), the exit
+    records of some employers, the relocation counts per day and employer, and the job
+    counts of a batch. `SQLiteEngine` answers the same questions with SQL, the flows take
+    either one through their `engine` argument.
+
+    Parameters:
+    - db (pd.DataFrame): Historical data.
+
+    Example:
+        engine = PandasEngine(db)
+        flow_1(data, db, config_flow1, engine=engine)
+    """
+
+    name = 'pandas'
+
+    def __init__(self, db: pd.DataFrame):
+        self.db = db
+
+    def status_index(self) -> AlienStatusIndex:
+        """
+        Get the latest-status index of the history (`latest`, `latest_form_type`).
+        """
+        return AlienStatusIndex(self.db)
+
+    def expiry_index(self) -> ExpiryIndex:
+        """
+        Get the expiry index of the exit records of the history (`permits`, `expiring`).
+        """
+        return ExpiryIndex(self.db)
+
+    def exit_records(self, employers=None) -> pd.DataFrame:
+        """
+        Get the MT_13_EXIT records of some employers (all of them if omitted), in history order.
+        """
+        db = self.db
+        is_exit = db['MASTER_FORM_TYPE'] == 'MT_13_EXIT'
+        if employers is None:
+            return db[is_exit]
+        return db[db['EMPLOYER_NO'].isin(employers) & is_exit]
+
+    def case_counts(self, excluded_aliens, employers=None) -> pd.DataFrame:
+        """
+        Count the aliens of the history per CREATED_TIMESTAMP, EMPLOYER_NO and FORM_ID.
+
+        Parameters:
+        - excluded_aliens (list-like): ALIEN_IDs left out of the counts.
+        - employers (list-like, optional): Only count the records of these EMPLOYER_NOs.
+
+        Returns:
+        - pd.DataFrame: `relocation_keys` and 'ALIEN_COUNT', sorted by the keys.
+        """
+        db = self.db
+        if employers is not None:
+            db = db[db['EMPLOYER_NO'].isin(employers)]
+        db_case = db[~db['ALIEN_ID'].isin(excluded_aliens)]
+        return db_case.groupby(relocation_keys, observed=True).agg(ALIEN_COUNT=('ALIEN_ID', 'count')).reset_index()
+
+    def job_counts(self, rows: pd.DataFrame) -> pd.DataFrame:
+        """
+        Count the aliens of a batch per EMPLOYER_NO and JOB (missing keys form their own groups).
+
+        Parameters:
+        - rows (pd.DataFrame): 'EMPLOYER_NO', 'JOB' and 'ALIEN_ID' of the rows to count.
+
+        Returns:
+        - pd.DataFrame: 'EMPLOYER_NO', 'JOB' and 'ALIEN_COUNT', in order of first appearance.
+        """
+        counts = rows.groupby(['EMPLOYER_NO', 'JOB'], observed=True, sort=False, dropna=False)['ALIEN_ID'].count()
+        return counts.rename('ALIEN_COUNT').reset_index()
+
+
+def sql_values(values) -> list:
+    """
+    Get values as Python objects for sqlite3 (missing values become None).
+    """
+    values = pd.Series(values).astype(object)
+    return values.where(values.notna(), None).tolist()
+
+
+def to_datetimes(values) -> np.ndarray:
+    """
+    Convert stored timestamps (nanoseconds since the epoch, None for missing dates) to datetime64[ns].
+    """
+    nat = np.iinfo(np.int64).min
+    return np.array([nat if value is None else value for value in values], dtype=np.int64).view('datetime64[ns]')
+
+
+class SQLiteEngine:
+    """
+    Execution of the history lookups of the checks as SQL on a SQLite database, for histories that do not fit in memory.
+
+    The history is kept in one `history` table, with the timestamps stored as nanoseconds since the
+    epoch, and indexes on (ALIEN_ID, CREATED_TIMESTAMP) for the latest status and the expiry merge,
+    (EMPLOYER_NO, MASTER_FORM_TYPE, CREATED_TIMESTAMP) for the exit records and relocation counts of
+    some employers, and VALID_UNTIL for the expiry ranges. The keys of a lookup (aliens, employers) go
+    through a temporary table, so each lookup is one indexed join whatever the number of keys.
+
+    It answers the same questions as `PandasEngine`, and is its own status and expiry index.
+
+    Only the relocation counts come from SQL, the relocation windows (`find_relocation_windows`)
+    stay in pandas: a window adds the counts of the history to the ones of the current batch, which
+    is not in the database, and the grouped counts are already down to one row per (day, employer,
+    form), so the cumulative sum over them is small next to the scan that produced them.
+
+    Parameters:
+    - path (str): Database file, created if missing (':memory:' for a temporary database).
+
+    Example:
+        engine = SQLiteEngine.from_frame(db, "history.sqlite")
+        flow_1(data, None, config_flow1, engine=SQLiteEngine("history.sqlite"))
+    """
+
+    name = 'sqlite'
+    datetime_columns = ['CREATED_TIMESTAMP', 'VALID_UNTIL']
+    indexes = {
+        'history_alien': ['ALIEN_ID', 'CREATED_TIMESTAMP'],
+        'history_employer': ['EMPLOYER_NO', 'MASTER_FORM_TYPE', 'CREATED_TIMESTAMP'],
+        'history_valid_until': ['VALID_UNTIL'],
+    }
+    # Latest record first: latest CREATED_TIMESTAMP, missing dates last, ties in history order (as AlienStatusIndex)
+    latest_order = "CREATED_TIMESTAMP IS NULL, CREATED_TIMESTAMP DESC, rowid"
+
+    def __init__(self, path=':memory:'):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("CREATE TEMP TABLE IF NOT EXISTS keys (pos INTEGER, key)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS temp.keys_key ON keys (key)")
+        self.columns = [row[1] for row in self.connection.execute("PRAGMA table_info(history)")]
+
+    @classmethod
+    def from_frame(cls, db: pd.DataFrame, path=':memory:', chunksize=100_000):
+        """
+        Create an engine and load a history frame into it, `chunksize` rows at a time.
+        """
+        engine = cls(path)
+        for start in range(0, len(db), chunksize):
+            engine.append(db.iloc[start:start + chunksize])
+        return engine
+
+    def __len__(self):
+        if not self.columns:
+            return 0
+        return self.connection.execute("SELECT COUNT(*) FROM history").fetchone()[0]
+
+    def append(self, rows: pd.DataFrame):
+        """
+        Add records to the history. The first call creates the table (with the columns of `rows`) and its indexes.
+        """
+        if not self.columns:
+            self.columns = list(rows.columns)
+            self.connection.execute(f"CREATE TABLE history ({', '.join(self.columns)})")
+            for name, columns in self.indexes.items():
+                if set(columns) <= set(self.columns):
+                    self.connection.execute(f"CREATE INDEX {name} ON history ({', '.join(columns)})")
+        rows = decode(rows.reindex(columns=self.columns))
+        values = {}
+        for column in self.columns:
+            if column in self.datetime_columns:
+                timestamps = pd.to_datetime(rows[column]).to_numpy(dtype='datetime64[ns]')
+                values[column] = [None if missing else value for value, missing in zip(timestamps.astype(np.int64).tolist(), np.isnat(timestamps))]
+            else:
+                values[column] = sql_values(rows[column])
+        with self.connection:
+            self.connection.executemany(
+                f"INSERT INTO history VALUES ({', '.join('?' * len(self.columns))})",
+                zip(*[values[column] for column in self.columns]),
+            )
+
+    def set_keys(self, values):
+        """
+        Load the keys of a lookup, with their position, into the temporary `keys` table.
+        """
+        self.connection.execute("DELETE FROM keys")
+        self.connection.executemany("INSERT INTO keys VALUES (?, ?)", enumerate(sql_values(values)))
+
+    def read(self, query, parameters=()) -> pd.DataFrame:
+        """
+        Run a query and get its rows as a DataFrame, with the stored timestamps converted back.
+        """
+        cursor = self.connection.execute(query, parameters)
+        columns = [description[0] for description in cursor.description]
+        frame = pd.DataFrame.from_records(cursor.fetchall(), columns=columns)
+        for column in frame.columns:
+            if column in self.datetime_columns:
+                frame[column] = to_datetimes(frame[column])
+        return frame
+
+    def status_index(self):
+        return self
+
+    def expiry_index(self):
+        return self
+
+    def latest(self, alien_ids=None) -> pd.DataFrame:
+        """
+        Get the latest record for each requested ALIEN_ID (all aliens if omitted), as `AlienStatusIndex.latest`.
+        """
+        if alien_ids is None:
+            latest = self.read(
+                "SELECT ALIEN_ID, MASTER_FORM_TYPE, CREATED_TIMESTAMP FROM ("
+                f" SELECT ALIEN_ID, MASTER_FORM_TYPE, CREATED_TIMESTAMP, ROW_NUMBER() OVER (PARTITION BY ALIEN_ID ORDER BY {self.latest_order}) AS n"
+                " FROM history) WHERE n = 1 ORDER BY ALIEN_ID"
+            )
+            return latest.set_index('ALIEN_ID')
+        self.set_keys(alien_ids)
+        latest = self.read(
+            "SELECT h.MASTER_FORM_TYPE, h.CREATED_TIMESTAMP FROM keys k LEFT JOIN history h ON h.rowid = ("
+            f" SELECT rowid FROM history WHERE ALIEN_ID = k.key ORDER BY {self.latest_order} LIMIT 1)"
+            " ORDER BY k.pos"
+        )
+        latest.index = pd.Index(alien_ids, name='ALIEN_ID')
+        return latest
+
+    def latest_form_type(self, alien_ids=None) -> pd.Series:
+        return self.latest(alien_ids)['MASTER_FORM_TYPE']
+
+    def permits(self, alien_ids) -> tuple:
+        """
+        Match each alien to its MT_13_EXIT records, as `ExpiryIndex.permits`.
+        """
+        self.set_keys(alien_ids)
+        rows = self.connection.execute(
+            "SELECT k.pos, h.VALID_UNTIL FROM keys k JOIN history h ON h.ALIEN_ID = k.key"
+            " WHERE h.MASTER_FORM_TYPE = 'MT_13_EXIT'"
+        ).fetchall()
+        return np.array([row[0] for row in rows], dtype=np.int64), to_datetimes([row[1] for row in rows])
+
+    def records(self, alien_ids) -> pd.DataFrame:
+        """
+        Get the MT_13_EXIT records of each alien with the position of the alien as 'TARGET', as `ExpiryIndex.records`.
+        """
+        self.set_keys(alien_ids)
+        columns = ', '.join(f"h.{column}" for column in ExpiryIndex.columns if column in self.columns)
+        return self.read(
+            f"SELECT k.pos AS TARGET, {columns} FROM keys k JOIN history h ON h.ALIEN_ID = k.key"
+            " WHERE h.MASTER_FORM_TYPE = 'MT_13_EXIT' ORDER BY k.pos, h.rowid"
+        )
+
+    def expiring(self, start, end, employers=None) -> pd.DataFrame:
+        """
+        Get the MT_13_EXIT records whose VALID_UNTIL is in [start, end), sorted by VALID_UNTIL, as `ExpiryIndex.expiring`.
+        """
+        query = (
+            f"SELECT {', '.join(ExpiryIndex.columns)} FROM history"
+            " WHERE VALID_UNTIL >= ? AND VALID_UNTIL < ? AND MASTER_FORM_TYPE = 'MT_13_EXIT'"
+        )
+        if employers is not None:
+            self.set_keys(np.unique(employers))
+            query += " AND EMPLOYER_NO IN (SELECT key FROM keys)"
+        bounds = [pd.Timestamp(start).value, pd.Timestamp(end).value]
+        return self.read(query + " ORDER BY VALID_UNTIL, rowid", bounds)
+
+    def exit_records(self, employers=None) -> pd.DataFrame:
+        if employers is None:
+            return self.read("SELECT * FROM history WHERE MASTER_FORM_TYPE = 'MT_13_EXIT' ORDER BY rowid")
+        self.set_keys(np.unique(employers))
+        return self.read(
+            "SELECT * FROM history WHERE EMPLOYER_NO IN (SELECT key FROM keys) AND MASTER_FORM_TYPE = 'MT_13_EXIT' ORDER BY rowid"
+        )
+
+    def case_counts(self, excluded_aliens, employers=None) -> pd.DataFrame:
+        where = "NOT EXISTS (SELECT 1 FROM keys WHERE pos < 0 AND key = h.ALIEN_ID)"
+        # Excluded aliens under negative positions, employers under positive ones
+        self.set_keys(employers if employers is not None else [])
+        self.connection.executemany("INSERT INTO keys VALUES (-1, ?)", [(value,) for value in sql_values(excluded_aliens)])
+        if employers is not None:
+            where += " AND h.EMPLOYER_NO IN (SELECT key FROM keys WHERE pos >= 0)"
+        keys = ', '.join(f"h.{column}" for column in relocation_keys)
+        return self.read(
+            f"SELECT {keys}, COUNT(h.ALIEN_ID) AS ALIEN_COUNT FROM history h WHERE {where}"
+            f" AND {' AND '.join(f'h.{column} IS NOT NULL' for column in relocation_keys)}"
+            f" GROUP BY {keys} ORDER BY {keys}"
+        )
+
+    def job_counts(self, rows: pd.DataFrame) -> pd.DataFrame:
+        self.connection.execute("CREATE TEMP TABLE IF NOT EXISTS job_rows (EMPLOYER_NO, JOB, ALIEN_ID)")
+        self.connection.execute("DELETE FROM job_rows")
+        self.connection.executemany(
+            "INSERT INTO job_rows VALUES (?, ?, ?)",
+            zip(sql_values(rows['EMPLOYER_NO']), sql_values(rows['JOB']), sql_values(rows['ALIEN_ID'])),
+        )
+        return self.read(
+            "SELECT EMPLOYER_NO, JOB, COUNT(ALIEN_ID) AS ALIEN_COUNT FROM job_rows"
+            " GROUP BY EMPLOYER_NO, JOB ORDER BY MIN(rowid)"
+        )
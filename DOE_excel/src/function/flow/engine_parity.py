@@ -0,0 +1,56 @@
+import numpy as np
+import pandas as pd
+
+from .flow1 import flow_1
+from .flow2 import flow_2
+from .flow4 import flow_4
+from .relocation import TransitionMatrix
+
+
+def comparable(value):
+    """
+    Get a result in a form that does not depend on the engine: frames as sorted text records, arrays as sorted lists.
+    """
+    if isinstance(value, tuple):
+        # Matched pairs of `permits`, in any order
+        return sorted(zip(*[np.asarray(v).astype(str).tolist() for v in value]))
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        frame = value.reset_index() if isinstance(value, pd.Series) or value.index.name else value
+        return sorted(map(str, frame.astype(object).where(frame.notna(), None).to_dict('records')))
+    if isinstance(value, dict):
+        rows = value.get('data')
+        rows = rows.to_records() if hasattr(rows, 'to_records') else rows
+        return {key: str(v) for key, v in value.items() if key != 'data'}, sorted(map(str, rows or []))
+    return value
+
+
+def engine_cases(data, db, engine, config):
+    """
+    Get the history lookups and the flows to run on an engine, to compare its results with the ones of another engine.
+
+    Parameters:
+    - data (pd.DataFrame): Current data.
+    - db (pd.DataFrame): Historical data, only given to the flows on a `PandasEngine`.
+    - engine (PandasEngine or SQLiteEngine): Engine of the history lookups (see flow/engine.py).
+    - config (dict): Config case of each flow, keyed by "flow1", "flow2" and "flow4" (as `run_flows`).
+
+    Returns:
+    - list of tuple: (name, function) pairs, compare the results of each function through `comparable`.
+    """
+    is_case = data['MASTER_FORM_TYPE'] == 'MT_59'
+    aliens = data.loc[is_case, 'ALIEN_ID']
+    employers = data['EMPLOYER_NO'].unique()
+    pairs = TransitionMatrix(data, db).to_frame()
+    pair = pairs.groupby(['EMPLOYER_NO_A', 'EMPLOYER_NO_B'], observed=True)['ALIEN_COUNT'].sum().idxmax() if len(pairs) else (None, None)
+    jobs = pd.DataFrame({'EMPLOYER_NO': data.loc[is_case, 'EMPLOYER_NO'], 'JOB': data.loc[is_case, 'JOB_DESCRIPTION'], 'ALIEN_ID': aliens})
+    history = db if engine.name == 'pandas' else None
+    return [
+        ('latest', lambda: engine.status_index().latest(aliens)),
+        ('permits', lambda: engine.expiry_index().permits(aliens)),
+        ('exit_records', lambda: engine.exit_records([pair[0]])),
+        ('case_counts', lambda: engine.case_counts(aliens[:100], employers=employers)),
+        ('job_counts', lambda: engine.job_counts(jobs)),
+        ('flow_1', lambda: flow_1(data, history, config['flow1'], engine=engine)),
+        ('flow_2', lambda: flow_2(data, history, config['flow2'], *pair, engine=engine)),
+        ('flow_4', lambda: flow_4(data, history, config['flow4'], engine=engine)),
+    ]
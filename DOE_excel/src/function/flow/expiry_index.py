@@ -0,0 +1,162 @@
+import numpy as np
+import pandas as pd
+
+from .lookup import key_values, match_positions, sorted_lookup
+
+
+class ExpiryIndex:
+    """
+    Calendar of the work permit expiry dates (VALID_UNTIL) of the exit records, keyed by alien and employer.
+
+    The records are kept sorted by VALID_UNTIL, by ALIEN_ID and by (EMPLOYER_NO, VALID_UNTIL), so
+    the permits of a set of aliens and the permits expiring in a date range (of everyone or of some
+    employers) are found with binary searches, in time proportional to log(n) plus the number of
+    results. New records are added as small sorted segments and folded into the base when they
+    grow beyond `compact_ratio` of it, like `HistoryStore`.
+
+    Parameters:
+    - db (pd.DataFrame): Historical data with 'ALIEN_ID', 'EMPLOYER_NO' and 'VALID_UNTIL' columns.
+    - form_types (tuple of str, optional): MASTER_FORM_TYPE of the indexed records, every record if None.
+    - compact_ratio (float): Size of the pending segments, relative to the base, that triggers a compaction.
+
+    Example:
+        index = ExpiryIndex(db)
+        index.expiring_within(30, today="2024-07-01")
+        index.expiring("2024-07-01", "2024-08-01", employers=["10000001"])
+        index.records(data["ALIEN_ID"])
+        index.append(new_exits)
+    """
+
+    columns = ['ALIEN_ID', 'EMPLOYER_NO', 'FORM_ID', 'CREATED_TIMESTAMP', 'VALID_UNTIL']
+
+    def __init__(self, db: pd.DataFrame, form_types=('MT_13_EXIT',), compact_ratio=0.25):
+        self.form_types = form_types
+        self.compact_ratio = compact_ratio
+        self.base = self.build_run(self.select(db))
+        self.segments = []
+
+    def select(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Get the indexed columns of the records of `form_types`.
+        """
+        if self.form_types is not None:
+            df = df[df['MASTER_FORM_TYPE'].isin(self.form_types)]
+        return df[[c for c in self.columns if c in df.columns]].reset_index(drop=True)
+
+    @staticmethod
+    def build_run(rows: pd.DataFrame) -> dict:
+        """
+        Sort one frame of records for the lookups. Records without VALID_UNTIL are only found by alien.
+        """
+        valid_until = pd.to_datetime(rows['VALID_UNTIL']).to_numpy(dtype='datetime64[ns]')
+        dated = np.flatnonzero(~np.isnat(valid_until))
+        by_date = dated[np.argsort(valid_until[dated], kind='mergesort')]
+        employers = key_values(rows['EMPLOYER_NO'])
+        # Employer blocks, each sorted by date, searched on one integer key: block * (number of dates + 1) + date rank
+        by_employer = dated[np.lexsort((valid_until[dated], employers[dated]))]
+        block_employers, block = np.unique(employers[by_employer], return_inverse=True)
+        dates = np.unique(valid_until[dated])
+        block_keys = block.astype(np.int64) * (len(dates) + 1) + np.searchsorted(dates, valid_until[by_employer])
+        return {
+            'rows': rows,
+            'valid_until': valid_until,
+            'by_date': (valid_until[by_date], by_date),
+            'by_alien': sorted_lookup(key_values(rows['ALIEN_ID'])),
+            'by_employer': (block_employers, dates, block_keys, by_employer),
+        }
+
+    def runs(self) -> list:
+        return [self.base] + self.segments
+
+    def __len__(self):
+        return sum(len(run['rows']) for run in self.runs())
+
+    def append(self, rows: pd.DataFrame):
+        """
+        Index new records (e.g. the exit reports of a new batch), compacting the pending segments if needed.
+        """
+        rows = self.select(rows)
+        if rows.empty:
+            return
+        self.segments.append(self.build_run(rows))
+        if sum(len(run['rows']) for run in self.segments) > self.compact_ratio * max(len(self.base['rows']), 1):
+            self.compact()
+
+    def compact(self):
+        """
+        Fold the pending segments into the base.
+        """
+        if not self.segments:
+            return
+        self.base = self.build_run(pd.concat([run['rows'] for run in self.runs()], ignore_index=True))
+        self.segments = []
+
+    def permits(self, alien_ids) -> tuple:
+        """
+        Match each alien to its indexed records, like an inner merge on ALIEN_ID.
+
+        Parameters:
+        - alien_ids (list-like): ALIEN_IDs to look up, duplicates are matched for each occurrence.
+
+        Returns:
+        - tuple: (target (np.ndarray) position in `alien_ids` of each match, valid_until (np.ndarray) VALID_UNTIL of the matched record).
+        """
+        targets = key_values(alien_ids)
+        matches = [match_positions(run['by_alien'], targets) for run in self.runs()]
+        valid_until = [run['valid_until'][rows] for run, (_, rows) in zip(self.runs(), matches)]
+        return np.concatenate([target for target, _ in matches]), np.concatenate(valid_until)
+
+    def records(self, alien_ids) -> pd.DataFrame:
+        """
+        Get the indexed records of each alien, like an inner merge on ALIEN_ID (see `permits`).
+
+        Returns:
+        - pd.DataFrame: Matched records with the indexed columns (VALID_UNTIL parsed), and the position in `alien_ids` of each match as 'TARGET'.
+        """
+        targets = key_values(alien_ids)
+        found = []
+        for run in self.runs():
+            target, rows = match_positions(run['by_alien'], targets)
+            frame = run['rows'].take(rows).assign(VALID_UNTIL=run['valid_until'][rows])
+            frame.insert(0, 'TARGET', target)
+            found.append(frame)
+        return pd.concat(found, ignore_index=True)
+
+    def expiring(self, start, end, employers=None) -> pd.DataFrame:
+        """
+        Get the records whose VALID_UNTIL is in [start, end), sorted by VALID_UNTIL.
+
+        Parameters:
+        - start (str or pd.Timestamp): First expiry date of the range.
+        - end (str or pd.Timestamp): End of the range (excluded).
+        - employers (list-like, optional): Only the records of these EMPLOYER_NOs.
+
+        Returns:
+        - pd.DataFrame: Matching records with the indexed columns.
+        """
+        start, end = np.datetime64(pd.Timestamp(start), 'ns'), np.datetime64(pd.Timestamp(end), 'ns')
+        found = []
+        for run in self.runs():
+            if employers is None:
+                dates, order = run['by_date']
+                positions = order[np.searchsorted(dates, start):np.searchsorted(dates, end)]
+            else:
+                block_employers, dates, block_keys, order = run['by_employer']
+                targets = np.unique(key_values(employers))
+                block = np.minimum(np.searchsorted(block_employers, targets), max(len(block_employers) - 1, 0))
+                block = block[block_employers[block] == targets] if len(block_employers) else block[:0]
+                # [start, end) of every employer block with a single search, [0] the first and [1] the end positions
+                bounds = np.searchsorted(block_keys, block * (len(dates) + 1) + np.searchsorted(dates, [[start], [end]]))
+                lengths = bounds[1] - bounds[0]
+                offsets = np.cumsum(lengths) - lengths
+                positions = order[np.repeat(bounds[0] - offsets, lengths) + np.arange(lengths.sum())]
+            found.append(run['rows'].take(positions))
+        result = pd.concat(found, ignore_index=True)
+        return result.sort_values('VALID_UNTIL', kind='mergesort', ignore_index=True)
+
+    def expiring_within(self, days, today=None, employers=None) -> pd.DataFrame:
+        """
+        Get the records whose permit expires in the next `days` days, from `today` (the current date if omitted).
+        """
+        today = pd.Timestamp.today().normalize() if today is None else pd.Timestamp(today)
+        return self.expiring(today, today + pd.Timedelta(days=days), employers)
@@ -1,8 +1,19 @@
-import sys
-import os
-from .module import *
+import numpy as np
 
-def flow_1(data, db, config_case):
+from .cases import CaseBatch, case_table
+from .instrumentation import instrumented
+from .module import check_job_limits, flow_rows
+from .plan import ExecutionPlan
+
+messages = {
+    "normal": "Aliens have reported their departure from the old company, and the employer hires not more than 10 aliens for different types of work and positions.",
+    "abnormal_inform_exit": "Some aliens have not yet reported their departure from the old company.",
+    "abnormal_job_limits": "Aliens have reported their departure from the old company. However, the employer hires more than 10 aliens for different types of work and positions.",
+}
+
+
+@instrumented
+def flow_1(data, db, config_case, status_index=None, plan=None, engine=None, case_key=None):
     """
     Flow 1: Check if aliens have reported their departure and if the employer hires within the job limits.
 
@@ -12,6 +23,12 @@ def flow_1(data, db, config_case):
     - config_case (list of dict): Configuration specifying job limits, where each dict has:
         - "job" (str): Job title.
         - "number" (int): Maximum allowed number for this job.
+    - status_index (AlienStatusIndex, optional): Latest-status index built once from `db`, shared between calls on the same history.
+    - plan (ExecutionPlan, optional): Shared intermediates of `data` and `db` (see flow/plan.py), shared between flows run on the same batch.
+    - engine (PandasEngine or SQLiteEngine, optional): Engine of the history lookups (see flow/engine.py), ignored with `plan`.
+      With a `SQLiteEngine`, or a `plan` on a `PartitionedHistory` (see `ExecutionPlan`), `db` may be None.
+    - case_key (str, optional): Case key column (e.g. a test case or application batch id) of `data` and `db`: every case is
+      checked at once by `flow_1_cases`, with `config_case` as a lookup table of the limits of each case.
     
     Example of `config_case`:
     config_case = [
@@ -27,16 +44,17 @@ def flow_1(data, db, config_case):
         - "message" (str): Description of the check results.
         - "count_abnormal" (int): Number of abnormalities found.
         - "job_abnormal" (list of dict, optional): Details of job limit violations.
-        - "data" (list of dict): Data of aliens relevant to the check.
+        - "data" (ResultRows): Data of aliens relevant to the check (columnar, `to_records()` gives the list of dict).
     """
-    messages = {
-        "normal": "Aliens have reported their departure from the old company, and the employer hires not more than 10 aliens for different types of work and positions.",
-        "abnormal_inform_exit": "Some aliens have not yet reported their departure from the old company.",
-        "abnormal_job_limits": "Aliens have reported their departure from the old company. However, the employer hires more than 10 aliens for different types of work and positions.",
-    }
     
+    if case_key is not None:
+        return flow_1_cases(data, db, config_case, case_key)
+
+    if plan is None:
+        plan = ExecutionPlan(data, db, status_index, engine=engine)
+
     # Check if aliens have reported their departure
-    result_check_inform_exit = check_inform_exit(data, db)
+    result_check_inform_exit = plan.get('inform_exit')
     
     # Initialize result dictionary
     result = {
@@ -48,8 +66,8 @@ def flow_1(data, db, config_case):
     }
     
     if result_check_inform_exit["result"] == "normal":
-        alien_ids_to_drop = result_check_inform_exit["data"]['ALIEN_ID'].unique()
-        result_check_job_limits = check_job_limits(data[~data['ALIEN_ID'].isin(alien_ids_to_drop)], config_case)
+        data_case = plan.get('data_case')
+        result_check_job_limits = check_job_limits(data_case, config_case, engine=plan.get('engine'))
         
         if result_check_job_limits["result"] == "normal":
             result.update({
@@ -58,12 +76,8 @@ def flow_1(data, db, config_case):
                 "count_abnormal": result_check_job_limits["count_abnormal"],
                 'job_abnormal': result_check_job_limits["job_abnormal"]
             })
-            # Combine data from both checks into a DataFrame
-            result_check_job_limits["data"]["case_code"] =  result_check_job_limits["data"]['status'].apply(lambda x: 'pass' if x == 'normal' else "R1/2")
-            result_check_inform_exit["data"]["case_code"] = "R1/1"
-            combined_data = pd.concat([result_check_inform_exit["data"], result_check_job_limits["data"]])
-            combined_data = combined_data.reset_index(drop=True)
-            result['data'] = combined_data.to_dict(orient='records')  # Convert DataFrame to dict
+            # Rows of both checks, materialized once (columnar, see flow/result.py)
+            result['data'] = flow_rows([(data, result_check_inform_exit, "R1/1"), (data_case, result_check_job_limits, "R1/2")])
         else:
             result.update({
                 "status": "abnormal",
@@ -71,13 +85,8 @@ def flow_1(data, db, config_case):
                 "count_abnormal": result_check_job_limits["count_abnormal"],
                 'job_abnormal': result_check_job_limits["job_abnormal"]
             })
-            # Correct status in data from inform exit check
-            result_check_job_limits["data"]['status'] = 'abnormal'
-            result_check_job_limits["data"]["case_code"] =  result_check_job_limits["data"]['status'].apply(lambda x: 'pass' if x == 'normal' else "R1/2")
-            result_check_inform_exit["data"]["case_code"] = "R1/1"
-
-            combined_data = pd.concat([result_check_inform_exit["data"], result_check_job_limits["data"]], ignore_index=True)
-            result['data'] = combined_data.to_dict(orient="records")
+            # Every row of the job limits check is reported as abnormal
+            result['data'] = flow_rows([(data, result_check_inform_exit, "R1/1"), (data_case, result_check_job_limits, "R1/2", "abnormal")])
     
     else:
         result.update({
@@ -86,7 +95,50 @@ def flow_1(data, db, config_case):
             "count_abnormal": result_check_inform_exit['count_abnormal'],
             'job_abnormal': None
         })
-        result_check_inform_exit["data"]["case_code"] = "R1/1"
-        result['data'] = result_check_inform_exit["data"].to_dict(orient='records')  # Convert DataFrame to dict
+        result['data'] = flow_rows([(data, result_check_inform_exit, "R1/1")])
     
-    return result
\ No newline at end of file
+    return result
+
+@instrumented
+def flow_1_cases(data, db, config_case, case_key):
+    """
+    Flow 1 on many cases at once (see `CaseBatch`), each case as if its rows were given to `flow_1` on their own.
+
+    Parameters:
+    - data (pd.DataFrame): Current data with the `case_key` column.
+    - db (pd.DataFrame): Historical data with the `case_key` column.
+    - config_case (pd.DataFrame): Job limits of each case, 'job' and 'number' per `case_key` value. Without a `case_key`
+      column, the limits apply to every case of `data` (see `case_table`).
+    - case_key (str): Case key column.
+
+    Returns:
+    - dict: 'cases' (pd.DataFrame with the `case_key`, 'status', 'message', 'count_abnormal' and 'job_abnormal' of each case)
+      and 'data' (ResultRows of all the cases, case after case, with their `case_key`).
+    """
+    config_case = case_table(config_case, case_key, data)
+    batch = CaseBatch(data, db, case_key, config_case[case_key].unique())
+
+    result_check_inform_exit = batch.inform_exit()
+    inform_normal = result_check_inform_exit['normal']
+
+    # Aliens who have not reported their departure are left out of the job limits check of their case
+    data_case = batch.without_aliens(batch.per_case(inform_normal), result_check_inform_exit['rows'])
+    result_check_job_limits = batch.job_limits(data_case, config_case)
+    job_normal = result_check_job_limits['normal']
+    outcome = np.where(inform_normal, np.where(job_normal, "normal", "abnormal_job_limits"), "abnormal_inform_exit")
+
+    # Every row of the job limits check is reported as abnormal in the cases over the limits
+    job_rows = result_check_job_limits['rows']
+    job_status = result_check_job_limits['abnormal'] | batch.per_case(~job_normal)[job_rows]
+    rows = batch.result_rows([
+        (result_check_inform_exit['rows'], True, True, 'inform_exit', "R1/1"),
+        (job_rows, result_check_job_limits['abnormal'], job_status, 'job_limits', "R1/2"),
+    ])
+
+    cases = batch.result_frame({
+        'status': np.where(outcome == "normal", "normal", "abnormal"),
+        'message': [messages[key] for key in outcome],
+        'count_abnormal': np.where(inform_normal, result_check_job_limits['count_abnormal'], result_check_inform_exit['count_abnormal']),
+        'job_abnormal': [jobs if normal else None for jobs, normal in zip(result_check_job_limits['job_abnormal'], inform_normal)],
+    })
+    return {'cases': cases, 'data': rows}
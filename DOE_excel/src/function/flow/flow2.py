@@ -1,10 +1,22 @@
-import sys
-import os
-from .module import *
+import numpy as np
 
-from flow.module import *
+from .cases import CaseBatch, case_table
+from .instrumentation import instrumented
+from .module import check_relocate_condition_from_A_to_B, flow_rows
+from .plan import ExecutionPlan
 
-def flow_2(data, db, config_case, EMPLOYER_NO_A, EMPLOYER_NO_B):
+# Define messages
+messages = {
+    "normal": "Aliens moved from A to B not exceeding the limit of people and have been relocated for less than a specified number of days.",
+    "abnormal_relocate": "Aliens moved from A to B exceeding the limit of people and have been relocated for more than a specified number of days.",
+    "abnormal_resign_B": "Aliens has moved out of the company but has not yet reported.",
+    "abnormal_resign_A": "Aliens has not yet reported their departure from the old company but has already applied for the new one.",
+    "abnormal_expire": "The application submission date and the expiration date of the work permit is less than or equal to 30 days."
+}
+
+
+@instrumented
+def flow_2(data, db, config_case, EMPLOYER_NO_A=None, EMPLOYER_NO_B=None, status_index=None, plan=None, engine=None, case_key=None):
     """
     Flow 2: Validate the movement of aliens from employer A to employer B based on various conditions.
 
@@ -21,6 +33,12 @@ def flow_2(data, db, config_case, EMPLOYER_NO_A, EMPLOYER_NO_B):
             }
     - EMPLOYER_NO_A (str): Employer number for location A.
     - EMPLOYER_NO_B (str): Employer number for location B.
+    - status_index (AlienStatusIndex, optional): Latest-status index built once from `db`, shared between calls on the same history.
+    - plan (ExecutionPlan, optional): Shared intermediates of `data` and `db` (see flow/plan.py), shared between flows run on the same batch.
+    - engine (PandasEngine or SQLiteEngine, optional): Engine of the history lookups (see flow/engine.py), ignored with `plan`.
+      With a `SQLiteEngine`, or a `plan` on a `PartitionedHistory` (see `ExecutionPlan`), `db` may be None.
+    - case_key (str, optional): Case key column (e.g. a test case or application batch id) of `data` and `db`: every case is
+      checked at once by `flow_2_cases`, with `config_case` as a lookup table of the limits and employers of each case.
 
     Returns:
     - dict: A dictionary with the following keys:
@@ -28,19 +46,16 @@ def flow_2(data, db, config_case, EMPLOYER_NO_A, EMPLOYER_NO_B):
         - 'message' (str): Descriptive message about the check result.
         - 'count_abnormal' (int): Count of abnormal records.
         - 'total_relocate_day' (int): Total days aliens have been relocated.
-        - 'data' (list of dict): Relevant data records.
+        - 'data' (ResultRows): Relevant data records (columnar, `to_records()` gives the list of dict).
     """
-    # Define messages
-    messages = {
-        "normal": "Aliens moved from A to B not exceeding the limit of people and have been relocated for less than a specified number of days.",
-        "abnormal_relocate": "Aliens moved from A to B exceeding the limit of people and have been relocated for more than a specified number of days.",
-        "abnormal_resign_B": "Aliens has moved out of the company but has not yet reported.",
-        "abnormal_resign_A": "Aliens has not yet reported their departure from the old company but has already applied for the new one.",
-        "abnormal_expire": "The application submission date and the expiration date of the work permit is less than or equal to 30 days."
-    }
+    if case_key is not None:
+        return flow_2_cases(data, db, config_case, case_key)
+
+    if plan is None:
+        plan = ExecutionPlan(data, db, status_index, engine=engine)
 
     # Check conditions in sequence
-    result_check_inform_exit = check_inform_exit(data, db)
+    result_check_inform_exit = plan.get('inform_exit')
     
     # Initialize result dictionary
     result = {
@@ -53,16 +68,16 @@ def flow_2(data, db, config_case, EMPLOYER_NO_A, EMPLOYER_NO_B):
     
     if result_check_inform_exit["result"] == "normal": 
         
-        alien_ids_to_drop = result_check_inform_exit["data"]['ALIEN_ID'].unique()
-        data_case = data[~data['ALIEN_ID'].isin(alien_ids_to_drop)]
-        db_case = db[~db['ALIEN_ID'].isin(alien_ids_to_drop)]
+        data_case = plan.get('data_case')
         
-        result_check_expire_condition = check_expire_condition(data_case, db_case) 
+        result_check_expire_condition = plan.get('expire')
         
         if result_check_expire_condition["result"] == "normal":
-            alien_ids_to_drop_2 = result_check_expire_condition["data"]['ALIEN_ID'].unique()
+            alien_ids_to_drop_2 = data_case['ALIEN_ID'].take(result_check_expire_condition["rows"]).unique()
             data_case_2 = data_case[~data_case['ALIEN_ID'].isin(alien_ids_to_drop_2)]
-            db_case_2 = db_case[~db_case['ALIEN_ID'].isin(alien_ids_to_drop_2)]
+            # Only the exits from employer A are relocations from A to B
+            exits_a = plan.get('engine').exit_records([EMPLOYER_NO_A])
+            db_case_2 = exits_a[~exits_a['ALIEN_ID'].isin(np.concatenate([plan.get('dropped_aliens'), alien_ids_to_drop_2]))]
             
             result_check_relocate_condition_from_A_to_B = check_relocate_condition_from_A_to_B(data_case_2,
                                                                                                     db_case_2, 
@@ -77,9 +92,8 @@ def flow_2(data, db, config_case, EMPLOYER_NO_A, EMPLOYER_NO_B):
                     "count_abnormal": result_check_relocate_condition_from_A_to_B['count_abnormal'],
                     "total_relocate_day": result_check_relocate_condition_from_A_to_B['total_relocate_day']
                 })
-                combined_data = pd.concat([result_check_inform_exit["data"], result_check_expire_condition["data"], result_check_relocate_condition_from_A_to_B["data"]], ignore_index=True)
-                combined_data["case_code"] = combined_data['status'].apply(lambda x: 'pass' if x == 'normal' else "R2/3")
-                result['data'] = combined_data.to_dict(orient="records")
+                result['data'] = flow_rows([(data, result_check_inform_exit, "R2/3"), (data_case, result_check_expire_condition, "R2/3"),
+                                            (data_case_2, result_check_relocate_condition_from_A_to_B, "R2/3")])
             else:
                 result.update({
                     "status": "abnormal", 
@@ -87,11 +101,8 @@ def flow_2(data, db, config_case, EMPLOYER_NO_A, EMPLOYER_NO_B):
                     "count_abnormal": result_check_relocate_condition_from_A_to_B['count_abnormal'],
                     "total_relocate_day": result_check_relocate_condition_from_A_to_B['total_relocate_day']
                 })
-                result_check_relocate_condition_from_A_to_B["data"]["case_code"] = "R2/3"
-                result_check_expire_condition["data"]["case_code"] = "R2/2"
-                result_check_inform_exit["data"]["case_code"] = "R1/2"
-                combined_data = pd.concat([result_check_inform_exit["data"], result_check_expire_condition["data"], result_check_relocate_condition_from_A_to_B["data"]], ignore_index=True)
-                result['data'] = combined_data.to_dict(orient="records")
+                result['data'] = flow_rows([(data, result_check_inform_exit, "R1/2"), (data_case, result_check_expire_condition, "R2/2"),
+                                            (data_case_2, result_check_relocate_condition_from_A_to_B, "R2/3")])
         else:
             result.update({
                 "status": "abnormal", 
@@ -99,10 +110,7 @@ def flow_2(data, db, config_case, EMPLOYER_NO_A, EMPLOYER_NO_B):
                 "count_abnormal": result_check_expire_condition['count_abnormal'],
                 "total_relocate_day": None
             })
-            result_check_expire_condition["data"]["case_code"] = "R2/2"
-            result_check_inform_exit["data"]["case_code"] = "R1/2"
-            combined_data = pd.concat([result_check_inform_exit["data"], result_check_expire_condition["data"]], ignore_index=True)
-            result['data'] = combined_data.to_dict(orient="records")
+            result['data'] = flow_rows([(data, result_check_inform_exit, "R1/2"), (data_case, result_check_expire_condition, "R2/2")])
     else:
         result.update({
             "status": "abnormal",
@@ -110,7 +118,66 @@ def flow_2(data, db, config_case, EMPLOYER_NO_A, EMPLOYER_NO_B):
             "count_abnormal": result_check_inform_exit['count_abnormal'],
             "total_relocate_day": None
         })
-        result_check_inform_exit["data"]["case_code"] = "R2/1"
-        result['data'] = result_check_inform_exit["data"].to_dict(orient="records")
+        result['data'] = flow_rows([(data, result_check_inform_exit, "R2/1")])
     
     return result
+
+
+@instrumented
+def flow_2_cases(data, db, config_case, case_key):
+    """
+    Flow 2 on many cases at once (see `CaseBatch`), each case as if its rows were given to `flow_2` on their own.
+
+    Parameters:
+    - data (pd.DataFrame): Current data with the `case_key` column.
+    - db (pd.DataFrame): Historical data with the `case_key` column.
+    - config_case (pd.DataFrame): 'number', 'day', 'EMPLOYER_NO_A' and 'EMPLOYER_NO_B' per `case_key` value.
+      Without a `case_key` column, the first entry applies to every case of `data` (see `case_table`).
+    - case_key (str): Case key column.
+
+    Returns:
+    - dict: 'cases' (pd.DataFrame with the `case_key`, 'status', 'message', 'count_abnormal' and 'total_relocate_day' of each case)
+      and 'data' (ResultRows of all the cases, case after case, with their `case_key`).
+    """
+    config_case = case_table(config_case, case_key, data).drop_duplicates(case_key)
+    batch = CaseBatch(data, db, case_key, config_case[case_key])
+    limits = config_case[['number', 'day']].reset_index(drop=True)
+
+    result_check_inform_exit = batch.inform_exit()
+    inform_normal = result_check_inform_exit['normal']
+    data_case = batch.without_aliens(batch.per_case(inform_normal), result_check_inform_exit['rows'])
+
+    result_check_expire_condition = batch.expire(data_case)
+    expire_normal = inform_normal & result_check_expire_condition['normal']
+
+    # Relocations from A to B of the cases past the expire check, without the aliens of both checks
+    excluded = np.concatenate([batch.data_alien[result_check_inform_exit['rows']], result_check_expire_condition['aliens']])
+    data_case_2 = data_case & batch.per_case(expire_normal) & ~np.isin(batch.data_alien, excluded)
+    employer_a = config_case['EMPLOYER_NO_A'].to_numpy(dtype=object)
+    employer_b = config_case['EMPLOYER_NO_B'].to_numpy(dtype=object)
+    exits = (expire_normal[batch.db_case] & (batch.db['MASTER_FORM_TYPE'] == 'MT_13_EXIT').to_numpy()
+             & (batch.db['EMPLOYER_NO'].to_numpy(dtype=object) == employer_a[batch.db_case]) & ~np.isin(batch.db_alien, excluded))
+    applications = data_case_2 & batch.is_application & (batch.data['EMPLOYER_NO'].to_numpy(dtype=object) == batch.per_case(employer_b))
+    window = batch.worst_windows(batch.relocation_counts(exits, applications), limits)
+    relocate_normal = window['ALIEN_COUNT'].isna().to_numpy()
+
+    outcome = np.select([~inform_normal, ~expire_normal, ~relocate_normal], ["abnormal_resign_A", "abnormal_expire", "abnormal_relocate"], "normal")
+    inform_code = np.select([~inform_normal, outcome == "normal"], ["R2/1", "R2/3"], "R1/2")
+    relocate_abnormal = batch.per_case(~relocate_normal)[data_case_2]
+    rows = batch.result_rows([
+        (result_check_inform_exit['rows'], True, True, 'inform_exit', batch.per_case(inform_code)[result_check_inform_exit['rows']]),
+        (result_check_expire_condition['rows'], True, True, 'expire',
+         batch.per_case(np.where(outcome == "normal", "R2/3", "R2/2"))[result_check_expire_condition['rows']]),
+        (np.flatnonzero(data_case_2), relocate_abnormal, relocate_abnormal, 'relocate', "R2/3"),
+    ])
+
+    count_abnormal = np.select([~inform_normal, ~expire_normal], [result_check_inform_exit['count_abnormal'], result_check_expire_condition['count_abnormal']],
+                               window['ALIEN_COUNT'].fillna(0).to_numpy(dtype=np.int64))
+    cases = batch.result_frame({
+        'status': np.where(outcome == "normal", "normal", "abnormal"),
+        'message': [messages[key] for key in outcome],
+        'count_abnormal': count_abnormal,
+        'total_relocate_day': [None if not checked else ("pass" if normal else int(days))
+                               for checked, normal, days in zip(expire_normal, relocate_normal, window['TOTAL_DAYS'])],
+    })
+    return {'cases': cases, 'data': rows}
@@ -1,9 +1,20 @@
-import sys
-import os
-from .module import *
+import numpy as np
+import pandas as pd
 
+from .cases import CaseBatch, case_table
+from .instrumentation import instrumented
+from .module import check_relocate_condition_from_B, flow_rows
+from .plan import ExecutionPlan
 
-def flow_4(data, db, config_case):
+messages = {
+    "normal": "Aliens moved to B not exceeding the limit of people and have been relocated for less than a specified number of days.",
+    "abnormal_relocate_B": "Aliens moved to B exceeding the limit of people and have been relocated for more than a specified number of days.",
+    "check_inform_exit": "Aliens have not yet reported their departure from the old company but have already applied for the new one."
+}
+
+
+@instrumented
+def flow_4(data, db, config_case, status_index=None, plan=None, engine=None, case_key=None):
     """
     Flow 4: Evaluate relocation conditions and departure reporting status of aliens.
 
@@ -18,6 +29,12 @@ def flow_4(data, db, config_case):
             "number": 50,
             "day": 20
         }
+    - status_index (AlienStatusIndex, optional): Latest-status index built once from `db`, shared between calls on the same history.
+    - plan (ExecutionPlan, optional): Shared intermediates of `data` and `db` (see flow/plan.py), shared between flows run on the same batch.
+    - engine (PandasEngine or SQLiteEngine, optional): Engine of the history lookups (see flow/engine.py), ignored with `plan`.
+      With a `SQLiteEngine`, or a `plan` on a `PartitionedHistory` (see `ExecutionPlan`), `db` may be None.
+    - case_key (str, optional): Case key column (e.g. a test case or application batch id) of `data` and `db`: every case is
+      checked at once by `flow_4_cases`, with `config_case` as a lookup table of the limits of each case.
 
     Returns:
     - dict: A dictionary with the following keys:
@@ -25,16 +42,17 @@ def flow_4(data, db, config_case):
         - 'message' (str): Description of the status.
         - 'count_abnormal' (int): Count of abnormalities found.
         - 'total_relocate_day' (int): Total days of relocation.
-        - 'data' (list of dict): Relevant data for further inspection.
+        - 'data' (ResultRows): Relevant data for further inspection (columnar, `to_records()` gives the list of dict).
     """
-    messages = {
-        "normal": "Aliens moved to B not exceeding the limit of people and have been relocated for less than a specified number of days.",
-        "abnormal_relocate_B": "Aliens moved to B exceeding the limit of people and have been relocated for more than a specified number of days.",
-        "check_inform_exit": "Aliens have not yet reported their departure from the old company but have already applied for the new one."
-    }
     
+    if case_key is not None:
+        return flow_4_cases(data, db, config_case, case_key)
+
+    if plan is None:
+        plan = ExecutionPlan(data, db, status_index, engine=engine)
+
     # Check if aliens have reported their departure
-    result_check_inform_exit = check_inform_exit(data, db)
+    result_check_inform_exit = plan.get('inform_exit')
     
     # Initialize result dictionary
     result = {
@@ -46,16 +64,16 @@ def flow_4(data, db, config_case):
     }
     
     if result_check_inform_exit["result"] == "normal":
-        alien_ids_to_drop = result_check_inform_exit["data"]['ALIEN_ID'].unique()
-        data_case = data[~data['ALIEN_ID'].isin(alien_ids_to_drop)]
-        db_case = db[~db['ALIEN_ID'].isin(alien_ids_to_drop)]
+        data_case = plan.get('data_case')
         
         # Create concat_df
-        data_case_agg = data_case.groupby(['CREATED_TIMESTAMP', 'EMPLOYER_NO', 'FORM_ID']).agg(ALIEN_COUNT=('ALIEN_ID', 'count')).reset_index()
-        db_case_agg = db_case.groupby(['CREATED_TIMESTAMP', 'EMPLOYER_NO', 'FORM_ID']).agg(ALIEN_COUNT=('ALIEN_ID', 'count')).reset_index()
+        data_case_agg = plan.get('data_case_counts')
+        db_case_agg = plan.get('db_case_counts')
         concat_df = pd.concat([db_case_agg, data_case_agg], axis=0).reset_index(drop=True)
         
-        result_check_relocate_condition_from_B = check_relocate_condition_from_B(data_case, concat_df, config_case["number"], config_case["day"])
+        # Relocation windows are evaluated per employer, only the employers of the applications are reported
+        result_check_relocate_condition_from_B = check_relocate_condition_from_B(data_case, concat_df, config_case["number"], config_case["day"],
+                                                                                 by=['EMPLOYER_NO'], groups=data_case['EMPLOYER_NO'].unique())
         
         if result_check_relocate_condition_from_B["result"] == "normal":
             result.update({
@@ -64,9 +82,7 @@ def flow_4(data, db, config_case):
                 "count_abnormal": result_check_relocate_condition_from_B['count_abnormal'],
                 "total_relocate_day": result_check_relocate_condition_from_B['total_relocate_day']
             })
-            combined_data = pd.concat([result_check_inform_exit["data"], result_check_relocate_condition_from_B["data"]], ignore_index=True)
-            combined_data["case_code"] = combined_data['status'].apply(lambda x: 'pass' if x == 'normal' else "R4/2")
-            result['data'] = combined_data.to_dict(orient='records')
+            result['data'] = flow_rows([(data, result_check_inform_exit, "R4/2"), (data_case, result_check_relocate_condition_from_B, "R4/2")])
         else:
             result.update({
                 "status": "abnormal", 
@@ -74,10 +90,7 @@ def flow_4(data, db, config_case):
                 "count_abnormal": result_check_relocate_condition_from_B['count_abnormal'],
                 "total_relocate_day": result_check_relocate_condition_from_B['total_relocate_day']
             })
-            result_check_relocate_condition_from_B["data"]["case_code"] = "R4/2"
-            result_check_inform_exit["data"]["case_code"] = "R4/1"
-            combined_data = pd.concat([result_check_inform_exit["data"], result_check_relocate_condition_from_B["data"]], ignore_index=True)
-            result['data'] = combined_data.to_dict(orient='records')
+            result['data'] = flow_rows([(data, result_check_inform_exit, "R4/1"), (data_case, result_check_relocate_condition_from_B, "R4/2")])
     
     else:
         result.update({
@@ -86,10 +99,61 @@ def flow_4(data, db, config_case):
             "count_abnormal": result_check_inform_exit['count_abnormal'],
             "total_relocate_day" : None
         })
-        result_check_inform_exit["data"]["case_code"] = "R4/1"
-        result['data'] = result_check_inform_exit['data'].to_dict(orient='records')
+        result['data'] = flow_rows([(data, result_check_inform_exit, "R4/1")])
     
     return result
 
 
-   
\ No newline at end of file
+   
+
+@instrumented
+def flow_4_cases(data, db, config_case, case_key):
+    """
+    Flow 4 on many cases at once (see `CaseBatch`), each case as if its rows were given to `flow_4` on their own.
+
+    Parameters:
+    - data (pd.DataFrame): Current data with the `case_key` column.
+    - db (pd.DataFrame): Historical data with the `case_key` column.
+    - config_case (pd.DataFrame): 'number' and 'day' per `case_key` value. Without a `case_key` column,
+      the first entry applies to every case of `data` (see `case_table`).
+    - case_key (str): Case key column.
+
+    Returns:
+    - dict: 'cases' (pd.DataFrame with the `case_key`, 'status', 'message', 'count_abnormal' and 'total_relocate_day' of each case)
+      and 'data' (ResultRows of all the cases, case after case, with their `case_key`).
+    """
+    config_case = case_table(config_case, case_key, data).drop_duplicates(case_key)
+    batch = CaseBatch(data, db, case_key, config_case[case_key])
+    limits = config_case[['number', 'day']].reset_index(drop=True)
+
+    result_check_inform_exit = batch.inform_exit()
+    inform_normal = result_check_inform_exit['normal']
+    dropped = batch.data_alien[result_check_inform_exit['rows']]
+    data_case = batch.without_aliens(batch.per_case(inform_normal), result_check_inform_exit['rows'])
+
+    # Relocation counts of the batch and of the history of its employers, per case
+    keys = ['CREATED_TIMESTAMP', 'EMPLOYER_NO', 'FORM_ID']
+    data_employers, db_employers = batch.codes('EMPLOYER_NO')
+    db_case = inform_normal[batch.db_case] & np.isin(db_employers, data_employers[data_case]) & ~np.isin(batch.db_alien, dropped)
+    counts = []
+    for frame, case, mask in [(batch.db, batch.db_case, db_case), (batch.data, batch.data_case, data_case)]:
+        rows = frame.loc[mask, keys + ['ALIEN_ID']].reset_index(drop=True)
+        rows.insert(0, 'CASE', case[mask])
+        counts.append(rows.groupby(['CASE'] + keys, observed=True).agg(ALIEN_COUNT=('ALIEN_ID', 'count')).reset_index())
+    window = batch.worst_windows(pd.concat(counts, axis=0).reset_index(drop=True), limits, by=['EMPLOYER_NO'])
+    relocate_normal = window['ALIEN_COUNT'].isna().to_numpy()
+    outcome = np.where(inform_normal, np.where(relocate_normal, "normal", "abnormal_relocate_B"), "check_inform_exit")
+
+    rows = batch.result_rows([
+        (result_check_inform_exit['rows'], True, True, 'inform_exit', batch.per_case(np.where(outcome == "normal", "R4/2", "R4/1"))[result_check_inform_exit['rows']]),
+        (np.flatnonzero(data_case), batch.per_case(~relocate_normal)[data_case], batch.per_case(~relocate_normal)[data_case], 'relocate', "R4/2"),
+    ])
+
+    cases = batch.result_frame({
+        'status': np.where(outcome == "normal", "normal", "abnormal"),
+        'message': [messages[key] for key in outcome],
+        'count_abnormal': np.where(inform_normal, window['ALIEN_COUNT'].fillna(0).to_numpy(dtype=np.int64), result_check_inform_exit['count_abnormal']),
+        'total_relocate_day': [None if not checked else ("pass" if normal else int(days))
+                               for checked, normal, days in zip(inform_normal, relocate_normal, window['TOTAL_DAYS'])],
+    })
+    return {'cases': cases, 'data': rows}
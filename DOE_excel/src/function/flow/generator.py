@@ -0,0 +1,183 @@
+import numpy as np
+import pandas as pd
+
+from .prep_data import column_names, is_text, list_columns, quoted_columns
+
+# Default share of each job description among the aliens
+job_mix = {
+    'กรรมกร': 0.5,
+    'งานขายของหน้าร้าน': 0.2,
+    'งานทํามือ': 0.15,
+    'งานทํารองเท้า': 0.1,
+    'อื่นๆ': 0.05,
+}
+
+
+def zipf_weights(n, skew) -> np.ndarray:
+    """
+    Get the probability of each of `n` ranks under a Zipf law, `skew` 0 is uniform.
+    """
+    weights = 1.0 / np.arange(1, n + 1) ** skew
+    return weights / weights.sum()
+
+
+def form_rows(forms: pd.DataFrame, sizes, alien_ids, jobs, form_type, form_status) -> pd.DataFrame:
+    """
+    Expand a table of forms (one row per form) into one row per alien, in the post-`prep_data` shape.
+    """
+    n_rows = np.repeat(np.arange(len(forms)), sizes)
+    position = np.arange(len(n_rows)) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+    employer = forms['EMPLOYER'].to_numpy()[n_rows]
+    return pd.DataFrame({
+        'CREATED_TIMESTAMP': forms['CREATED_TIMESTAMP'].to_numpy()[n_rows],
+        'FORM_ID': forms['FORM_ID'].to_numpy()[n_rows],
+        'FORM_ID_SEQ': forms['FORM_ID_SEQ'].to_numpy()[n_rows],
+        'ALIEN_ID': alien_ids,
+        'ALIEN_SEQ': (position + 1).astype(str).astype(object),
+        'EMPLOYER_ID': pd.Series(employer).map('{:05d}'.format).to_numpy(dtype=object),
+        'COMPANYNAME_TH': pd.Series(employer).map('บริษัท {} จำกัด'.format).to_numpy(dtype=object),
+        'COMPANYNAME_EN': pd.Series(employer).map('Company {} Co., Ltd.'.format).to_numpy(dtype=object),
+        'BUS_TYPE_ID': employer % 20 + 1,
+        'JOB_DESCRIPTION': jobs,
+        'EMPLOYER_NO': pd.Series(employer + 10_000_000).map('{:08d}'.format).to_numpy(dtype=object),
+        'MASTER_FORM_TYPE': form_type,
+        'MASTER_FORM_STATUS': form_status,
+        'VALID_UNTIL': forms['VALID_UNTIL'].to_numpy()[n_rows],
+    })
+
+
+def generate(n_aliens, n_employers, seed=0, max_aliens=5, employer_skew=1.1, exit_share=0.8,
+             move_share=0.2, burst_share=0.1, n_bursts=10, burst_days=5, expire_share=0.05,
+             jobs=None, start='2024-01-01', n_days=365):
+    """
+    Generate `data` and `db` frames in the post-`prep_data` shape (one row per alien).
+
+    The history (`db`) holds one MT_59 application per alien at its employer A, grouped in forms
+    of 1 to `max_aliens` aliens, and MT_13_EXIT reports for a share of those forms. The current
+    data holds the MT_59 applications of the forms that move to a new employer B. A share of the
+    moves are relocation bursts: many forms from the same employer A to the same employer B within
+    a few days. Aliens who move without an exit report fail the inform exit check, and a share of
+    the exits have a work permit expiring within 30 days of the new application.
+
+    Parameters:
+    - n_aliens (int): Number of aliens in the history.
+    - n_employers (int): Number of employers.
+    - seed (int): Random seed, the same parameters and seed give the same frames.
+    - max_aliens (int): Maximum number of aliens per form.
+    - employer_skew (float): Zipf exponent of the employer sizes (0 for equal sizes).
+    - exit_share (float): Share of the moving forms with an MT_13_EXIT report.
+    - move_share (float): Share of the history forms applying at a new employer in `data`.
+    - burst_share (float): Share of the moving forms that are part of a relocation burst.
+    - n_bursts (int): Number of (A, B) employer pairs with a relocation burst.
+    - burst_days (int): Number of days of a burst.
+    - expire_share (float): Share of the exits with a work permit expiring within 30 days of the new application.
+    - jobs (dict, optional): Share of each job description, `job_mix` if omitted.
+    - start (str): First day of the history.
+    - n_days (int): Number of days covered by the history.
+
+    Returns:
+    - tuple: (data (pd.DataFrame), db (pd.DataFrame)).
+
+    Example:
+        data, db = generate(n_aliens=1_000_000, n_employers=100_000, employer_skew=1.2, seed=1)
+        raw_data = to_raw(data)
+    """
+    rng = np.random.default_rng(seed)
+    jobs = job_mix if jobs is None else jobs
+    start = pd.Timestamp(start)
+    half = max(n_days // 2, 1)
+
+    # History forms, sizes are cut so the forms hold exactly n_aliens aliens
+    sizes = rng.integers(1, max_aliens + 1, n_aliens)
+    n_forms = int(np.searchsorted(np.cumsum(sizes), n_aliens)) + 1
+    sizes = sizes[:n_forms]
+    sizes[-1] -= sizes.sum() - n_aliens
+    employer_a = rng.choice(n_employers, size=n_forms, p=zipf_weights(n_employers, employer_skew))
+    apply_day = rng.integers(0, half, n_forms)
+    alien_ids = pd.Series(np.arange(n_aliens)).map('{:08d}'.format).to_numpy(dtype=object)
+    alien_jobs = rng.choice(np.array(list(jobs), dtype=object), size=n_aliens, p=np.array(list(jobs.values())) / sum(jobs.values()))
+
+    # Forms moving to a new employer, with or without an exit report
+    moving = rng.random(n_forms) < move_share
+    employer_b = rng.choice(n_employers, size=n_forms, p=zipf_weights(n_employers, employer_skew))
+    employer_b = np.where(employer_b == employer_a, (employer_b + 1) % max(n_employers, 1), employer_b)
+    exited = moving & (rng.random(n_forms) < exit_share)
+    exit_day = apply_day + rng.integers(30, half + 30, n_forms)
+
+    # Relocation bursts: several forms from the same A to the same B within burst_days
+    burst = moving & (rng.random(n_forms) < burst_share)
+    burst_id = rng.integers(0, n_bursts, n_forms)
+    burst_pairs = rng.choice(n_employers, size=(n_bursts, 2), replace=n_employers < 2 * n_bursts)
+    burst_start = rng.integers(half, max(n_days - burst_days, half + 1), n_bursts)
+    employer_a = np.where(burst, burst_pairs[burst_id, 0], employer_a)
+    employer_b = np.where(burst, burst_pairs[burst_id, 1], employer_b)
+    exited |= burst
+    exit_day = np.where(burst, burst_start[burst_id] + rng.integers(0, burst_days, n_forms), exit_day)
+    move_day = np.where(exited, exit_day + rng.integers(0, burst_days + 1, n_forms), exit_day)
+
+    time_of_day = pd.to_timedelta(rng.integers(8 * 3600, 17 * 3600, n_forms), unit='s')
+    apply_timestamp = start + pd.to_timedelta(apply_day, unit='D') + time_of_day
+    exit_timestamp = start + pd.to_timedelta(exit_day, unit='D') + time_of_day
+    move_timestamp = start + pd.to_timedelta(move_day, unit='D') + time_of_day
+    valid_until = apply_timestamp + pd.Timedelta(days=730)
+    expiring = exited & (rng.random(n_forms) < expire_share)
+    exit_valid_until = np.where(expiring, move_timestamp + pd.to_timedelta(rng.integers(0, 30, n_forms), unit='D'), valid_until)
+
+    # FORM_ID and FORM_ID_SEQ follow the order of the forms: applications, exits, then the current data
+    n_exits, n_moves = int(exited.sum()), int(moving.sum())
+    form_ids = pd.Series(np.arange(n_forms + n_exits + n_moves) + 1).map('{:07d}'.format).to_numpy(dtype=object)
+    form_seq = np.arange(n_forms + n_exits + n_moves) + 1
+    alien_form = np.repeat(np.arange(n_forms), sizes)
+
+    applications = pd.DataFrame({
+        'CREATED_TIMESTAMP': apply_timestamp, 'FORM_ID': form_ids[:n_forms], 'FORM_ID_SEQ': form_seq[:n_forms],
+        'EMPLOYER': employer_a, 'VALID_UNTIL': valid_until,
+    })
+    exits = pd.DataFrame({
+        'CREATED_TIMESTAMP': exit_timestamp[exited], 'FORM_ID': form_ids[n_forms:n_forms + n_exits],
+        'FORM_ID_SEQ': form_seq[n_forms:n_forms + n_exits], 'EMPLOYER': employer_a[exited],
+        'VALID_UNTIL': exit_valid_until[exited],
+    })
+    moves = pd.DataFrame({
+        'CREATED_TIMESTAMP': move_timestamp[moving], 'FORM_ID': form_ids[n_forms + n_exits:],
+        'FORM_ID_SEQ': form_seq[n_forms + n_exits:], 'EMPLOYER': employer_b[moving],
+        'VALID_UNTIL': np.where(exited, exit_valid_until, valid_until)[moving],
+    })
+
+    exit_aliens = exited[alien_form]
+    move_aliens = moving[alien_form]
+    db = pd.concat([
+        form_rows(applications, sizes, alien_ids, alien_jobs, 'MT_59', 'Completed'),
+        form_rows(exits, sizes[exited], alien_ids[exit_aliens], alien_jobs[exit_aliens], 'MT_13_EXIT', 'Completed'),
+    ], ignore_index=True)
+    data = form_rows(moves, sizes[moving], alien_ids[move_aliens], alien_jobs[move_aliens], 'MT_59', 'Consider request round1')
+    return data, db
+
+
+def to_raw(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Convert a post-`prep_data` frame back to the raw workbook shape: one row per form, workbook headers,
+    comma separated alien columns and quoted values. `prep_data(to_raw(df))` gives `df` back.
+
+    Parameters:
+    - df (pd.DataFrame): One row per alien, the rows of a form next to each other.
+
+    Returns:
+    - pd.DataFrame: One row per form.
+    """
+    df = df.copy()
+    for column in quoted_columns:
+        if column in df.columns and is_text(df[column]):
+            df[column] = '"' + df[column].astype(str) + '"'
+
+    form_ids = df['FORM_ID'].to_numpy()
+    new_form = np.r_[True, form_ids[1:] != form_ids[:-1]]
+    raw = df[new_form].reset_index(drop=True)
+    form = np.cumsum(new_form) - 1
+    for column in list_columns:
+        if column in df.columns:
+            raw[column] = df[column].astype(str).groupby(form, sort=False).agg(','.join).to_numpy()
+
+    raw_names = {name.upper(): header for header, name in column_names.items()}
+    raw_names['VALID_UNTIL'] = 'Valid_Until'
+    return raw.rename(columns=raw_names)
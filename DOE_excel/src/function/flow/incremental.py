@@ -0,0 +1,348 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from .engine import PandasEngine, relocation_keys
+from .expiry_index import ExpiryIndex
+from .lookup import find_positions, key_values, sorted_lookup
+from .partitioned_store import PartitionedHistory
+from .plan import ExecutionPlan, run_flows
+from .snapshot_cache import read_snapshot, write_snapshot
+
+
+class HistoryStore:
+    """
+    Append-only history of prepped rows with lookups by ALIEN_ID and EMPLOYER_NO.
+
+    The rows live in a base frame with a sorted key array per lookup column, so the rows of a
+    set of aliens or employers are found with `searchsorted` instead of a scan of the history.
+    Appended batches are kept as pending segments, whose keys are merged into one sorted lookup
+    per column on append (as `PartitionedHistory.alien_files` merges its indexes), so a lookup in
+    the pending rows is a binary search too. When the segments grow beyond `compact_ratio` of the
+    base, they are folded into it and the lookups are rebuilt, which keeps the amortized cost of a
+    batch proportional to its size.
+
+    Parameters:
+    - db (pd.DataFrame): Initial historical data.
+    - compact_ratio (float): Size of the pending segments, relative to the base, that triggers a compaction.
+    - keys (list of str, optional): Lookup columns, ALIEN_ID and EMPLOYER_NO by default.
+
+    Example:
+        history = HistoryStore(db)
+        history.append(data)
+        history.rows_for(alien_ids=data["ALIEN_ID"].unique())
+    """
+
+    keys = ['ALIEN_ID', 'EMPLOYER_NO']
+
+    def __init__(self, db: pd.DataFrame, compact_ratio=0.25, keys=None):
+        if keys is not None:
+            self.keys = list(keys)
+        self.compact_ratio = compact_ratio
+        self.generation = 0
+        self.base = db.reset_index(drop=True)
+        self.lookups = self.build_lookups(self.base)
+        self.segments = []
+        self.clear_pending()
+
+    def build_lookups(self, df: pd.DataFrame) -> dict:
+        return {key: sorted_lookup(key_values(df[key])) for key in self.keys}
+
+    def clear_pending(self):
+        # Start of each segment in the pending rows, and sorted lookups of the pending rows
+        self.segment_starts = np.array([], dtype=np.int64)
+        self.pending_lookups = {key: (key_values([]), np.array([], dtype=np.int64)) for key in self.keys}
+
+    def __len__(self):
+        return len(self.base) + self.pending_rows()
+
+    def pending_rows(self) -> int:
+        return int(self.segment_starts[-1]) + len(self.segments[-1]) if self.segments else 0
+
+    def add_segment(self, segment: pd.DataFrame):
+        """
+        Add a segment to the pending rows and merge its keys into the pending lookups.
+        """
+        start = self.pending_rows()
+        for key, (values, positions) in self.pending_lookups.items():
+            new_values, new_positions = sorted_lookup(key_values(segment[key]))
+            # Two sorted runs, merged by the stable sort in about linear time
+            values = np.concatenate([values, new_values])
+            order = np.argsort(values, kind='mergesort')
+            self.pending_lookups[key] = (values[order], np.concatenate([positions, new_positions + start])[order])
+        self.segment_starts = np.append(self.segment_starts, start)
+        self.segments.append(segment)
+
+    def append(self, rows: pd.DataFrame):
+        """
+        Add new rows at the end of the history, compacting the pending segments if needed.
+        """
+        if rows.empty:
+            return
+        self.add_segment(rows.reset_index(drop=True))
+        if self.pending_rows() > self.compact_ratio * max(len(self.base), 1):
+            self.compact()
+
+    def compact(self):
+        """
+        Fold the pending segments into the base and rebuild the lookups.
+        """
+        if not self.segments:
+            return
+        self.base = pd.concat([self.base] + self.segments, ignore_index=True)
+        self.segments = []
+        self.clear_pending()
+        self.lookups = self.build_lookups(self.base)
+        self.generation += 1
+
+    def positions_for(self, lookups, alien_ids=(), employers=()) -> np.ndarray:
+        positions = [
+            find_positions(lookups[key], key_values(values))
+            for key, values in [('ALIEN_ID', alien_ids), ('EMPLOYER_NO', employers)] if len(values)
+        ]
+        return np.unique(np.concatenate(positions)) if positions else np.array([], dtype=np.int64)
+
+    def rows_for(self, alien_ids=(), employers=()) -> pd.DataFrame:
+        """
+        Get the history rows of some aliens or employers, in history order.
+
+        Parameters:
+        - alien_ids (list-like): ALIEN_IDs to look up.
+        - employers (list-like): EMPLOYER_NOs to look up.
+
+        Returns:
+        - pd.DataFrame: Rows matching any of the aliens or employers.
+        """
+        frames = [self.base.take(self.positions_for(self.lookups, alien_ids, employers))]
+        if self.segments:
+            pending = self.positions_for(self.pending_lookups, alien_ids, employers)
+            segment = np.searchsorted(self.segment_starts, pending, side='right') - 1
+            bounds = np.searchsorted(segment, np.arange(len(self.segments) + 1))
+            frames.extend(
+                self.segments[i].take(pending[bounds[i]:bounds[i + 1]] - self.segment_starts[i])
+                for i in range(len(self.segments)) if bounds[i] < bounds[i + 1]
+            )
+        return pd.concat(frames, ignore_index=True)
+
+    def save(self, path):
+        """
+        Checkpoint the history to a directory.
+
+        Only the files missing from the directory are written: the base and its lookups once per
+        compaction, then one Arrow file per pending segment. The manifest is replaced atomically
+        and files of older generations are removed afterwards.
+        """
+        os.makedirs(path, exist_ok=True)
+        base_name = f"base-{self.generation:05d}"
+        files = [f"{base_name}.arrow", f"{base_name}.npz"]
+        if not os.path.exists(os.path.join(path, files[0])):
+            write_snapshot(self.base, os.path.join(path, files[0]))
+            lookup_arrays = {}
+            for key, (values, order) in self.lookups.items():
+                lookup_arrays[f"{key}_values"] = values
+                lookup_arrays[f"{key}_order"] = order
+            np.savez(os.path.join(path, files[1]), **lookup_arrays)
+
+        segment_files = []
+        for i, segment in enumerate(self.segments):
+            segment_file = f"segment-{self.generation:05d}-{i:05d}.arrow"
+            if not os.path.exists(os.path.join(path, segment_file)):
+                write_snapshot(segment, os.path.join(path, segment_file))
+            segment_files.append(segment_file)
+
+        manifest = {
+            'generation': self.generation,
+            'compact_ratio': self.compact_ratio,
+            'keys': self.keys,
+            'base': files,
+            'segments': segment_files,
+        }
+        tmp_path = os.path.join(path, f"manifest.json.{os.getpid()}.tmp")
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, os.path.join(path, 'manifest.json'))
+
+        for name in os.listdir(path):
+            if name.startswith(('base-', 'segment-')) and name not in files + segment_files:
+                os.remove(os.path.join(path, name))
+
+    @classmethod
+    def load(cls, path):
+        """
+        Restore a history checkpointed with `save`, without sorting it again.
+        """
+        with open(os.path.join(path, 'manifest.json'), encoding='utf-8') as f:
+            manifest = json.load(f)
+        history = cls.__new__(cls)
+        history.keys = manifest.get('keys', cls.keys)
+        history.compact_ratio = manifest['compact_ratio']
+        history.generation = manifest['generation']
+        history.base = read_snapshot(os.path.join(path, manifest['base'][0]))
+        with np.load(os.path.join(path, manifest['base'][1])) as lookup_arrays:
+            history.lookups = {key: (lookup_arrays[f"{key}_values"], lookup_arrays[f"{key}_order"]) for key in history.keys}
+        history.segments = []
+        history.clear_pending()
+        for name in manifest['segments']:
+            history.add_segment(read_snapshot(os.path.join(path, name)))
+        return history
+
+
+def relocation_counts(rows: pd.DataFrame) -> pd.DataFrame:
+    """
+    Count the aliens ('ALIEN_COUNT') and the rows ('ROW_COUNT') of history rows per `relocation_keys`.
+    """
+    return rows.groupby(relocation_keys, observed=True).agg(
+        ALIEN_COUNT=('ALIEN_ID', 'count'), ROW_COUNT=('ALIEN_ID', 'size')
+    ).reset_index()
+
+
+class IncrementalEngine(PandasEngine):
+    """
+    History lookups of one batch against the state kept by `IncrementalEvaluator`.
+
+    `db` only holds the history rows of the batch aliens. The relocation counts of the batch employers
+    come from the per-employer day counts of the whole history (a `HistoryStore` of `relocation_counts`
+    keyed by EMPLOYER_NO), from which the rows of the excluded aliens are subtracted. The excluded aliens
+    are aliens of the batch, so their rows are in `db`.
+
+    Parameters:
+    - db (pd.DataFrame): History rows of the batch aliens.
+    - counts (HistoryStore): Relocation counts of the whole history, see `relocation_counts`.
+    """
+
+    name = 'incremental'
+
+    def __init__(self, db: pd.DataFrame, counts: HistoryStore):
+        super().__init__(db)
+        self.counts = counts
+
+    def case_counts(self, excluded_aliens, employers=None) -> pd.DataFrame:
+        if employers is None:
+            counts = pd.concat([self.counts.base] + self.counts.segments, ignore_index=True)
+        else:
+            counts = self.counts.rows_for(employers=employers)
+        # A (day, employer, form) group may have been counted over several appended batches
+        totals = counts.groupby(relocation_keys, observed=True)[['ALIEN_COUNT', 'ROW_COUNT']].sum()
+
+        excluded = self.db[self.db['ALIEN_ID'].isin(excluded_aliens)]
+        if employers is not None:
+            excluded = excluded[excluded['EMPLOYER_NO'].isin(employers)]
+        if len(excluded):
+            removed = relocation_counts(excluded).set_index(relocation_keys)
+            totals = totals.sub(removed.reindex(totals.index, fill_value=0))
+        # Groups left without any row are not counted, as with a groupby on the remaining rows
+        totals = totals[totals['ROW_COUNT'] > 0]
+        return totals[['ALIEN_COUNT']].astype(np.int64).reset_index()
+
+
+class IncrementalEvaluator:
+    """
+    Evaluate batches of new applications against a history kept between runs.
+
+    The evaluator keeps state between batches: the history with its key lookups (`HistoryStore`),
+    the per-employer day counts of the relocations (`relocation_counts`, in a `HistoryStore` keyed
+    by EMPLOYER_NO) and the exit records with their expiry dates (`ExpiryIndex`). Applying a batch
+    appends it to each of them.
+
+    Each batch is only checked against the history rows of its aliens (latest status, exit records
+    and A to B relocations) and the day counts of its employers (relocation windows of flow 4), see
+    `IncrementalEngine`. The flows share one `ExecutionPlan` of the batch and those rows, so the cost
+    of a batch follows the batch size and not the history size. The results are the same as running
+    the flows on the batch with the full history.
+
+    Parameters:
+    - db (pd.DataFrame, HistoryStore or PartitionedHistory): Historical data. With a `PartitionedHistory`, each batch
+      only reads the partitions of its aliens and employers, and the applied batches are appended to the store.
+    - config (dict): Config case of each flow to run, keyed by "flow1", "flow2" and "flow4"
+      (same format as the `config_case` of `flow_1`, `flow_2` and `flow_4`). Flows without config are skipped.
+    - checkpoint_dir (str, optional): Directory where a `HistoryStore` and its day counts (in 'relocation_counts')
+      are checkpointed after each applied batch.
+
+    Example:
+        evaluator = IncrementalEvaluator(db, {"flow1": config_flow1, "flow4": {"number": 50, "day": 20}}, ".checkpoint")
+        results = evaluator.apply(data)
+        ...
+        evaluator = IncrementalEvaluator.load(".checkpoint", config)
+    """
+
+    def __init__(self, db, config, checkpoint_dir=None):
+        self.history = db if isinstance(db, (HistoryStore, PartitionedHistory)) else HistoryStore(db)
+        self.config = config
+        self.checkpoint_dir = checkpoint_dir
+        self.expiry_index = self.build_expiry_index(self.history)
+        self.counts = self.build_counts(self.history)
+        self.checkpoint()
+
+    @staticmethod
+    def build_counts(history) -> HistoryStore:
+        if isinstance(history, PartitionedHistory):
+            return HistoryStore(relocation_counts(history.query(columns=relocation_keys + ['ALIEN_ID'])), keys=['EMPLOYER_NO'])
+        counts = HistoryStore(relocation_counts(history.base), keys=['EMPLOYER_NO'])
+        for segment in history.segments:
+            counts.append(relocation_counts(segment))
+        return counts
+
+    @staticmethod
+    def build_expiry_index(history) -> ExpiryIndex:
+        if isinstance(history, PartitionedHistory):
+            return ExpiryIndex(history.query(form_types=['MT_13_EXIT']))
+        expiry_index = ExpiryIndex(history.base)
+        for segment in history.segments:
+            expiry_index.append(segment)
+        return expiry_index
+
+    @classmethod
+    def load(cls, checkpoint_dir, config):
+        """
+        Restart an evaluator from its checkpoint directory.
+        """
+        evaluator = cls.__new__(cls)
+        evaluator.history = HistoryStore.load(checkpoint_dir)
+        evaluator.config = config
+        evaluator.checkpoint_dir = checkpoint_dir
+        evaluator.expiry_index = cls.build_expiry_index(evaluator.history)
+        counts_dir = os.path.join(checkpoint_dir, 'relocation_counts')
+        if os.path.exists(os.path.join(counts_dir, 'manifest.json')):
+            evaluator.counts = HistoryStore.load(counts_dir)
+        else:
+            evaluator.counts = cls.build_counts(evaluator.history)
+        return evaluator
+
+    def evaluate(self, data: pd.DataFrame, EMPLOYER_NO_A=None, EMPLOYER_NO_B=None) -> dict:
+        """
+        Run the configured flows on a batch without adding it to the history.
+
+        Parameters:
+        - data (pd.DataFrame): Batch of new applications.
+        - EMPLOYER_NO_A (str, optional): Employer number for location A, flow 2 is only run when both employers are given.
+        - EMPLOYER_NO_B (str, optional): Employer number for location B.
+
+        Returns:
+        - dict: Result of each flow that was run, keyed by "flow1", "flow2" and "flow4".
+        """
+        # Rows of the batch aliens (status, exits, A to B), the employers only need their day counts
+        db_rows = self.history.rows_for(alien_ids=data['ALIEN_ID'].unique())
+        plan = ExecutionPlan(data, db_rows, expiry_index=self.expiry_index, engine=IncrementalEngine(db_rows, self.counts))
+        return run_flows(plan, self.config, EMPLOYER_NO_A, EMPLOYER_NO_B)
+
+    def apply(self, data: pd.DataFrame, EMPLOYER_NO_A=None, EMPLOYER_NO_B=None) -> dict:
+        """
+        Evaluate a batch (see `evaluate`), then add it to the history and checkpoint it.
+
+        Returns:
+        - dict: Result of each flow that was run, keyed by "flow1", "flow2" and "flow4".
+        """
+        results = self.evaluate(data, EMPLOYER_NO_A, EMPLOYER_NO_B)
+        self.history.append(data)
+        self.expiry_index.append(data)
+        self.counts.append(relocation_counts(data))
+        self.checkpoint()
+        return results
+
+    def checkpoint(self):
+        # Appends to a PartitionedHistory are already on disk
+        if self.checkpoint_dir is not None and isinstance(self.history, HistoryStore):
+            self.history.save(self.checkpoint_dir)
+            self.counts.save(os.path.join(self.checkpoint_dir, 'relocation_counts'))
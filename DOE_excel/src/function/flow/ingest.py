@@ -0,0 +1,191 @@
+import os
+from itertools import islice
+
+import pandas as pd
+
+from .prep_data import normalize_column, prep_data, selected_cols
+from .schema import apply_schema, concat_typed
+
+
+def source_format(path) -> str:
+    """
+    Get the format of a source file from its extension ('csv' or 'xlsx').
+    """
+    extension = os.path.splitext(str(path))[1].lower()
+    if extension in ('.csv', '.txt'):
+        return 'csv'
+    if extension in ('.xlsx', '.xlsm'):
+        return 'xlsx'
+    raise ValueError(f"Unsupported source file: {path}")
+
+
+def wanted_columns(columns):
+    """
+    Get the set of normalized columns the reader must keep for `columns`.
+
+    ALIEN_ID is always read because it drives the explode of each form row.
+    """
+    if columns is None:
+        return None
+    return set(columns) | {'ALIEN_ID'}
+
+
+def iter_csv_chunks(path, wanted, chunksize):
+    """
+    Read a CSV file by chunks, keeping only the raw columns that normalize to `wanted`.
+    """
+    usecols = None if wanted is None else (lambda name: normalize_column(name) in wanted)
+    # Keep ids as text, '00501' must not be read as the number 501
+    reader = pd.read_csv(path, usecols=usecols, chunksize=chunksize, dtype=str, keep_default_na=True)
+    for chunk in reader:
+        yield chunk
+
+
+def iter_xlsx_chunks(path, wanted, chunksize, sheet_name=0):
+    """
+    Read a sheet of an XLSX workbook by chunks with the openpyxl read-only row iterator,
+    keeping only the raw columns that normalize to `wanted`.
+    """
+    from openpyxl import load_workbook
+
+    workbook = load_workbook(path, read_only=True, data_only=True)
+    try:
+        worksheet = workbook.worksheets[sheet_name] if isinstance(sheet_name, int) else workbook[sheet_name]
+        rows = worksheet.iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return
+        positions = [
+            i for i, name in enumerate(header)
+            if name is not None and (wanted is None or normalize_column(name) in wanted)
+        ]
+        names = [header[i] for i in positions]
+        while True:
+            block = [[row[i] if i < len(row) else None for i in positions] for row in islice(rows, chunksize)]
+            if not block:
+                break
+            chunk = pd.DataFrame(block, columns=names)
+            # Skip the empty rows that Excel keeps at the end of a formatted sheet
+            chunk = chunk.dropna(how='all')
+            if not chunk.empty:
+                yield chunk
+    finally:
+        workbook.close()
+
+
+def iter_prepped(path, columns=None, chunksize=100_000, sheet_name=0, typed=False):
+    """
+    Stream a CSV or XLSX source through `prep_data` chunk by chunk.
+
+    Column projection is done by the reader, so unused columns such as COMPANYNAME_TH/EN
+    are never loaded, and memory is bounded by `chunksize` rather than by the file size.
+
+    Parameters:
+    - path (str): CSV or XLSX file.
+    - columns (list of str, optional): Normalized columns to keep, e.g. `selected_cols`. All columns if omitted.
+    - chunksize (int): Number of source (form) rows per chunk.
+    - sheet_name (str or int): Sheet to read for XLSX sources.
+    - typed (bool): Convert the chunks to the typed schema of `flow/schema.py` (`selected_cols` only).
+
+    Returns:
+    - generator of pd.DataFrame: Normalized chunks, one row per alien.
+
+    Example:
+        for chunk in iter_prepped("Testcase_DOE_2-7-2024.xlsx", selected_cols, sheet_name="Prerequisite"):
+            ...
+    """
+    if typed:
+        columns = selected_cols
+    wanted = wanted_columns(columns)
+    if source_format(path) == 'csv':
+        chunks = iter_csv_chunks(path, wanted, chunksize)
+    else:
+        chunks = iter_xlsx_chunks(path, wanted, chunksize, sheet_name)
+
+    for chunk in chunks:
+        prepped = prep_data(chunk)
+        if typed:
+            prepped = apply_schema(prepped)
+        elif columns is not None:
+            prepped = prepped.reindex(columns=columns)
+        yield prepped
+
+
+def read_prepped(path, columns=None, chunksize=100_000, sheet_name=0, typed=False) -> pd.DataFrame:
+    """
+    Read a CSV or XLSX source with `iter_prepped` and concatenate the chunks.
+
+    Parameters:
+    - path (str): CSV or XLSX file.
+    - columns (list of str, optional): Normalized columns to keep, e.g. `selected_cols`.
+    - chunksize (int): Number of source (form) rows per chunk.
+    - sheet_name (str or int): Sheet to read for XLSX sources.
+    - typed (bool): Convert the data to the typed schema of `flow/schema.py` (`selected_cols` only).
+
+    Returns:
+    - pd.DataFrame: Normalized data, one row per alien.
+    """
+    if typed:
+        return concat_typed(iter_prepped(path, columns, chunksize, sheet_name, typed=True))
+    chunks = list(iter_prepped(path, columns, chunksize, sheet_name))
+    if not chunks:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(chunks, ignore_index=True)
+
+
+def write_prepped(path, store_path, columns=None, chunksize=100_000, sheet_name=0) -> int:
+    """
+    Stream a CSV or XLSX source through `prep_data` straight into an on-disk store.
+
+    The store format follows the extension of `store_path`: '.parquet' is written
+    row group by row group with pyarrow, '.csv' is appended chunk by chunk.
+
+    Parameters:
+    - path (str): CSV or XLSX file.
+    - store_path (str): Output file ('.parquet' or '.csv').
+    - columns (list of str, optional): Normalized columns to keep, e.g. `selected_cols`.
+    - chunksize (int): Number of source (form) rows per chunk.
+    - sheet_name (str or int): Sheet to read for XLSX sources.
+
+    Returns:
+    - int: Number of rows written.
+    """
+    chunks = iter_prepped(path, columns, chunksize, sheet_name)
+    extension = os.path.splitext(str(store_path))[1].lower()
+    if extension == '.parquet':
+        return write_parquet_chunks(chunks, store_path)
+    if extension == '.csv':
+        return write_csv_chunks(chunks, store_path)
+    raise ValueError(f"Unsupported store file: {store_path}")
+
+
+def write_csv_chunks(chunks, store_path) -> int:
+    n_rows = 0
+    with open(store_path, 'w', newline='', encoding='utf-8') as f:
+        for i, chunk in enumerate(chunks):
+            chunk.to_csv(f, index=False, header=(i == 0))
+            n_rows += len(chunk)
+    return n_rows
+
+
+def write_parquet_chunks(chunks, store_path) -> int:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    n_rows = 0
+    writer = None
+    try:
+        for chunk in chunks:
+            if writer is None:
+                schema = pa.Schema.from_pandas(chunk, preserve_index=False)
+                # Columns that are empty in the first chunk are stored as text
+                for i, field in enumerate(schema):
+                    if pa.types.is_null(field.type):
+                        schema = schema.set(i, field.with_type(pa.string()))
+                writer = pq.ParquetWriter(store_path, schema)
+            writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+            n_rows += len(chunk)
+    finally:
+        if writer is not None:
+            writer.close()
+    return n_rows
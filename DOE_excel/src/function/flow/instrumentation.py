@@ -0,0 +1,215 @@
+import functools
+import inspect
+import json
+import logging
+import os
+import sys
+import time
+import tracemalloc
+import warnings
+from collections import deque
+
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# Instrumentation is off unless `enable` is called, instrumented functions then only check this flag
+enabled = False
+settings = {'trace_memory': False, 'log_path': None}
+
+# Last call records, totals per function for the Prometheus file, and records of the calls in progress
+records = deque(maxlen=10_000)
+totals = {}
+active = []
+
+
+def enable(log_path=None, trace_memory=False):
+    """
+    Turn on the instrumentation of the checks, `prep_data` and the flows.
+
+    Parameters:
+    - log_path (str, optional): JSON lines file where each call record is appended.
+      Records are also sent to the 'flow.instrumentation' logger.
+    - trace_memory (bool): Measure the peak allocation of each call with tracemalloc (slower).
+
+    Example:
+        instrumentation.enable("metrics.jsonl")
+        flow_4(data, db, config_case)
+        instrumentation.write_prometheus("doe_checks.prom")
+    """
+    global enabled
+    settings['log_path'] = log_path
+    settings['trace_memory'] = trace_memory
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    enabled = True
+
+
+def disable():
+    global enabled
+    enabled = False
+    if settings['trace_memory'] and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    settings['trace_memory'] = False
+
+
+def reset():
+    records.clear()
+    totals.clear()
+
+
+def row_count(value):
+    """
+    Get the number of rows of a frame, a check or flow result, or a list of records (None for other values).
+    """
+    if isinstance(value, (pd.DataFrame, pd.Series, list)):
+        return len(value)
+    if isinstance(value, dict) and 'data' in value:
+        return row_count(value['data'])
+    if isinstance(value, dict) and 'rows' in value:
+        # Check result, its rows are positions in the data of the check
+        return len(value['rows'])
+    if hasattr(value, 'frame') and hasattr(value, '__len__'):
+        return len(value)
+    return None
+
+
+def note_merge(name, left, right, merged):
+    """
+    Record the cardinality of a merge done by the instrumented call in progress.
+    """
+    if not enabled or not active:
+        return
+    active[-1]['merges'].append({
+        'name': name,
+        'left_rows': len(left),
+        'right_rows': len(right),
+        'output_rows': len(merged),
+    })
+
+
+def instrumented(function):
+    """
+    Record wall time, input and output row counts, merge cardinalities and peak allocation of each call.
+
+    When the instrumentation is off, the call goes straight to `function`.
+    """
+    signature = inspect.signature(function)
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if not enabled:
+            return function(*args, **kwargs)
+
+        input_rows = {}
+        for name, value in signature.bind_partial(*args, **kwargs).arguments.items():
+            if row_count(value) is not None:
+                input_rows[name] = row_count(value)
+        record = {'function': function.__qualname__, 'timestamp': time.time(), 'input_rows': input_rows, 'merges': []}
+        trace_memory = settings['trace_memory'] and tracemalloc.is_tracing()
+        if trace_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            # The peak is reset for this call, keep the one seen so far by the calling record
+            if active:
+                active[-1]['peak_absolute'] = max(active[-1].get('peak_absolute', 0), peak)
+            tracemalloc.reset_peak()
+            record['start_bytes'] = current
+
+        active.append(record)
+        start = time.perf_counter()
+        try:
+            output = function(*args, **kwargs)
+        finally:
+            record['seconds'] = time.perf_counter() - start
+            active.pop()
+            if trace_memory:
+                _, peak = tracemalloc.get_traced_memory()
+                peak = max(peak, record.pop('peak_absolute', 0))
+                record['peak_bytes'] = peak - record.pop('start_bytes')
+                if active:
+                    active[-1]['peak_absolute'] = max(active[-1].get('peak_absolute', 0), peak)
+
+        record['output_rows'] = row_count(output)
+        save_record(record)
+        return output
+
+    return wrapper
+
+
+# Code of the wrappers made by `instrumented`, shared by all of them
+wrapper_code = instrumented(lambda: None).__code__
+
+
+def warn(message, category=UserWarning, stacklevel=1):
+    """
+    Issue a warning as `warnings.warn` does, without counting the frames of the `instrumented` wrappers.
+
+    With stacklevel=2, a warning of an instrumented function points at its caller and not at the wrapper.
+    """
+    frame = sys._getframe(1)
+    level = 1
+    while stacklevel > 1 and frame.f_back is not None:
+        frame = frame.f_back
+        level += 1
+        if frame.f_code is not wrapper_code:
+            stacklevel -= 1
+    warnings.warn(message, category, stacklevel=level + 1)
+
+
+def save_record(record):
+    records.append(record)
+    total = totals.setdefault(record['function'], {
+        'calls': 0, 'seconds': 0.0, 'input_rows': 0, 'output_rows': 0, 'peak_bytes': 0, 'merges': {},
+    })
+    total['calls'] += 1
+    total['seconds'] += record['seconds']
+    total['input_rows'] += sum(record['input_rows'].values())
+    total['output_rows'] += record['output_rows'] or 0
+    total['peak_bytes'] = max(total['peak_bytes'], record.get('peak_bytes', 0))
+    for merge in record['merges']:
+        merge_total = total['merges'].setdefault(merge['name'], {'left_rows': 0, 'right_rows': 0, 'output_rows': 0})
+        for key in merge_total:
+            merge_total[key] += merge[key]
+
+    line = json.dumps(record, ensure_ascii=False, default=str)
+    logger.info(line)
+    if settings['log_path'] is not None:
+        with open(settings['log_path'], 'a', encoding='utf-8') as f:
+            f.write(line + '\n')
+
+
+def prometheus_text() -> str:
+    """
+    Get the totals per function in the Prometheus text exposition format.
+    """
+    metrics = [
+        ('doe_check_calls_total', 'counter', 'Number of calls.', 'calls'),
+        ('doe_check_seconds_total', 'counter', 'Wall time spent in the calls.', 'seconds'),
+        ('doe_check_input_rows_total', 'counter', 'Rows of the frames passed to the calls.', 'input_rows'),
+        ('doe_check_output_rows_total', 'counter', 'Rows of the frames or results returned by the calls.', 'output_rows'),
+        ('doe_check_peak_bytes', 'gauge', 'Largest peak allocation of a call (with trace_memory).', 'peak_bytes'),
+    ]
+    lines = []
+    for name, metric_type, help_text, key in metrics:
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {metric_type}"]
+        for function, total in sorted(totals.items()):
+            lines.append(f'{name}{{function="{function}"}} {total[key]}')
+
+    lines += ["# HELP doe_merge_rows_total Rows on each side of the merges done by the calls.",
+              "# TYPE doe_merge_rows_total counter"]
+    for function, total in sorted(totals.items()):
+        for merge, merge_total in sorted(total['merges'].items()):
+            for side, rows in merge_total.items():
+                lines.append(f'doe_merge_rows_total{{function="{function}",merge="{merge}",side="{side[:-5]}"}} {rows}')
+    return '\n'.join(lines) + '\n'
+
+
+def write_prometheus(path):
+    """
+    Write the totals to a Prometheus text-format file (e.g. for the node exporter textfile collector).
+    The file is replaced atomically.
+    """
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(prometheus_text())
+    os.replace(tmp_path, path)
@@ -0,0 +1,46 @@
+import numpy as np
+import pandas as pd
+
+
+def key_values(values) -> np.ndarray:
+    """
+    Get lookup keys as a fixed-width text array (missing values become 'nan').
+    """
+    return np.asarray(pd.Series(values).astype(str), dtype=str)
+
+
+def sorted_lookup(values) -> tuple:
+    """
+    Build a lookup of key values: the values sorted (stable) and the row position of each of them.
+    """
+    order = np.argsort(values, kind='mergesort')
+    return values[order], order
+
+
+def find_positions(lookup, targets) -> np.ndarray:
+    """
+    Get the row positions of every target key in a sorted lookup.
+
+    Parameters:
+    - lookup (tuple): Sorted key values and the row position of each of them.
+    - targets (np.ndarray): Keys to find.
+
+    Returns:
+    - np.ndarray: Row positions of the matching rows.
+    """
+    return match_positions(lookup, np.unique(targets))[1]
+
+
+def match_positions(lookup, targets) -> tuple:
+    """
+    Match each target key to the rows of a sorted lookup with the same key, like an inner join.
+
+    Returns:
+    - tuple: (target (np.ndarray) position of the target of each match, row (np.ndarray) position of the matching row).
+    """
+    sorted_values, order = lookup
+    left = np.searchsorted(sorted_values, targets, side='left')
+    lengths = np.searchsorted(sorted_values, targets, side='right') - left
+    offsets = np.cumsum(lengths) - lengths
+    target = np.repeat(np.arange(len(targets)), lengths)
+    return target, order[np.repeat(left - offsets, lengths) + np.arange(lengths.sum())]
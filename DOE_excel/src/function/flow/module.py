@@ -3,131 +3,225 @@ import numpy as np
 import datetime
 from datetime import datetime, timedelta
 
+from .engine import PandasEngine
+from .expiry_index import ExpiryIndex
+from .instrumentation import instrumented, note_merge
+from .relocation import TransitionMatrix, find_relocation_windows, worst_window
+from .result import ResultRows
+from .status_index import AlienStatusIndex
+
+# Description of the abnormal rows of each check, by reason code
+reasons = {
+    'inform_exit': "Aliens have not yet reported their departure from the old company.",
+    'job_limits': "The employer hires more than 10 aliens for different types of work and positions.",
+    'expire': "The application submission date and the expiration date of the work permit is less than or equal to 30 days.",
+    'relocate': "Aliens moved to B exceeding the limit of people and have been relocated for more than a specified number of days.",
+}
+
+
+def check_rows(data, result, case_code, status=None) -> pd.DataFrame:
+    """
+    Materialize the rows reported by a check: its 'rows' of `data`, with their 'status', 'abnormal_desc' and 'case_code'.
+
+    Parameters:
+    - data (pd.DataFrame): Data given to the check.
+    - result (dict): Check result with 'rows' (positions in `data`), 'abnormal' (mask of the rows) and 'reason' (code in `reasons`).
+    - case_code (str): Case code of the abnormal rows, the normal rows get 'pass'.
+    - status (str, optional): Status given to every row instead of the status of the check (the description is kept).
+
+    Returns:
+    - pd.DataFrame: New frame with the rows, `data` is not modified.
+    """
+    rows = data.take(result['rows'])
+    abnormal = result['abnormal'] if status is None else np.full(len(rows), status == 'abnormal')
+    rows['status'] = np.where(abnormal, 'abnormal', 'normal')
+    rows['abnormal_desc'] = np.where(result['abnormal'], reasons[result['reason']], 'pass')
+    rows['case_code'] = np.where(abnormal, case_code, 'pass')
+    return rows
+
+
+def flow_rows(parts) -> ResultRows:
+    """
+    Materialize the rows of the checks of a flow, once, at the end of the flow.
+
+    Parameters:
+    - parts (list of tuple): (data, result, case_code) or (data, result, case_code, status) of each check, see `check_rows`.
+
+    Returns:
+    - ResultRows: Rows of all the checks, in order.
+    """
+    return ResultRows(pd.concat([check_rows(*part) for part in parts], ignore_index=True))
+
+
 #Test ID 01
-def check_inform_exit(data: pd.DataFrame, db: pd.DataFrame) -> tuple:
+@instrumented
+def check_inform_exit(data: pd.DataFrame, db: pd.DataFrame, status_index: AlienStatusIndex = None) -> tuple:
     """
     Check if a group of aliens has reported their departure from the company.
 
+    The latest record of each alien in `db` must be an 'MT_13_EXIT' report.
+
+    This differs from the earlier check, which merged every record of the alien and reported one
+    abnormal row per record that was not an 'MT_13_EXIT' report. An alien whose history has an older
+    non-exit record followed by a later exit is now normal (it was abnormal), and an abnormal MT_59
+    row is reported once, not once per non-exit record. This is the rule of `module_main.check_inform_exit`.
+
     Parameters:
     - data (pd.DataFrame): Current data.
     - db (pd.DataFrame): Historical data.
+    - status_index (AlienStatusIndex, optional): Latest-status index built from `db`. Built on the fly if omitted.
 
     Returns:
-    - tuple: A tuple containing a string indicating overall status ('normal' or 'abnormal'),
-             an integer count of abnormal entries, a list of ALIEN_IDs marked as 'normal',
-             and a list of ALIEN_IDs marked as 'abnormal'.
+    - dict: 'result' ('normal' or 'abnormal'), 'count_abnormal', and the abnormal MT_59 rows as 'rows'
+      (positions in `data`), 'abnormal' (all True) and 'reason' (see `check_rows`).
     """
-    abnormal_message =  "Aliens have not yet reported their departure from the old company."       
+    if status_index is None:
+        status_index = AlienStatusIndex(db)
 
-    data_filtered = data[data["MASTER_FORM_TYPE"] == "MT_59"]
-    data_filtered_alien_id = data_filtered["ALIEN_ID"].to_list()
-    db_filtered = db[db["ALIEN_ID"].isin(data_filtered_alien_id)]
-    db_filtered['status'] = db_filtered['MASTER_FORM_TYPE'].apply(lambda x: 'normal' if 'MT_13_EXIT' in x else 'abnormal')
+    positions = np.flatnonzero((data["MASTER_FORM_TYPE"] == "MT_59").to_numpy())
+    latest_form_type = status_index.latest_form_type(data["ALIEN_ID"].iloc[positions])
 
-    data_filtered = pd.merge(data_filtered, db_filtered[['ALIEN_ID', 'status']], on='ALIEN_ID', how='left')
-    data_filtered_abnormal = data_filtered[data_filtered["status"] == 'abnormal']
-    data_filtered_abnormal['abnormal_desc'] = abnormal_message
+    # Aliens without history are neither normal nor abnormal, as with the previous left merge
+    is_exit = latest_form_type.str.contains('MT_13_EXIT', regex=False, na=False).to_numpy()
+    is_abnormal = ~is_exit & latest_form_type.notna().to_numpy()
+    rows = positions[is_abnormal]
 
-    count_abnormal = data_filtered_abnormal.shape[0]
-    result = 'normal' if count_abnormal < data_filtered.shape[0] else 'abnormal'
+    count_abnormal = len(rows)
+    result = 'normal' if count_abnormal < len(positions) else 'abnormal'
 
-    return {'result': result,'count_abnormal': count_abnormal, 'data': data_filtered_abnormal}
+    return {'result': result, 'count_abnormal': count_abnormal, 'rows': rows, 'abnormal': np.ones(len(rows), dtype=bool), 'reason': 'inform_exit'}
     
     
+def job_limit_table(config_case) -> pd.Series:
+    """
+    Get the limit of each job of `config_case`, in config order ("N/A" applies to the jobs without their own entry).
+
+    A job listed several times keeps its strictest limit.
+    """
+    limits = pd.DataFrame(list(config_case), columns=['job', 'number'])
+    return limits.groupby('job', sort=False)['number'].min()
+
+
 #Test ID 02-05
-def check_job_limits(data, config_case):
+@instrumented
+def check_job_limits(data, config_case, engine=None):
     """
-    Check an employer hires more than 10 aliens for different types of work and positions.
+    Check each employer hires not more aliens for a type of work than the limit of that job.
+
+    The aliens of the MT_59 applications are counted per (EMPLOYER_NO, job) in a single groupby, where
+    the jobs without their own entry in `config_case` are counted together under "N/A". The limits are
+    mapped onto the counts through `job_limit_table`, and the rows are labelled with a join on the
+    (EMPLOYER_NO, job) pairs over their limit, so a whole population of employers is checked in one call.
+    Rows without a JOB_DESCRIPTION are counted under "N/A". `data` is not modified.
 
     Parameters:
     - data (pd.DataFrame): The input data containing job information.
     - config_case (list of dict): A list of dictionaries containing job configurations with 'job' and 'number' keys.
+    - engine (PandasEngine or SQLiteEngine, optional): Engine running the group counts (see flow/engine.py), pandas if omitted.
 
     Returns:
-    - str: 'normal' if all job counts are within limits, 'abnormal' otherwise.
+    - dict: 'result' ('normal' if some rows are within the limits), 'count_abnormal' (number of abnormal rows),
+      'job_abnormal' (jobs over their limit for some employer, followed by the "N/A" jobs of those employers when
+      "N/A" is over its limit), 'counts' (pd.DataFrame of ALIEN_COUNT and LIMIT per EMPLOYER_NO and JOB),
+      and every row of `data` as 'rows', 'abnormal' (rows of the pairs over their limit) and 'reason' (see `check_rows`).
     """
-    
-    abnormal_message =  "The employer hires more than 10 aliens for different types of work and positions."       
-    # Filter data based on form_id and master_form_type
-    data_case = data[data['MASTER_FORM_TYPE'] == 'MT_59']
-    
-    # Group by relevant columns and count the number of aliens per job
-    # data_case = data_case.groupby(['EMPLOYER_NO', 'FORM_ID', 'JOB_DESCRIPTION']).agg(ALIEN_COUNT=('ALIEN_ID', 'count')).reset_index()
-    
-    count_abnormal = 0
-    job_abnormal_list = []
-    
-    #all_jobs = [job_config['job'] for job_config in config_case]
-    specific_jobs = [job_config['job'] for job_config in config_case if job_config['job'] != "N/A"]
-    na_jobs = data_case[~data_case['JOB_DESCRIPTION'].isin(specific_jobs)]['JOB_DESCRIPTION'].unique()
-    
-    # Check each job configuration
-    for job_config in config_case:
-        job = job_config['job']
-        expected_number = job_config['number']
-        # Calculate the total count of aliens for the specified job
-        if job == "N/A":
-            # Calculate the sum of ALIEN_ID count for jobs not listed in specific_jobs
-            job_count = data_case[~data_case['JOB_DESCRIPTION'].isin(specific_jobs)]['ALIEN_ID'].count()
-        else:
-            job_count = data_case[data_case['JOB_DESCRIPTION'] == job]['ALIEN_ID'].count()
-            
-        # If the job count exceeds the expected number, return 'abnormal'
-        if job_count > expected_number:
-            count_abnormal += 1
-            job_abnormal_list.append(job)
-            
+    limits = job_limit_table(config_case)
+    specific_jobs = limits.index[limits.index != "N/A"]
+
+    # Job of each row as counted against the config: its own entry or the "N/A" catch-all
+    jobs = data['JOB_DESCRIPTION']
+    job_key = pd.Series(np.where(jobs.isin(specific_jobs), jobs.astype(object), "N/A"), index=data.index)
+    is_case = data['MASTER_FORM_TYPE'] == 'MT_59'
+
+    # Count the aliens per employer and job in one pass, then look up the limit of each job
+    if engine is None:
+        engine = PandasEngine(None)
+    counts = engine.job_counts(pd.DataFrame({
+        'EMPLOYER_NO': data.loc[is_case, 'EMPLOYER_NO'],
+        'JOB': job_key[is_case],
+        'ALIEN_ID': data.loc[is_case, 'ALIEN_ID'],
+    }))
+    counts['LIMIT'] = counts['JOB'].map(limits)
+    # Jobs without a limit (no "N/A" entry) are never over it
+    counts['abnormal'] = counts['ALIEN_COUNT'] > counts['LIMIT']
+
+    over = counts[counts['abnormal']]
+    job_abnormal_list = [job for job in limits.index if job in set(over['JOB'])]
     if "N/A" in job_abnormal_list:
-        job_abnormal_list.extend(na_jobs)
-    
-    data["status"] = data["JOB_DESCRIPTION"].apply(lambda x: 'normal' if not any(item in x for item in job_abnormal_list) else 'abnormal')        
-    data["abnormal_desc"] = data['status'].apply(lambda x: 'pass' if x == 'normal' else abnormal_message)
-    
-    
+        na_employers = over.loc[over['JOB'] == "N/A", 'EMPLOYER_NO']
+        na_rows = is_case & (job_key == "N/A") & data['EMPLOYER_NO'].isin(na_employers)
+        job_abnormal_list.extend(data.loc[na_rows, 'JOB_DESCRIPTION'].dropna().unique())
+
+    # Rows of the (employer, job) pairs over their limit
+    row_keys = pd.MultiIndex.from_arrays([data['EMPLOYER_NO'], job_key])
+    is_abnormal = row_keys.isin(pd.MultiIndex.from_frame(over[['EMPLOYER_NO', 'JOB']]))
+
     # If all job counts are within limits, return 'normal'
-    result = 'abnormal' if "normal" not in data["status"].to_list() else 'normal'
-    count_abnormal = data[data["status"] == "abnormal"].shape[0]
-    return {'result': result,'count_abnormal': count_abnormal, 'job_abnormal': job_abnormal_list, 'data': data}
+    result = 'abnormal' if is_abnormal.all() else 'normal'
+    count_abnormal = int(is_abnormal.sum())
+    return {'result': result, 'count_abnormal': count_abnormal, 'job_abnormal': job_abnormal_list, 'counts': counts,
+            'rows': np.arange(len(data)), 'abnormal': is_abnormal, 'reason': 'job_limits'}
 
 
 #Test ID 6
-def check_expire_condition(data, db):
+@instrumented
+def check_expire_condition(data, db, merged_id=None, expiry_index: ExpiryIndex = None):
     """
     remaining period between the application submission date and the expiration date of the work permit is less than or equal to 30 days.
 
     Parameters:
     - data (pd.DataFrame): The input data containing job information.
     - db (pd.DataFrame): The database containing exit information.
+    - merged_id (pd.DataFrame, optional): MT_59 rows of `data` merged with the MT_13_EXIT rows of `db` on ALIEN_ID
+      (see flow/plan.py). Computed if omitted.
+    - expiry_index (ExpiryIndex, optional): Expiry index of the MT_13_EXIT rows of `db` (or of a history containing them),
+      the exits of the applications are then found by binary search instead of a merge.
 
     Returns:
-    - str: 'normal' if the timestamp condition is met, 'abnormal' otherwise.
+    - dict: 'result' ('normal' if some application is more than 30 days before the expiry of the permit), 'count_abnormal',
+      and the rows of `data` of the aliens of the abnormal pairs as 'rows', 'abnormal' (all True) and 'reason' (see `check_rows`).
     """
-    # Filter data based on master_form_type
-    data_case = data[data['MASTER_FORM_TYPE'] == 'MT_59']
-    db_case = db[db['MASTER_FORM_TYPE'] == 'MT_13_EXIT']
-    
-    # Merge data and db on 'ALIEN_ID'
-    merged_id = pd.merge(data_case, db_case, on='ALIEN_ID', how='inner')
-    
-    # Convert timestamps to datetime
-    merged_id['CREATED_TIMESTAMP_x'] = pd.to_datetime(merged_id['CREATED_TIMESTAMP_x'])
-    merged_id['VALID_UNTIL_y'] = pd.to_datetime(merged_id['VALID_UNTIL_y'])
+    if expiry_index is not None and merged_id is None:
+        data_case = data[data['MASTER_FORM_TYPE'] == 'MT_59']
+        # One match per (application, exit record) pair, as the merge
+        target, valid_until = expiry_index.permits(data_case['ALIEN_ID'])
+        created = data_case['CREATED_TIMESTAMP'].to_numpy(dtype='datetime64[ns]')[target]
+        is_abnormal = (created + np.timedelta64(30, 'D')) > valid_until
+        aliens_abnormal_list = data_case['ALIEN_ID'].to_numpy()[target][is_abnormal]
+        return expire_result(data, len(target), aliens_abnormal_list)
+
+    if merged_id is None:
+        # Filter data based on master_form_type
+        data_case = data[data['MASTER_FORM_TYPE'] == 'MT_59']
+        db_case = db[db['MASTER_FORM_TYPE'] == 'MT_13_EXIT']
+
+        # Merge data and db on 'ALIEN_ID'
+        merged_id = pd.merge(data_case, db_case, on='ALIEN_ID', how='inner')
+        note_merge('merged_id', data_case, db_case, merged_id)
     
+    # Timestamps are parsed once at ingestion (see flow/schema.py)
     # Calculate the condition
-    merged_id['is_abnormal'] = (merged_id['CREATED_TIMESTAMP_x'] + pd.Timedelta(days=30)) > merged_id['VALID_UNTIL_y']
+    # The merge may be shared with other checks, it is not modified
+    is_abnormal = (merged_id['CREATED_TIMESTAMP_x'] + pd.Timedelta(days=30)) > merged_id['VALID_UNTIL_y']
     
-    aliens_abnormal_list = merged_id[merged_id['is_abnormal'] == True]["ALIEN_ID"]
+    aliens_abnormal_list = merged_id.loc[is_abnormal, "ALIEN_ID"]
+    return expire_result(data, len(merged_id), aliens_abnormal_list)
+
+
+def expire_result(data, n_pairs, aliens_abnormal_list) -> dict:
+    """
+    Build the result of `check_expire_condition` from the number of (application, exit) pairs and the aliens of the abnormal pairs.
+    """
     count_abnormal = len(aliens_abnormal_list)
-    data_abnormal = data[data["ALIEN_ID"].isin(aliens_abnormal_list)]
-    data_abnormal["status"] = "abnormal"
-    data_abnormal["abnormal_desc"] = "The application submission date and the expiration date of the work permit is less than or equal to 30 days."
-    
+    rows = np.flatnonzero(data["ALIEN_ID"].isin(aliens_abnormal_list).to_numpy())
+
     # Determine anomaly status
-    result = 'normal' if (len(merged_id["is_abnormal"]) - count_abnormal) > 0 else 'abnormal'
-    return {"result":result, "count_abnormal": count_abnormal, "data": data_abnormal} 
+    result = 'normal' if (n_pairs - count_abnormal) > 0 else 'abnormal'
+    return {"result": result, "count_abnormal": count_abnormal, "rows": rows, "abnormal": np.ones(len(rows), dtype=bool), "reason": "expire"}
 
 
 #Test ID 7 **remark similar test ID 1 instead
+@instrumented
 def check_status_resign_a(data, db):
     """
     Check aliens has not yet reported their departure from the old company but has already applied for the new one.
@@ -144,18 +238,21 @@ def check_status_resign_a(data, db):
     
     # Merge data and db on 'ALIEN_ID'
     merged_id = pd.merge(data_case, db, on='ALIEN_ID', how='inner',suffixes=('_A', '_B'))
+    note_merge('merged_id', data_case, db, merged_id)
     
     # Check if the required status is present in the merged data
     return 'abnormal' if 'MT_13_EXIT' not in merged_id['MASTER_FORM_TYPE_B'].values else 'normal'
 
 
 #Test ID 8 ***
-def check_status_resign_b(db):
+@instrumented
+def check_status_resign_b(db, status_index: AlienStatusIndex = None):
     """
     Check aliens has moved out of the company but has not yet reported their arrival at the new place.
 
     Parameters:
     - db (pd.DataFrame): The database containing status information.
+    - status_index (AlienStatusIndex, optional): Latest-status index built from `db`. Built on the fly if omitted.
 
     Returns:
     - str: 'normal' if the required status is not present, 'abnormal' otherwise.
@@ -164,84 +261,61 @@ def check_status_resign_b(db):
     # Ensure CREATED_TIMESTAMP is in datetime format
     # db['CREATED_TIMESTAMP'] = pd.to_datetime(db['CREATED_TIMESTAMP'])
 
-    # Get the index of the latest entry for each ALIEN_ID
-    latest_indices = db.loc[db.groupby('ALIEN_ID')['CREATED_TIMESTAMP'].idxmax()]
+    # Get the latest entry for each ALIEN_ID
+    if status_index is None:
+        status_index = AlienStatusIndex(db)
+    latest_indices = status_index.latest()
 
     # Filter based on MASTER_FORM_TYPE
-    ms_type_check = latest_indices[latest_indices['MASTER_FORM_TYPE'].isin(['MT_13_EXIT'])]
-    ms_type_check['status_check'] = ms_type_check['MASTER_FORM_TYPE'].apply(lambda x: 'normal' if x == 'MT_13_EXIT' else 'abnormal')
-    
-    count_abnormal = (ms_type_check['status_check'] == 'abnormal').sum()
+    ms_type_check = latest_indices.loc[latest_indices['MASTER_FORM_TYPE'].isin(['MT_13_EXIT']), 'MASTER_FORM_TYPE']
+
+    count_abnormal = (ms_type_check != 'MT_13_EXIT').sum()
     result = 'abnormal' if count_abnormal > 0 else 'normal'
     
     return {"result":result, "count_abnormal": count_abnormal} 
 
 
 #Test ID 16-21
-def check_relocate_condition_from_B(data, df, limit_count, limit_days):
+@instrumented
+def check_relocate_condition_from_B(data, df, limit_count, limit_days, by=None, groups=None):
     """
     Check if a group of aliens moved to location B within the limit of people and have been relocated for more than a specified number of days. 
 
+    Every `limit_days` window of the relocation history is checked, not only the one ending at the latest date.
+    A window is abnormal when its count reaches `limit_count`, see `find_relocation_windows` for how this
+    differs from the previous 90-day gate.
+
     Parameters:
+    - data (pd.DataFrame): Current data, every row is reported with the status of the check.
     - df (pd.DataFrame): DataFrame containing relocation data with 'CREATED_TIMESTAMP' and 'ALIEN_COUNT' columns.
-    - end_date (str or pd.Timestamp): The end date for the check in 'YYYY-MM-DD' format or as a Timestamp.
     - limit_count (int): The limit of people allowed to relocate.
     - limit_days (int): The number of days to check for relocation.
+    - by (list of str, optional): Group columns of `df` evaluated separately, e.g. ['EMPLOYER_NO'].
+    - groups (list-like, optional): Only windows of these `by` values are taken into account (single group column).
 
     Returns:
-    - str: A message indicating whether the condition is normal or abnormal.
+    - dict: 'result', 'count_abnormal' and 'total_relocate_day' of the worst offending window,
+      'windows' (pd.DataFrame) with every offending window, and every row of `data` as 'rows', 'abnormal' and 'reason' (see `check_rows`).
     """
-    count_abnormal = 0
-    df.sort_values(by = "CREATED_TIMESTAMP", ascending= False, inplace= True)
-    end_date = df.iloc[0]['CREATED_TIMESTAMP']
-    # Ensure CREATED_TIMESTAMP is in datetime format
-    df['CREATED_TIMESTAMP'] = pd.to_datetime(df['CREATED_TIMESTAMP'])
-
-    # If end_date is a Timestamp, convert it to datetime; otherwise, parse it
-    if isinstance(end_date, pd.Timestamp) or isinstance(end_date, pd.DatetimeIndex):
-        end_date = end_date.to_pydatetime()
+    windows = find_relocation_windows(df, limit_count, limit_days, by=by)
+    if groups is not None:
+        windows = windows[windows[by[0]].isin(groups)].reset_index(drop=True)
+    window = worst_window(windows)
+
+    if window is None:
+        result = 'normal'
+        count_abnormal = 0
+        total_relocate_day = "pass"
     else:
-        end_date = datetime.strptime(end_date, '%Y-%m-%d')
-    
-    # Calculate the start date for the two-month timeframe
-    start_date_time_frame = end_date - timedelta(days=90)
-    # Filter the DataFrame for the two-month timeframe
-    df_time_frame = df[(df['CREATED_TIMESTAMP'] >= start_date_time_frame) & (df['CREATED_TIMESTAMP'] <= end_date)]
-    # Calculate the total count within the two-month timeframe
-    total_count_time_frame = df_time_frame['ALIEN_COUNT'].sum()
-
-    # Check if the total count within the two-month timeframe exceeds the limit_count
-    if total_count_time_frame > limit_count:
-        # Calculate the start date by subtracting limit_days from end date
-        start_date = end_date - timedelta(days=limit_days - 1)
-        
-        # Filter the DataFrame between the calculated start date and the end date
-        filtered_df = df[(df['CREATED_TIMESTAMP'] >= start_date) & (df['CREATED_TIMESTAMP'] <= end_date)]
-        
-        # Calculate total count and number of days within the limit_days timeframe
-        total_count = filtered_df['ALIEN_COUNT'].sum()
-        total_days = (filtered_df['CREATED_TIMESTAMP'].max() - filtered_df['CREATED_TIMESTAMP'].min()).days + 1
-        # Check scenarios
-        if total_count < limit_count:
-            data["status"] = "normal"
-            data["abnormal_desc"] = "pass"
-        else:
-            if total_days <= limit_days:
-                data["status"] = "abnormal"
-                data["abnormal_desc"] = "Aliens moved to B exceeding the limit of people and have been relocated for more than a specified number of days."
-                count_abnormal = total_count
-            else:
-                data["status"] = "normal"
-                data["abnormal_desc"] = "pass"
-    else:
-        data["status"] = "normal"
-        data["abnormal_desc"] = "pass"
-        
-    result = 'normal' if count_abnormal < data.shape[0] else 'abnormal'    
-    total_relocate_day = "pass" if result == "normal" else total_days
-    return {'result': result,'count_abnormal': count_abnormal, 'total_relocate_day': total_relocate_day, 'data': data}
+        result = 'abnormal'
+        count_abnormal = window['ALIEN_COUNT']
+        total_relocate_day = window['TOTAL_DAYS']
+
+    return {'result': result, 'count_abnormal': count_abnormal, 'total_relocate_day': total_relocate_day, 'windows': windows,
+            'rows': np.arange(len(data)), 'abnormal': np.full(len(data), window is not None), 'reason': 'relocate'}
     
 #Test ID 9-14
+@instrumented
 def check_relocate_condition_from_A_to_B(data, db, config_case, EMPLOYER_NO_A, EMPLOYER_NO_B):
     """
     Check if a group of aliens moved from A to B exceeding the limit of people and have been relocated for more than a specified number of days.
@@ -254,7 +328,7 @@ def check_relocate_condition_from_A_to_B(data, db, config_case, EMPLOYER_NO_A, E
     - EMPLOYER_NO_B (str): Employer number for location B.
 
     Returns:
-    - tuple: A tuple containing the anomaly status and the merged DataFrame.
+    - dict: Result of `check_relocate_condition_from_B` on the relocations of each pair of employers ('rows' are positions in `data`).
     """
     # Filter for MT_13_EXIT at location A
     db_exit_filter = db[(db["EMPLOYER_NO"] == EMPLOYER_NO_A) & (db["MASTER_FORM_TYPE"] == "MT_13_EXIT")]
@@ -262,12 +336,41 @@ def check_relocate_condition_from_A_to_B(data, db, config_case, EMPLOYER_NO_A, E
     db_access_filter = data[(data["EMPLOYER_NO"] == EMPLOYER_NO_B) & (data["MASTER_FORM_TYPE"] == "MT_59")]
     # Merge on ALIEN_ID
     merged_alien_id = pd.merge(db_exit_filter, db_access_filter, on='ALIEN_ID', how='inner', suffixes=('_A', '_B'))
+    note_merge('merged_alien_id', db_exit_filter, db_access_filter, merged_alien_id)
 
     # Group by date and employer numbers
-    count_alien_date = merged_alien_id.groupby(['CREATED_TIMESTAMP_A', "EMPLOYER_NO_A", "EMPLOYER_NO_B"]).agg(
+    count_alien_date = merged_alien_id.groupby(['CREATED_TIMESTAMP_A', "EMPLOYER_NO_A", "EMPLOYER_NO_B"], observed=True).agg(
         ALIEN_COUNT=('ALIEN_ID', 'count')
     ).reset_index().rename(columns={'CREATED_TIMESTAMP_A': 'CREATED_TIMESTAMP'})
         
-    # Check relocation condition
-    result = check_relocate_condition_from_B(data, count_alien_date, config_case['number'], config_case['day'])
-    return result
\ No newline at end of file
+    # Check relocation condition for each pair of employers
+    result = check_relocate_condition_from_B(data, count_alien_date, config_case['number'], config_case['day'],
+                                             by=['EMPLOYER_NO_A', 'EMPLOYER_NO_B'])
+    return result
+
+
+#Test ID 9-14, all pairs
+@instrumented
+def check_relocate_condition_all_pairs(data, db, config_case, matrix: TransitionMatrix = None):
+    """
+    Check every pair of employers for groups of aliens moved from A to B exceeding the limit of people within the number of days.
+
+    Unlike `check_relocate_condition_from_A_to_B`, the pair does not need to be known: the MT_13_EXIT
+    records are joined to the MT_59 applications once and the thresholds are run over all pairs together.
+
+    Parameters:
+    - data (pd.DataFrame): DataFrame containing access preparation data.
+    - db (pd.DataFrame): DataFrame containing exit preparation data.
+    - config_case (dict): Configuration case containing 'number' and 'day' keys.
+    - matrix (TransitionMatrix, optional): Prebuilt transition matrix of `data` and `db`.
+
+    Returns:
+    - dict: 'result' ('normal' or 'abnormal'), 'count_abnormal' (number of violating pairs)
+      and 'pairs' (pd.DataFrame of the violating pairs with their worst window).
+    """
+    if matrix is None:
+        matrix = TransitionMatrix(data, db)
+    pairs = matrix.find_violating_pairs(config_case['number'], config_case['day'])
+
+    result = 'abnormal' if len(pairs) > 0 else 'normal'
+    return {'result': result, 'count_abnormal': len(pairs), 'pairs': pairs}
@@ -0,0 +1,374 @@
+import heapq
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+
+from .cases import case_history
+from .plan import ExecutionPlan, run_flows
+from .result import ResultRows
+from .schema import decode
+
+# Frames attached by the worker: the history once per worker, the current data once per run
+worker_frames = {}
+
+# Case key column of the grouped flows, the position of the group in the run
+group_key = 'GROUP'
+
+
+
+class SharedFrame:
+    """
+    DataFrame whose column buffers are placed in one shared memory block, so worker processes read them without copies.
+
+    Numeric and datetime columns are stored as they are. Text columns are stored as categorical codes,
+    their categories travel with the `handle` (once per worker for the history). Attached frames are
+    read-only views of the block.
+
+    Parameters:
+    - frame (pd.DataFrame): Frame to share.
+
+    Example:
+        shared = SharedFrame(db)
+        db_view = SharedFrame.attach(shared.handle)  # in a worker
+        shared.close()
+    """
+
+    def __init__(self, frame: pd.DataFrame):
+        columns, arrays = [], []
+        offset = 0
+        for name in frame.columns:
+            column = frame[name]
+            categories = None
+            if pd.api.types.is_datetime64_any_dtype(column.dtype):
+                values = column.to_numpy(dtype='datetime64[ns]')
+            elif pd.api.types.is_numeric_dtype(column.dtype) and not isinstance(column.dtype, pd.CategoricalDtype):
+                values = column.to_numpy()
+            else:
+                codes = column if isinstance(column.dtype, pd.CategoricalDtype) else column.astype('category')
+                values, categories = codes.cat.codes.to_numpy(), codes.cat.categories
+            columns.append({'name': name, 'dtype': values.dtype.str, 'offset': offset, 'categories': categories})
+            arrays.append(values)
+            # 8-byte aligned buffers
+            offset += -(-values.nbytes // 8) * 8
+        self.memory = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+        for spec, values in zip(columns, arrays):
+            np.ndarray(len(values), dtype=values.dtype, buffer=self.memory.buf, offset=spec['offset'])[:] = values
+        self.handle = {'name': self.memory.name, 'rows': len(frame), 'columns': columns}
+
+    @staticmethod
+    def attach(handle) -> tuple:
+        """
+        Get the frame of a handle in another process.
+
+        Returns:
+        - tuple: (frame (pd.DataFrame), memory (SharedMemory) that must be kept open while the frame is used).
+        """
+        # The block stays registered to the resource tracker of the creating process (shared by its pool),
+        # which unlinks it in `close`
+        memory = shared_memory.SharedMemory(name=handle['name'])
+        columns = {}
+        for spec in handle['columns']:
+            values = np.ndarray(handle['rows'], dtype=np.dtype(spec['dtype']), buffer=memory.buf, offset=spec['offset'])
+            values.flags.writeable = False
+            if spec['categories'] is not None:
+                values = pd.Categorical.from_codes(values, categories=spec['categories'], validate=False)
+            columns[spec['name']] = values
+        return pd.DataFrame(columns, copy=False), memory
+
+    def close(self):
+        self.memory.close()
+        self.memory.unlink()
+
+
+def attach_frame(key, handle) -> pd.DataFrame:
+    """
+    Get a shared frame in a worker, attaching it on first use (the previous frame of `key` is released).
+    """
+    if key not in worker_frames or worker_frames[key][0] != handle['name']:
+        if key in worker_frames:
+            _, frame, memory = worker_frames.pop(key)
+            del frame
+            try:
+                memory.close()
+            except BufferError:
+                # Views of the block are still referenced, it is closed when they are collected
+                pass
+        frame, memory = SharedFrame.attach(handle)
+        worker_frames[key] = (handle['name'], frame, memory)
+    return worker_frames[key][1]
+
+
+def init_worker(db_handle):
+    attach_frame('db', db_handle)
+
+
+def employer_components(employers, pairs) -> dict:
+    """
+    Group employers linked by (EMPLOYER_NO_A, EMPLOYER_NO_B) pairs into connected components.
+
+    Returns:
+    - dict: Component (the first employer of the component found) of each employer.
+    """
+    parent = {employer: employer for employer in employers}
+
+    def find(employer):
+        parent.setdefault(employer, employer)
+        while parent[employer] != employer:
+            parent[employer] = parent[parent[employer]]
+            employer = parent[employer]
+        return employer
+
+    for employer_a, employer_b in pairs:
+        root_a, root_b = find(employer_a), find(employer_b)
+        if root_a != root_b:
+            parent[root_b] = root_a
+    return {employer: find(employer) for employer in list(parent)}
+
+
+def group_rows(frame, group) -> pd.DataFrame:
+    """
+    Tag the result rows of one group with its position in the run.
+    """
+    frame = frame.copy()
+    frame[group_key] = group
+    return frame
+
+
+def run_groups(flow, groups, data, history, config) -> tuple:
+    """
+    Run one flow on every group of a shard with its grouped variant (`flow_1_cases`, `flow_2_cases` or
+    `flow_4_cases`), the position of the group in the run being the case key.
+
+    Returns:
+    - tuple: (cases (pd.DataFrame) with the `group_key` and the summary of each group, rows (pd.DataFrame) of all groups with their `group_key`).
+    """
+    from .flow1 import flow_1_cases
+    from .flow2 import flow_2_cases
+    from .flow4 import flow_4_cases
+
+    if flow == 'flow1':
+        result = flow_1_cases(data, history, config, group_key)
+    elif flow == 'flow2':
+        cases = pd.DataFrame([{**config, group_key: group['group'], 'EMPLOYER_NO_A': group['employer_no_a'],
+                               'EMPLOYER_NO_B': group['employer_no_b']} for group in groups])
+        result = flow_2_cases(data, history, cases, group_key)
+    else:
+        result = flow_4_cases(data, history, config, group_key)
+    return result['cases'], result['data'].to_frame()
+
+
+def run_each(flow, groups, data, history, config) -> tuple:
+    """
+    Run one flow on the groups of a shard one at a time, as `run_groups`, an error only failing its group.
+    """
+    summaries, frames = [], []
+    for group in groups:
+        group_data = data[data[group_key].to_numpy() == group['group']].drop(columns=group_key).reset_index(drop=True)
+        db_rows = history[history[group_key].to_numpy() == group['group']].drop(columns=group_key).reset_index(drop=True)
+        try:
+            result = run_flows(ExecutionPlan(group_data, db_rows), {flow: config}, group.get('employer_no_a'), group.get('employer_no_b'))[flow]
+            summaries.append({group_key: group['group'], **{key: value for key, value in result.items() if key != 'data'}, 'error': None})
+            frames.append(group_rows(result['data'].to_frame(), group['group']))
+        except Exception as error:
+            summaries.append({group_key: group['group'], 'status': 'error', 'count_abnormal': 0, 'error': f"{type(error).__name__}: {error}"})
+    return pd.DataFrame(summaries), pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=[group_key])
+
+
+def run_shard(data_handle, groups, config) -> dict:
+    """
+    Run the flows on the groups of one shard, in a worker.
+
+    The history rows of the shard (its aliens and employers) are selected once with one pass over
+    the shared history. Each flow then runs once on all the groups of the shard (`run_groups`), with
+    the rows of each group (`case_history`). When a grouped run fails, the groups of that flow are run
+    one by one with `run_flows`, so only the failing group gets an 'error'.
+
+    Parameters:
+    - data_handle (dict): `SharedFrame` handle of the current data.
+    - groups (list of dict): 'group' position of the group in the run, 'positions' of its rows in the data,
+      its 'flows', and 'employer_no_a' and 'employer_no_b' for flow 2.
+    - config (dict): Config case of each flow.
+
+    Returns:
+    - dict: (cases, rows) of each flow run on the shard, see `run_groups`, the cases with an 'error' column.
+    """
+    data, db = attach_frame('data', data_handle), worker_frames['db'][1]
+    positions = np.concatenate([group['positions'] for group in groups])
+    flow4_positions = np.concatenate([group['positions'] for group in groups if 'flow4' in group['flows']] or [np.array([], dtype=np.int64)])
+    selected = db['ALIEN_ID'].isin(data['ALIEN_ID'].take(positions)) | db['EMPLOYER_NO'].isin(data['EMPLOYER_NO'].take(flow4_positions))
+    # The rows of the shard are copied out of the shared frames as plain columns, the categories
+    # of the whole history would make every operation on the rows of the shard slower
+    shard_db = decode(db[selected.to_numpy()]).reset_index(drop=True)
+
+    outputs = {}
+    for flow in ['flow1', 'flow2', 'flow4']:
+        members = [group for group in groups if flow in group['flows']]
+        if not members:
+            continue
+        flow_data = decode(data.take(np.concatenate([group['positions'] for group in members])).reset_index(drop=True))
+        flow_data[group_key] = np.repeat([group['group'] for group in members], [len(group['positions']) for group in members])
+        employer_groups = [group['group'] for group in members] if flow == 'flow4' else ()
+        history = case_history(flow_data, shard_db, group_key, employer_groups)
+        try:
+            cases, rows = run_groups(flow, members, flow_data, history, config[flow])
+            cases['error'] = None
+        except Exception:
+            cases, rows = run_each(flow, members, flow_data, history, config[flow])
+        outputs[flow] = (cases, rows)
+    return outputs
+
+
+def merge_results(keys, outputs) -> dict:
+    """
+    Merge the results of one flow over all groups.
+
+    Parameters:
+    - keys (pd.DataFrame): Key columns of each group of the flow, indexed by the position of the group in the run.
+    - outputs (list of tuple): (cases, rows) of the flow on each shard (see `run_shard`).
+
+    Returns:
+    - dict: 'status' ('abnormal' if some group is abnormal), 'count_abnormal' (sum over the groups),
+      'groups' (pd.DataFrame with the key columns, 'status', 'message', 'count_abnormal' and 'error' of each group)
+      and 'data' (ResultRows of all groups, group after group).
+    """
+    cases = pd.concat([cases for cases, _ in outputs] or [pd.DataFrame(columns=[group_key])], ignore_index=True).set_index(group_key)
+    groups = keys.join(cases.reindex(columns=['status', 'message', 'count_abnormal', 'error'])).reset_index(drop=True)
+    groups['count_abnormal'] = groups['count_abnormal'].fillna(0).astype(np.int64)
+    rows = pd.concat([rows for _, rows in outputs if len(rows)], ignore_index=True) if any(len(rows) for _, rows in outputs) else pd.DataFrame()
+    if len(rows):
+        # Stable sort: the rows of a group keep their order
+        rows = rows.sort_values(group_key, kind='mergesort', ignore_index=True).drop(columns=group_key)
+    return {
+        'status': 'abnormal' if (groups['status'] == 'abnormal').any() else 'normal',
+        'count_abnormal': int(groups['count_abnormal'].sum()),
+        'groups': groups,
+        'data': ResultRows(rows),
+    }
+
+
+class ParallelRunner:
+    """
+    Run the flows on a process pool, per employer group.
+
+    This is a different API from running `flow_1`, `flow_2` or `flow_4` on the whole data: the
+    applications of each employer are a group evaluated on their own, with the history rows of
+    their aliens and employer, as `IncrementalEvaluator` does for a batch, and each group gets its
+    own status. The flows on the whole data give a single status, e.g. flow 1 is normal as long as
+    some alien of the batch has reported their departure, so their result is not the merge of the
+    group results. Flow 1 and flow 4 are grouped by EMPLOYER_NO, flow 2 by (EMPLOYER_NO_A,
+    EMPLOYER_NO_B) pair with the applications of employer B.
+
+    Each shard runs each flow once on all its groups with the grouped flows (`run_groups`), the
+    groups being the cases. Employers linked by a pair form one connected component, and the
+    components are spread over `shards_per_worker` shards per worker by number of applications,
+    so the history rows of an employer are only selected in one shard.
+
+    The history is placed in shared memory once (`SharedFrame`) and attached by every worker at start,
+    the data of each run is shared the same way, so no frame is pickled to the workers.
+    The results of the groups are merged into one result per flow (`merge_results`).
+
+    Parameters:
+    - db (pd.DataFrame): Historical data.
+    - workers (int, optional): Number of worker processes, the number of CPUs if omitted. 0 runs the shards in this process.
+    - shards_per_worker (int): Number of shards per worker, more shards balance uneven employers better.
+
+    Example:
+        with ParallelRunner(db, workers=4) as runner:
+            results = runner.run(data, {"flow1": config_flow1, "flow4": config_flow4})
+        results["flow4"]["groups"]
+    """
+
+    def __init__(self, db: pd.DataFrame, workers=None, shards_per_worker=4):
+        self.workers = os.cpu_count() if workers is None else workers
+        self.shards_per_worker = shards_per_worker
+        self.db = SharedFrame(db)
+        self.executor = None
+        if self.workers > 0:
+            self.executor = ProcessPoolExecutor(self.workers, initializer=init_worker, initargs=(self.db.handle,))
+        else:
+            init_worker(self.db.handle)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        self.db.close()
+
+    def make_groups(self, data, config, pairs) -> tuple:
+        """
+        Get the groups of a run and the key of each of them.
+        """
+        groups, keys = [], []
+        rows_of = data.groupby('EMPLOYER_NO', observed=True, sort=False).indices
+        flows = [flow for flow in ['flow1', 'flow4'] if flow in config]
+        if flows:
+            for employer, positions in rows_of.items():
+                groups.append({'group': len(groups), 'employer': employer, 'positions': positions, 'flows': flows})
+                keys.append({'EMPLOYER_NO': employer})
+        if 'flow2' in config:
+            for employer_a, employer_b in pairs or []:
+                if employer_b in rows_of:
+                    groups.append({'group': len(groups), 'employer': employer_b, 'positions': rows_of[employer_b], 'flows': ['flow2'],
+                                   'employer_no_a': employer_a, 'employer_no_b': employer_b})
+                    keys.append({'EMPLOYER_NO_A': employer_a, 'EMPLOYER_NO_B': employer_b})
+        return groups, keys
+
+    def make_shards(self, groups, pairs) -> list:
+        """
+        Spread the groups over the shards, by connected component of employers, largest components first.
+        """
+        component_of = employer_components([group['employer'] for group in groups], pairs or [])
+        components = {}
+        for i, group in enumerate(groups):
+            components.setdefault(component_of[group['employer']], []).append(i)
+        n_shards = max(self.workers, 1) * self.shards_per_worker
+        # (applications, shard) of the least loaded shard first
+        loads = [(0, shard) for shard in range(n_shards)]
+        shards = [[] for _ in range(n_shards)]
+        sizes = {component: sum(len(groups[i]['positions']) for i in members) for component, members in components.items()}
+        for component in sorted(components, key=sizes.get, reverse=True):
+            load, shard = heapq.heappop(loads)
+            shards[shard].extend(components[component])
+            heapq.heappush(loads, (load + sizes[component], shard))
+        return [sorted(shard) for shard in shards if shard]
+
+    def run(self, data: pd.DataFrame, config, pairs=None) -> dict:
+        """
+        Run the flows of `config` on every employer group of `data`, each group on its own (see `ParallelRunner`).
+
+        Parameters:
+        - data (pd.DataFrame): Current data.
+        - config (dict): Config case of each flow to run, keyed by "flow1", "flow2" and "flow4".
+        - pairs (list of tuple, optional): (EMPLOYER_NO_A, EMPLOYER_NO_B) pairs checked by flow 2.
+
+        Returns:
+        - dict: Merged result of each flow that was run (see `merge_results`), keyed by "flow1", "flow2" and "flow4".
+        """
+        groups, keys = self.make_groups(data.reset_index(drop=True), config, pairs)
+        shards = self.make_shards(groups, pairs)
+        shared = SharedFrame(data.reset_index(drop=True))
+        try:
+            tasks = [(shared.handle, [groups[i] for i in shard], config) for shard in shards]
+            if self.executor is None:
+                outputs = [run_shard(*task) for task in tasks]
+            else:
+                outputs = list(self.executor.map(run_shard, *zip(*tasks))) if tasks else []
+        finally:
+            shared.close()
+
+        merged = {}
+        for flow in ['flow1', 'flow2', 'flow4']:
+            members = [i for i, group in enumerate(groups) if flow in group['flows']]
+            if flow in config:
+                merged[flow] = merge_results(pd.DataFrame([keys[i] for i in members], index=members),
+                                             [output[flow] for output in outputs if flow in output])
+        return merged
@@ -0,0 +1,256 @@
+import json
+import os
+import zlib
+
+import numpy as np
+import pandas as pd
+
+from .lookup import find_positions, key_values, sorted_lookup
+from .schema import decode
+from .snapshot_cache import to_arrow_table
+
+
+def employer_buckets(employers, n_buckets) -> np.ndarray:
+    """
+    Get the bucket of each EMPLOYER_NO: CRC-32 of its text modulo `n_buckets`, the same in every process and run.
+    """
+    uniques, inverse = np.unique(key_values(employers), return_inverse=True)
+    buckets = np.array([zlib.crc32(value.encode('utf-8')) % n_buckets for value in uniques], dtype=np.int64)
+    return buckets[inverse]
+
+
+def month_keys(timestamps) -> np.ndarray:
+    """
+    Get the 'YYYY-MM' month of each CREATED_TIMESTAMP ('none' for missing dates).
+    """
+    timestamps = pd.to_datetime(pd.Series(timestamps))
+    months = (timestamps.dt.year * 100 + timestamps.dt.month).fillna(0).astype(np.int64).to_numpy()
+    uniques, inverse = np.unique(months, return_inverse=True)
+    names = np.array(['none' if month == 0 else f"{month // 100:04d}-{month % 100:02d}" for month in uniques], dtype=object)
+    return names[inverse]
+
+
+class PartitionedHistory:
+    """
+    On-disk store of the prepped history, partitioned by month of CREATED_TIMESTAMP and bucketed by EMPLOYER_NO.
+
+    Each append writes new Parquet files under 'month=YYYY-MM/bucket=NN/', one per partition touched,
+    sorted by ALIEN_ID, and an ALIEN_ID -> file index of those files; existing files are never
+    rewritten. A manifest lists the files with their month and bucket and is replaced atomically
+    after each append.
+
+    Queries push their predicates down: the month range and the buckets of the employers select
+    the partitions, the ALIEN_ID index selects the files of the requested aliens (who are spread
+    over all months and employers), and the remaining predicates are given to the Parquet reader,
+    which skips row groups by their statistics. Rows come back in history order, so the checks
+    see the same rows as with the frame.
+
+    Parameters:
+    - path (str): Directory of the store, created if missing. An existing store keeps its number of buckets.
+    - n_buckets (int): Number of EMPLOYER_NO buckets of a new store.
+    - row_group_size (int): Rows per Parquet row group.
+
+    Example:
+        history = PartitionedHistory(".history")
+        history.append(db)
+        history.query(employers=["10000001"], form_types=["MT_13_EXIT"], start="2024-06-01")
+        history.rows_for(alien_ids=data["ALIEN_ID"].unique(), employers=data["EMPLOYER_NO"].unique(), start="2024-05-12")
+    """
+
+    def __init__(self, path, n_buckets=16, row_group_size=65_536):
+        self.path = path
+        self.row_group_size = row_group_size
+        self.last_scan = None
+        manifest_path = os.path.join(path, 'manifest.json')
+        if os.path.exists(manifest_path):
+            with open(manifest_path, encoding='utf-8') as f:
+                self.manifest = json.load(f)
+        else:
+            os.makedirs(path, exist_ok=True)
+            self.manifest = {'n_buckets': n_buckets, 'next_row_id': 0, 'next_file': 0, 'columns': None, 'files': [], 'alien_indexes': []}
+        self.alien_lookup = None
+        self.alien_indexes_loaded = 0
+
+    @property
+    def n_buckets(self):
+        return self.manifest['n_buckets']
+
+    def __len__(self):
+        return sum(entry['rows'] for entry in self.manifest['files'])
+
+    def save_manifest(self):
+        tmp_path = os.path.join(self.path, f"manifest.json.{os.getpid()}.tmp")
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.manifest, f)
+        os.replace(tmp_path, os.path.join(self.path, 'manifest.json'))
+
+    def append(self, rows: pd.DataFrame) -> int:
+        """
+        Write new rows to new files of their partitions.
+
+        Returns:
+        - int: Number of files written.
+        """
+        import pyarrow.parquet as pq
+
+        if rows.empty:
+            return 0
+        rows = decode(rows).reset_index(drop=True)
+        # ROW_ID keeps the history order across partitions
+        rows['ROW_ID'] = np.arange(len(rows), dtype=np.int64) + self.manifest['next_row_id']
+        if self.manifest['columns'] is None:
+            self.manifest['columns'] = [c for c in rows.columns if c != 'ROW_ID']
+
+        partitions = pd.DataFrame({
+            'month': month_keys(rows['CREATED_TIMESTAMP']),
+            'bucket': employer_buckets(rows['EMPLOYER_NO'], self.n_buckets),
+        })
+        alien_keys = key_values(rows['ALIEN_ID'])
+        first_file = len(self.manifest['files'])
+        file_of_row = np.empty(len(rows), dtype=np.int64)
+        n_files = 0
+        for (month, bucket), positions in partitions.groupby(['month', 'bucket']).indices.items():
+            # Sorted by ALIEN_ID, so the row group statistics can skip the other aliens
+            positions = positions[np.argsort(alien_keys[positions], kind='mergesort')]
+            directory = os.path.join(f"month={month}", f"bucket={bucket:02d}")
+            name = os.path.join(directory, f"part-{self.manifest['next_file']:06d}.parquet")
+            os.makedirs(os.path.join(self.path, directory), exist_ok=True)
+            tmp_path = os.path.join(self.path, f"{name}.{os.getpid()}.tmp")
+            pq.write_table(to_arrow_table(rows.take(positions)), tmp_path, row_group_size=self.row_group_size)
+            os.replace(tmp_path, os.path.join(self.path, name))
+            file_of_row[positions] = len(self.manifest['files'])
+            self.manifest['files'].append({'path': name, 'month': month, 'bucket': int(bucket), 'rows': len(positions)})
+            self.manifest['next_file'] += 1
+            n_files += 1
+
+        # ALIEN_ID -> file index of this append
+        pairs = pd.DataFrame({'key': alien_keys, 'file': file_of_row}).drop_duplicates()
+        index_name = f"aliens-{first_file:06d}.npz"
+        np.savez(os.path.join(self.path, index_name), keys=pairs['key'].to_numpy(dtype=str), files=pairs['file'].to_numpy())
+        self.manifest['alien_indexes'].append(index_name)
+        self.manifest['next_row_id'] += len(rows)
+        self.save_manifest()
+        return n_files
+
+    def alien_files(self, alien_ids) -> set:
+        """
+        Get the positions (in the manifest) of the files holding rows of some aliens.
+
+        The ALIEN_ID indexes of the appends are loaded once and merged into one sorted lookup.
+        """
+        names = self.manifest['alien_indexes']
+        if self.alien_indexes_loaded < len(names):
+            keys, files = [], []
+            if self.alien_lookup is not None:
+                keys.append(self.alien_lookup[0])
+                files.append(self.alien_lookup[1])
+            for name in names[self.alien_indexes_loaded:]:
+                with np.load(os.path.join(self.path, name)) as index:
+                    keys.append(index['keys'])
+                    files.append(index['files'])
+            sorted_keys, order = sorted_lookup(np.concatenate(keys))
+            # Sorted keys with the file of each of them
+            self.alien_lookup = (sorted_keys, np.concatenate(files)[order])
+            self.alien_indexes_loaded = len(names)
+        if self.alien_lookup is None:
+            return set()
+        sorted_keys, files = self.alien_lookup
+        positions = find_positions((sorted_keys, np.arange(len(sorted_keys))), key_values(alien_ids))
+        return set(files[positions].tolist())
+
+    def select_files(self, alien_ids=None, employers=None, start=None, end=None) -> list:
+        """
+        Get the manifest entries of the files that can hold rows matching the predicates.
+        """
+        selected = list(enumerate(self.manifest['files']))
+        if start is not None or end is not None:
+            first = '0000-00' if start is None else pd.Timestamp(start).strftime('%Y-%m')
+            last = '9999-12' if end is None else pd.Timestamp(end).strftime('%Y-%m')
+            selected = [(i, entry) for i, entry in selected if entry['month'] != 'none' and first <= entry['month'] <= last]
+        if employers is not None:
+            buckets = set(employer_buckets(employers, self.n_buckets).tolist())
+            selected = [(i, entry) for i, entry in selected if entry['bucket'] in buckets]
+        if alien_ids is not None:
+            positions = self.alien_files(alien_ids)
+            selected = [(i, entry) for i, entry in selected if i in positions]
+        return [entry for _, entry in selected]
+
+    def query(self, alien_ids=None, employers=None, form_types=None, start=None, end=None, columns=None) -> pd.DataFrame:
+        """
+        Read the rows matching all the given predicates, in history order.
+
+        Parameters:
+        - alien_ids (list-like, optional): ALIEN_IDs to keep.
+        - employers (list-like, optional): EMPLOYER_NOs to keep.
+        - form_types (list-like, optional): MASTER_FORM_TYPEs to keep.
+        - start (str or pd.Timestamp, optional): First CREATED_TIMESTAMP to keep.
+        - end (str or pd.Timestamp, optional): End of the CREATED_TIMESTAMP range (excluded).
+        - columns (list of str, optional): Columns to read, all if omitted.
+
+        Returns:
+        - pd.DataFrame: Matching rows. `last_scan` holds the number of files read and in the store.
+        """
+        import pyarrow.parquet as pq
+
+        filters = []
+        if alien_ids is not None:
+            filters.append(('ALIEN_ID', 'in', list(np.unique(key_values(alien_ids)))))
+        if employers is not None:
+            filters.append(('EMPLOYER_NO', 'in', list(np.unique(key_values(employers)))))
+        if form_types is not None:
+            filters.append(('MASTER_FORM_TYPE', 'in', list(form_types)))
+        if start is not None:
+            filters.append(('CREATED_TIMESTAMP', '>=', pd.Timestamp(start)))
+        if end is not None:
+            filters.append(('CREATED_TIMESTAMP', '<', pd.Timestamp(end)))
+
+        files = self.select_files(alien_ids, employers, start, end)
+        columns = list(self.manifest['columns'] or []) if columns is None else list(columns)
+        frames = [
+            pq.read_table(os.path.join(self.path, entry['path']), columns=columns + ['ROW_ID'], filters=filters or None).to_pandas()
+            for entry in files
+        ]
+        self.last_scan = {'files_read': len(files), 'files_total': len(self.manifest['files'])}
+        frames = [frame for frame in frames if len(frame)]
+        if not frames:
+            return pd.DataFrame(columns=columns)
+        rows = pd.concat(frames, ignore_index=True).sort_values('ROW_ID', kind='mergesort', ignore_index=True)
+        return rows.drop(columns='ROW_ID')
+
+    def rows_for(self, alien_ids=(), employers=(), start=None) -> pd.DataFrame:
+        """
+        Get the history rows of some aliens or employers, in history order (as `HistoryStore.rows_for`).
+
+        Parameters:
+        - alien_ids (list-like): ALIEN_IDs to look up, their rows are read whatever their date.
+        - employers (list-like): EMPLOYER_NOs to look up.
+        - start (str or pd.Timestamp, optional): First CREATED_TIMESTAMP of the rows of the employers, e.g. the start of
+          the relocation window of a batch (see `ExecutionPlan`). The months before it are not read for the employers.
+
+        Returns:
+        - pd.DataFrame: Rows matching any of the aliens or employers.
+        """
+        import pyarrow.parquet as pq
+
+        # Files of the requested aliens or of the buckets (and months) of the requested employers, each read once
+        files = {}
+        predicates = []
+        if len(alien_ids):
+            files.update((entry['path'], entry) for entry in self.select_files(alien_ids=alien_ids))
+            predicates.append([('ALIEN_ID', 'in', list(np.unique(key_values(alien_ids))))])
+        if len(employers):
+            files.update((entry['path'], entry) for entry in self.select_files(employers=employers, start=start))
+            predicates.append([('EMPLOYER_NO', 'in', list(np.unique(key_values(employers))))]
+                              + ([('CREATED_TIMESTAMP', '>=', pd.Timestamp(start))] if start is not None else []))
+        columns = list(self.manifest['columns'] or [])
+        self.last_scan = {'files_read': len(files), 'files_total': len(self.manifest['files'])}
+        if not files:
+            return pd.DataFrame(columns=columns)
+
+        # Disjunctive filters: a row is kept if it matches the aliens or the employers
+        frames = [
+            pq.read_table(os.path.join(self.path, path), columns=columns + ['ROW_ID'], filters=predicates).to_pandas()
+            for path in sorted(files)
+        ]
+        rows = pd.concat(frames, ignore_index=True).sort_values('ROW_ID', kind='mergesort', ignore_index=True)
+        return rows.drop(columns='ROW_ID')
@@ -0,0 +1,195 @@
+import pandas as pd
+
+from .engine import PandasEngine
+from .expiry_index import ExpiryIndex
+from .module import check_expire_condition, check_inform_exit
+from .status_index import AlienStatusIndex
+
+# Intermediate name -> (function, names of its inputs). 'data' and 'db' are the inputs of the plan.
+nodes = {}
+
+
+def node(name, *inputs):
+    """
+    Register the function computing the intermediate `name` from the intermediates `inputs`.
+    """
+    def register(function):
+        nodes[name] = (function, inputs)
+        return function
+    return register
+
+
+@node('db', 'data', 'store', 'history_start')
+def history(data, store, history_start):
+    # Rows of the history the batch can affect: every row of its aliens, the rows of its employers from `history_start`
+    return store.rows_for(alien_ids=data['ALIEN_ID'].unique(), employers=data['EMPLOYER_NO'].unique(), start=history_start)
+
+
+@node('engine', 'db')
+def engine(db):
+    return PandasEngine(db)
+
+
+@node('status_index', 'engine')
+def status_index(engine):
+    return engine.status_index()
+
+
+@node('inform_exit', 'data', 'db', 'status_index')
+def inform_exit(data, db, status_index):
+    return check_inform_exit(data, db, status_index)
+
+
+@node('dropped_aliens', 'data', 'inform_exit')
+def dropped_aliens(data, inform_exit):
+    # Aliens who have not reported their departure are left out of the following checks
+    return data['ALIEN_ID'].take(inform_exit['rows']).unique()
+
+
+@node('data_case', 'data', 'dropped_aliens')
+def data_case(data, dropped_aliens):
+    return data[~data['ALIEN_ID'].isin(dropped_aliens)]
+
+
+@node('expiry_index', 'engine')
+def expiry_index(engine):
+    return engine.expiry_index()
+
+
+@node('data_case_mt59', 'data_case')
+def data_case_mt59(data_case):
+    return data_case[data_case['MASTER_FORM_TYPE'] == 'MT_59']
+
+
+@node('db_case_exits', 'data_case_mt59', 'expiry_index')
+def db_case_exits(data_case_mt59, expiry_index):
+    # Exit records of the applicants, one per (application, exit) pair, found in the index instead of a scan of db.
+    # The index may cover dropped aliens, they are not in data_case either
+    return expiry_index.records(data_case_mt59['ALIEN_ID'])
+
+
+@node('exit_merge', 'data_case_mt59', 'db_case_exits')
+def exit_merge(data_case_mt59, db_case_exits):
+    # Columns of the inner merge on ALIEN_ID used by the expire check, taken at the positions of the pairs
+    target = db_case_exits['TARGET'].to_numpy()
+    return pd.DataFrame({
+        'ALIEN_ID': data_case_mt59['ALIEN_ID'].to_numpy()[target],
+        'CREATED_TIMESTAMP_x': data_case_mt59['CREATED_TIMESTAMP'].to_numpy(dtype='datetime64[ns]')[target],
+        'VALID_UNTIL_y': db_case_exits['VALID_UNTIL'].to_numpy(),
+    })
+
+
+@node('expire', 'data_case', 'db', 'exit_merge')
+def expire(data_case, db, exit_merge):
+    return check_expire_condition(data_case, db, merged_id=exit_merge)
+
+
+@node('data_case_counts', 'data_case')
+def data_case_counts(data_case):
+    return data_case.groupby(['CREATED_TIMESTAMP', 'EMPLOYER_NO', 'FORM_ID'], observed=True).agg(ALIEN_COUNT=('ALIEN_ID', 'count')).reset_index()
+
+
+@node('db_case_counts', 'engine', 'dropped_aliens', 'data_case')
+def db_case_counts(engine, dropped_aliens, data_case):
+    # Relocation windows are evaluated per employer, only the employers of the batch are counted
+    return engine.case_counts(dropped_aliens, employers=data_case['EMPLOYER_NO'].unique())
+
+
+class ExecutionPlan:
+    """
+    Shared intermediates of the checks for one batch (`data`) and its history (`db`).
+
+    The intermediates are the nodes of a DAG registered with `node`. Each one is computed
+    the first time it is requested and memoized, so the flows run on the same plan share
+    the latest-status index, the inform exit check, the MT_59 and exit slices, the ALIEN_ID
+    merge of the expire check and the relocation counts instead of computing them once per flow.
+    The exits and the merge come from the expiry index (`ExpiryIndex.records`), not from a scan of `db`.
+
+    The lookups in the history run on an engine (see flow/engine.py): a `PandasEngine` of `db`
+    by default, or e.g. a `SQLiteEngine`, in which case `db` is not used and may be None.
+
+    With a `store` instead of `db`, `db` is the node of the rows of the store the batch can affect
+    (`PartitionedHistory.rows_for`): every row of its aliens, and the rows of its employers. With
+    `window_days`, the rows of the employers start `window_days` days before the first application,
+    so only the months of the relocation windows reaching the batch are read. Those windows are
+    counted in full; older windows, which do not contain an application of the batch, are not checked.
+
+    Intermediates are shared and must not be modified. The checks do not modify their inputs and
+    report their rows as positions (see `check_rows` in flow/module.py), so `data`, `db` and the
+    intermediates can be shared between flows, and threads, without copies.
+
+    Parameters:
+    - data (pd.DataFrame): Current data.
+    - db (pd.DataFrame): Historical data.
+    - status_index (AlienStatusIndex, optional): Latest-status index of `db`, built on first use if omitted.
+    - expiry_index (ExpiryIndex, optional): Expiry index of the exits of `db` (or of a history containing them), built on first use if omitted.
+    - engine (PandasEngine or SQLiteEngine, optional): Engine of the history lookups, a `PandasEngine` of `db` if omitted.
+    - store (PartitionedHistory, optional): On-disk history read for the batch when `db` is None.
+    - window_days (int, optional): Relocation window (the 'day' of the config) bounding the employer rows read from `store`.
+
+    Example:
+        plan = ExecutionPlan(data, db)
+        flow_1(data, db, config_flow1, plan=plan)
+        flow_4(data, db, config_flow4, plan=plan)
+
+        plan = ExecutionPlan(data, None, store=PartitionedHistory(".history"), window_days=config_flow4["day"])
+        flow_4(data, None, config_flow4, plan=plan)
+    """
+
+    def __init__(self, data: pd.DataFrame, db: pd.DataFrame, status_index: AlienStatusIndex = None, expiry_index: ExpiryIndex = None,
+                 engine=None, store=None, window_days=None):
+        self.values = {'data': data}
+        if db is not None or store is None:
+            self.values['db'] = db
+        else:
+            first = data['CREATED_TIMESTAMP'].min()
+            self.values['store'] = store
+            self.values['history_start'] = (None if window_days is None or pd.isna(first)
+                                            else pd.Timestamp(first).normalize() - pd.Timedelta(days=int(window_days)))
+        if engine is not None:
+            self.values['engine'] = engine
+        if status_index is not None:
+            self.values['status_index'] = status_index
+        if expiry_index is not None:
+            self.values['expiry_index'] = expiry_index
+
+    def __contains__(self, name):
+        return name in self.values
+
+    def get(self, name):
+        """
+        Get an intermediate, computing it and its missing inputs first.
+        """
+        if name not in self.values:
+            function, inputs = nodes[name]
+            self.values[name] = function(*[self.get(i) for i in inputs])
+        return self.values[name]
+
+
+def run_flows(plan: ExecutionPlan, config, EMPLOYER_NO_A=None, EMPLOYER_NO_B=None) -> dict:
+    """
+    Run flow 1, 2 and 4 on one shared plan.
+
+    Parameters:
+    - plan (ExecutionPlan): Plan of the batch and its history.
+    - config (dict): Config case of each flow to run, keyed by "flow1", "flow2" and "flow4". Flows without config are skipped.
+    - EMPLOYER_NO_A (str, optional): Employer number for location A, flow 2 is only run when both employers are given.
+    - EMPLOYER_NO_B (str, optional): Employer number for location B.
+
+    Returns:
+    - dict: Result of each flow that was run, keyed by "flow1", "flow2" and "flow4".
+    """
+    # The flows import this module
+    from .flow1 import flow_1
+    from .flow2 import flow_2
+    from .flow4 import flow_4
+
+    data, db = plan.get('data'), plan.get('db')
+    results = {}
+    if 'flow1' in config:
+        results['flow1'] = flow_1(data, db, config['flow1'], plan=plan)
+    if 'flow2' in config and EMPLOYER_NO_A is not None and EMPLOYER_NO_B is not None:
+        results['flow2'] = flow_2(data, db, config['flow2'], EMPLOYER_NO_A, EMPLOYER_NO_B, plan=plan)
+    if 'flow4' in config:
+        results['flow4'] = flow_4(data, db, config['flow4'], plan=plan)
+    return results
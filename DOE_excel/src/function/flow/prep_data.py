@@ -1,59 +1,178 @@
+import numpy as np
 import pandas as pd
 
+from .instrumentation import instrumented, warn
+
+# Raw workbook headers mapped to the column names used by the checks
+column_names = {
+    'CREATED_TIMESTAMP\n(วันที่ยื่นคำขอ)': 'CREATED_TIMESTAMP',
+    'FORM_ID\n(รหัสฟอร์ม)': 'FORM_ID',
+    'FORM_ID_SEQ\n(ลำดับรหัสฟอร์ม)': 'FORM_ID_SEQ',
+    'ALIEN_ID\n(รหัสคนต่างด้าว)': 'ALIEN_ID',
+    'ALIEN_SEQ\n(ลำดับรหัสคนต่างด้าว)': 'ALIEN_SEQ',
+    'EMPLOYER_ID\n(รหัสนายจ้าง)': 'EMPLOYER_ID',
+    'COMPANYNAME_TH\n(ชื่อนายจ้างไทย/สถานประกอบการ)': 'COMPANYNAME_TH',
+    'COMPANYNAME_EN\n(ชื่อบริษัท (อังกฤษ))': 'COMPANYNAME_EN',
+    'BUS_TYPE_ID\n(รหัสประเภทกิจการ)': 'BUS_TYPE_ID',
+    'Job Description\n(ตำแหน่งงานลูกจ้าง)': 'Job_Description',
+    'EMPLOYER_NO\n(เลขปชช./นิติบุคคล)': 'EMPLOYER_NO',
+    'Master_Form_Type\n(FORM_TYPE_ID)': 'Master_Form_Type',
+    'Master_Form_Status\n(Tracking_Status)': 'Master_Form_Status',
+}
+
+# Columns used by the checks in flow/module.py
+selected_cols = [
+    'CREATED_TIMESTAMP',
+    'FORM_ID',
+    'ALIEN_ID',
+    'JOB_DESCRIPTION',
+    'EMPLOYER_NO',
+    'MASTER_FORM_TYPE',
+    'MASTER_FORM_STATUS',
+    'VALID_UNTIL'
+    ]
+
+# Accepted date formats, in order: workbook/ISO values, then the day-first values of the CSV extracts
+date_formats = ['ISO8601', '%d/%m/%Y %H:%M:%S', '%d/%m/%Y']
+
+# Comma separated columns holding one value per alien of the form
+list_columns = ['ALIEN_ID', 'ALIEN_SEQ', 'JOB_DESCRIPTION']
+
+# Columns whose values are wrapped in double quotes in the source
+quoted_columns = [
+    'ALIEN_ID', 'FORM_ID', 'EMPLOYER_ID',
+    'COMPANYNAME_TH', 'COMPANYNAME_EN',
+    'BUS_TYPE_ID', 'EMPLOYER_NO', 'JOB_DESCRIPTION'
+]
+
+
+def parse_dates(s: pd.Series) -> pd.Series:
+    """
+    Parse a date column with the explicit `date_formats`, values already parsed are kept.
+
+    Parameters:
+    - s (pd.Series): Date values as datetimes or text.
+
+    Returns:
+    - pd.Series: datetime64 values, NaT where no format matches.
+    """
+    if pd.api.types.is_datetime64_any_dtype(s):
+        return s
+    parsed = pd.Series(pd.NaT, index=s.index, dtype='datetime64[ns]')
+    for date_format in date_formats:
+        missing = parsed.isna() & s.notna()
+        if not missing.any():
+            break
+        parsed[missing] = pd.to_datetime(s[missing], format=date_format, errors='coerce')
+    return parsed
+
+
+def normalize_column(name) -> str:
+    """
+    Get the column name used by the checks for a raw workbook header.
+    """
+    return column_names.get(name, name).upper()
+
+
+def is_text(s: pd.Series) -> bool:
+    return s.dtype == object or isinstance(s.dtype, pd.StringDtype)
+
+
+def remove_quote(s: pd.Series) -> pd.Series:
+    """
+    Remove double quotes from the string values of a column, other values are kept as is.
+
+    Quotes are removed once per distinct value, which is much cheaper on columns
+    like EMPLOYER_NO or COMPANYNAME_TH that repeat for every form of an employer.
+    """
+    if not is_text(s):
+        return s
+    codes, uniques = pd.factorize(s)
+    uniques = pd.Series(uniques, dtype=object)
+    stripped = uniques.str.replace('"', '', regex=False)
+    stripped = stripped.where(stripped.notna(), uniques).to_numpy(dtype=object)
+    values = stripped[codes] if len(stripped) else np.full(len(s), np.nan, dtype=object)
+    values[codes == -1] = np.nan
+    return pd.Series(values, index=s.index, name=s.name)
+
+
+def split_column(s: pd.Series):
+    """
+    Split a comma separated column into a flat array of values and the number of values per row.
+
+    Non-string values (numbers, NaN) count as a single value.
+
+    Returns:
+    - tuple: (values (np.ndarray), lengths (np.ndarray))
+    """
+    if not is_text(s):
+        return s.to_numpy(dtype=object), np.ones(len(s), dtype=np.int64)
+    parts = s.str.split(',')
+    lengths = parts.str.len().fillna(1).to_numpy(dtype=np.int64)
+    values = parts.where(parts.notna(), s).explode().to_numpy(dtype=object)
+    return values, lengths
+
+
+@instrumented
 def prep_data(df):
+    """
+    Normalize a raw Testcase/Prerequisite sheet into one row per alien.
 
+    ALIEN_ID, ALIEN_SEQ and JOB_DESCRIPTION are split and exploded together in a single pass.
+    A list column with a single value is repeated for every alien of the row. Rows where a list
+    column has another number of values than ALIEN_ID are reported with a warning and the
+    missing values are left empty.
+
+    Parameters:
+    - df (pd.DataFrame): Raw sheet as read from the workbook or CSV extract.
+
+    Returns:
+    - pd.DataFrame: One row per alien with upper-case column names and quotes removed.
+    """
     #Rename columns
-    df.rename(columns={
-                'CREATED_TIMESTAMP\n(วันที่ยื่นคำขอ)': 'CREATED_TIMESTAMP',
-                'FORM_ID\n(รหัสฟอร์ม)': 'FORM_ID',
-                'FORM_ID_SEQ\n(ลำดับรหัสฟอร์ม)': 'FORM_ID_SEQ',
-                'ALIEN_ID\n(รหัสคนต่างด้าว)': 'ALIEN_ID',
-                'ALIEN_SEQ\n(ลำดับรหัสคนต่างด้าว)': 'ALIEN_SEQ',
-                'EMPLOYER_ID\n(รหัสนายจ้าง)': 'EMPLOYER_ID',
-                'COMPANYNAME_TH\n(ชื่อนายจ้างไทย/สถานประกอบการ)': 'COMPANYNAME_TH',
-                'COMPANYNAME_EN\n(ชื่อบริษัท (อังกฤษ))': 'COMPANYNAME_EN',
-                'BUS_TYPE_ID\n(รหัสประเภทกิจการ)': 'BUS_TYPE_ID',
-                'Job Description\n(ตำแหน่งงานลูกจ้าง)': 'Job_Description',
-                'EMPLOYER_NO\n(เลขปชช./นิติบุคคล)': 'EMPLOYER_NO',
-                'Master_Form_Type\n(FORM_TYPE_ID)': 'Master_Form_Type',
-                'Master_Form_Status\n(Tracking_Status)': 'Master_Form_Status',
-                   }, inplace=True)
-    df.columns = [x.upper() for x in df.columns]
+    df = df.rename(columns=normalize_column)
 
     # Convert columns to datetime
-    df['CREATED_TIMESTAMP'] = pd.to_datetime(df['CREATED_TIMESTAMP'])
-    # df['CREATED_TIMESTAMP'] = df['CREATED_TIMESTAMP'].dt.date
-
-    # Split and explode columns ALIEN_ID, ALIEN_SEQ, Job Description
-    df['ALIEN_ID'] = df['ALIEN_ID'].str.split(',')
-    df['ALIEN_SEQ'] = df['ALIEN_SEQ'].apply(lambda x: x.split(',') if isinstance(x, str) and ',' in x else [x])
-    df['JOB_DESCRIPTION'] = df['JOB_DESCRIPTION'].str.split(',')
-
-    # Explode the columns
-    exploded_A = df.explode('ALIEN_ID').reset_index(drop=True)
-    exploded_B = df.explode('ALIEN_SEQ').reset_index(drop=True)
-    exploded_C = df.explode('JOB_DESCRIPTION').reset_index(drop=True)
-    
-    # Combine the exploded columns back into a single DataFrame
-    exploded_df = exploded_A.copy()
-    exploded_df['ALIEN_SEQ'] = exploded_B['ALIEN_SEQ']
-    exploded_df['JOB_DESCRIPTION'] = exploded_C['JOB_DESCRIPTION']
-
-    # Fill NaN values with previous values
-    exploded_df = exploded_df.ffill()
-
-    def remove_quote(x):
-        return x.replace('"', '') if isinstance(x, str) else x
-
-    # List of columns to process
-    columns_to_process = [
-        'ALIEN_ID', 'FORM_ID', 'EMPLOYER_ID', 
-        'COMPANYNAME_TH', 'COMPANYNAME_EN', 
-        'BUS_TYPE_ID', 'EMPLOYER_NO', 'JOB_DESCRIPTION'
-    ]
+    if 'CREATED_TIMESTAMP' in df.columns:
+        df['CREATED_TIMESTAMP'] = parse_dates(df['CREATED_TIMESTAMP'])
+
+    # Remove quotes before exploding, so it runs once per source row
+    for column in quoted_columns:
+        if column in df.columns:
+            df[column] = remove_quote(df[column])
+
+    # ALIEN_ID drives the number of output rows per source row
+    alien_values, n_rows = split_column(df['ALIEN_ID'])
+    row_index = np.repeat(np.arange(len(df)), n_rows)
+    row_start = np.cumsum(n_rows) - n_rows
+    position = np.arange(len(alien_values)) - np.repeat(row_start, n_rows)
+
+    other_columns = [c for c in df.columns if c not in list_columns]
+    exploded_df = df[other_columns].take(row_index).reset_index(drop=True)
+    exploded_df['ALIEN_ID'] = alien_values
+
+    mismatch = np.zeros(len(df), dtype=bool)
+    for column in list_columns[1:]:
+        if column not in df.columns:
+            continue
+        values, lengths = split_column(df[column])
+        starts = np.cumsum(lengths) - lengths
+        column_lengths = np.repeat(lengths, n_rows)
+        # Single values are repeated for every alien of the row
+        column_position = np.where(column_lengths == 1, 0, position)
+        valid = column_position < column_lengths
+        take = np.repeat(starts, n_rows) + np.minimum(column_position, column_lengths - 1)
+        exploded_values = values[take]
+        exploded_values[~valid] = np.nan
+        exploded_df[column] = exploded_values
+        mismatch |= (lengths != n_rows) & (lengths != 1)
 
-    # Apply remove_quote function to each column in the list
-    for column in columns_to_process:
-        exploded_df[column] = exploded_df[column].apply(remove_quote)
+    if mismatch.any():
+        form_ids = df.loc[mismatch, 'FORM_ID'].tolist() if 'FORM_ID' in df.columns else []
+        warn(
+            f"{mismatch.sum()} rows have a different number of values in {list_columns} "
+            f"(FORM_ID: {form_ids}), missing values are left empty.",
+            stacklevel=2
+        )
 
-    return exploded_df
\ No newline at end of file
+    return exploded_df[[c for c in df.columns]]
@@ -0,0 +1,179 @@
+import numpy as np
+import pandas as pd
+
+from .instrumentation import note_merge
+
+window_columns = ['WINDOW_START', 'WINDOW_END', 'ALIEN_COUNT', 'TOTAL_DAYS']
+
+
+def daily_counts(df: pd.DataFrame, by=None) -> pd.DataFrame:
+    """
+    Sum ALIEN_COUNT per group and calendar day.
+
+    Parameters:
+    - df (pd.DataFrame): Relocation data with 'CREATED_TIMESTAMP' and 'ALIEN_COUNT' columns.
+    - by (list of str, optional): Group columns, e.g. ['EMPLOYER_NO'].
+
+    Returns:
+    - pd.DataFrame: `by` columns, 'DAY' and 'ALIEN_COUNT', sorted by group and day.
+    """
+    by = list(by or [])
+    day = df['CREATED_TIMESTAMP'].dt.normalize().rename('DAY')
+    counts = df['ALIEN_COUNT'].groupby([df[c] for c in by] + [day], sort=True, dropna=False, observed=True).sum()
+    return counts.reset_index()
+
+
+def find_relocation_windows(df: pd.DataFrame, limit_count, limit_days, by=None) -> pd.DataFrame:
+    """
+    Find every `limit_days` window where the number of relocated aliens reaches `limit_count`.
+
+    The bound is inclusive: a window with exactly `limit_count` aliens is offending. The previous check
+    compared the latest `limit_days` window the same way (`total_count < limit_count` was normal), but
+    only after the total of the last 90 days exceeded `limit_count` (`>`), a gate that is dropped here.
+    A window with exactly `limit_count` aliens and no other relocation in the 90 days was normal and is
+    now offending. The workbook case TC19 (50 aliens in 19 days, limit 50, expected abnormal) relies on
+    the inclusive bound, since the exits at other employers no longer count towards the total of B.
+
+    All groups are evaluated in one pass: the per-day counts of every group are laid out on a
+    single day axis (groups are separated by a gap longer than the window), and the window sums
+    are taken from a cumulative sum with `searchsorted`, so the cost is O(n log n) in the number
+    of (group, day) pairs whatever the number of groups.
+
+    Parameters:
+    - df (pd.DataFrame): Relocation data with 'CREATED_TIMESTAMP' and 'ALIEN_COUNT' columns.
+    - limit_count (int): The limit of people allowed to relocate.
+    - limit_days (int): The number of days of a window.
+    - by (list of str, optional): Group columns, e.g. ['EMPLOYER_NO'] or ['EMPLOYER_NO_A', 'EMPLOYER_NO_B'].
+
+    Returns:
+    - pd.DataFrame: One row per offending window with the `by` columns, 'WINDOW_START' and 'WINDOW_END'
+      (first and last day with relocations in the window), 'ALIEN_COUNT' (total in the window)
+      and 'TOTAL_DAYS' (days from WINDOW_START to WINDOW_END, inclusive).
+    """
+    by = list(by or [])
+    counts = daily_counts(df, by)
+    if counts.empty:
+        return pd.DataFrame(columns=by + window_columns)
+
+    day = counts['DAY'].to_numpy(dtype='datetime64[D]').astype(np.int64)
+    if by:
+        group = counts.groupby(by, sort=False, dropna=False, observed=True).ngroup().to_numpy(dtype=np.int64)
+    else:
+        group = np.zeros(len(counts), dtype=np.int64)
+
+    # One axis for all groups, each group shifted past the end of the previous one
+    span = int(day.max() - day.min()) + int(limit_days) + 1
+    axis = group * span + (day - day.min())
+
+    cumulative = np.concatenate([[0], np.cumsum(counts['ALIEN_COUNT'].to_numpy())])
+    first = np.searchsorted(axis, axis - (int(limit_days) - 1), side='left')
+    last = np.arange(len(axis))
+    window_count = cumulative[last + 1] - cumulative[first]
+
+    offending = window_count >= limit_count
+    windows = counts.loc[offending, by].reset_index(drop=True)
+    windows['WINDOW_START'] = counts['DAY'].to_numpy()[first[offending]]
+    windows['WINDOW_END'] = counts['DAY'].to_numpy()[last[offending]]
+    windows['ALIEN_COUNT'] = window_count[offending]
+    windows['TOTAL_DAYS'] = (day[last[offending]] - day[first[offending]]) + 1
+    return windows
+
+
+def worst_window(windows: pd.DataFrame):
+    """
+    Get the offending window with the most relocated aliens (the latest one on ties).
+
+    Returns:
+    - pd.Series or None: The window row, None if there is no offending window.
+    """
+    if windows.empty:
+        return None
+    order = windows.sort_values(['ALIEN_COUNT', 'WINDOW_END'], kind='mergesort')
+    return order.iloc[-1]
+
+
+class TransitionMatrix:
+    """
+    Sparse (employer A, employer B, day) count matrix of aliens who left A and applied at B.
+
+    MT_13_EXIT records of the history are joined once to the MT_59 applications on ALIEN_ID.
+    Employer numbers are dictionary-encoded into integer codes and the matrix is kept in
+    coordinate form: one entry per (A, B, exit day) with at least one alien.
+
+    Parameters:
+    - data (pd.DataFrame): Current data with the MT_59 applications (employer B).
+    - db (pd.DataFrame): Historical data with the MT_13_EXIT records (employer A).
+
+    Attributes:
+    - employers (pd.Index): Employer numbers, the position is the employer code.
+    - a (np.ndarray): Employer code of A for each entry.
+    - b (np.ndarray): Employer code of B for each entry.
+    - day (np.ndarray): Exit day (datetime64[D]) for each entry.
+    - count (np.ndarray): Number of aliens for each entry.
+    """
+
+    def __init__(self, data: pd.DataFrame, db: pd.DataFrame):
+        exits = db.loc[db['MASTER_FORM_TYPE'] == 'MT_13_EXIT', ['ALIEN_ID', 'EMPLOYER_NO', 'CREATED_TIMESTAMP']]
+        arrivals = data.loc[data['MASTER_FORM_TYPE'] == 'MT_59', ['ALIEN_ID', 'EMPLOYER_NO']]
+        merged = pd.merge(exits, arrivals, on='ALIEN_ID', how='inner', suffixes=('_A', '_B'))
+        note_merge('transition_matrix', exits, arrivals, merged)
+
+        codes, self.employers = pd.factorize(
+            pd.concat([merged['EMPLOYER_NO_A'], merged['EMPLOYER_NO_B']], ignore_index=True)
+        )
+        a = codes[:len(merged)]
+        b = codes[len(merged):]
+        day = merged['CREATED_TIMESTAMP'].to_numpy(dtype='datetime64[D]')
+
+        counts = pd.Series(1, index=[a, b, day]).groupby(level=[0, 1, 2]).sum()
+        self.a = counts.index.get_level_values(0).to_numpy(dtype=np.int64)
+        self.b = counts.index.get_level_values(1).to_numpy(dtype=np.int64)
+        self.day = counts.index.get_level_values(2).to_numpy(dtype='datetime64[D]')
+        self.count = counts.to_numpy(dtype=np.int64)
+
+    def __len__(self):
+        return len(self.count)
+
+    def to_frame(self) -> pd.DataFrame:
+        """
+        Get the matrix entries with decoded employer numbers.
+
+        Returns:
+        - pd.DataFrame: 'EMPLOYER_NO_A', 'EMPLOYER_NO_B', 'CREATED_TIMESTAMP' (exit day) and 'ALIEN_COUNT'.
+        """
+        return pd.DataFrame({
+            'EMPLOYER_NO_A': self.employers.take(self.a),
+            'EMPLOYER_NO_B': self.employers.take(self.b),
+            'CREATED_TIMESTAMP': self.day.astype('datetime64[ns]'),
+            'ALIEN_COUNT': self.count,
+        })
+
+    def find_violating_pairs(self, limit_count, limit_days) -> pd.DataFrame:
+        """
+        Run the relocation window check over all (A, B) pairs at once.
+
+        Parameters:
+        - limit_count (int): The limit of people allowed to relocate.
+        - limit_days (int): The number of days of a window.
+
+        Returns:
+        - pd.DataFrame: One row per violating pair with 'EMPLOYER_NO_A', 'EMPLOYER_NO_B', the worst
+          window ('WINDOW_START', 'WINDOW_END', 'ALIEN_COUNT', 'TOTAL_DAYS') and 'WINDOW_COUNT',
+          the number of offending windows of the pair.
+        """
+        entries = pd.DataFrame({
+            'PAIR': self.a * max(len(self.employers), 1) + self.b,
+            'CREATED_TIMESTAMP': self.day.astype('datetime64[ns]'),
+            'ALIEN_COUNT': self.count,
+        })
+        windows = find_relocation_windows(entries, limit_count, limit_days, by=['PAIR'])
+        window_count = windows.groupby('PAIR').size()
+
+        worst = windows.sort_values(['PAIR', 'ALIEN_COUNT', 'WINDOW_END'], kind='mergesort')
+        worst = worst.drop_duplicates(subset='PAIR', keep='last').reset_index(drop=True)
+        pair = worst.pop('PAIR').to_numpy(dtype=np.int64)
+        a, b = np.divmod(pair, max(len(self.employers), 1))
+        worst.insert(0, 'EMPLOYER_NO_A', self.employers.take(a))
+        worst.insert(1, 'EMPLOYER_NO_B', self.employers.take(b))
+        worst['WINDOW_COUNT'] = window_count.reindex(pair).to_numpy()
+        return worst
@@ -0,0 +1,187 @@
+import csv
+import importlib.util
+import os
+
+import pandas as pd
+
+from .result import ResultRows
+
+# Rows of an Excel sheet, the header included
+excel_max_rows = 1_048_576
+
+# Characters Excel does not allow in sheet names
+sheet_name_table = str.maketrans({char: '-' for char in '[]:*?/\\'})
+
+summary_columns = ['flow', 'case', 'status', 'message', 'count_abnormal']
+
+
+def sheet_name(flow, case_code, part=1) -> str:
+    """
+    Get the sheet of the rows of a flow and case code, e.g. "flow1 R1-2", "flow1 R1-2 (2)" for the second part.
+    """
+    suffix = f" ({part})" if part > 1 else ''
+    return f"{flow} {case_code}".translate(sheet_name_table)[:31 - len(suffix)] + suffix
+
+
+def cell_values(frame: pd.DataFrame):
+    """
+    Get the rows of a frame as tuples of plain cell values (missing values become None).
+    """
+    frame = frame.astype(object)
+    return frame.where(frame.notna(), None).itertuples(index=False, name=None)
+
+
+class ReportWriter:
+    """
+    Anomaly report of flow results, written while the results come in.
+
+    Each result added with `add` is written right away, batch by batch (see `ResultRows.iter_batches`),
+    and is not kept by the writer, so the memory used does not grow with the size of the report. The
+    abnormal rows go to one sheet per flow and case code ("flow1 R1-1", "flow2 R2-3", ...) with the columns
+    of the first rows of the sheet, and a sheet rolls over to a new one ("flow1 R1-1 (2)") when it reaches
+    `max_rows`. The 'summary' sheet has one row per result (per case for the grouped flows).
+
+    The format follows the extension of `path`:
+    - '.xlsx': a workbook whose sheets are streamed to temporary files until `close`, with the
+      `constant_memory` mode of xlsxwriter when it is installed (about 3 times faster), or the
+      write-only mode of openpyxl.
+    - '.csv': one CSV file per sheet next to `path`, e.g. "report_summary.csv" and "report_flow1_R1-1.csv", without a row limit.
+
+    Parameters:
+    - path (str): Report file.
+    - abnormal_only (bool): Only write the rows with an 'abnormal' status, the normal rows otherwise go to "<flow> pass" sheets.
+    - max_rows (int): Rows per sheet, the header included (the Excel limit by default).
+    - batch_size (int, optional): Rows converted at a time, `ResultRows.batch_size` by default. The memory used grows with it.
+    - engine (str, optional): 'xlsxwriter' or 'openpyxl' for '.xlsx' reports, the first one installed if omitted.
+
+    Example:
+        with ReportWriter("anomalies.xlsx") as report:
+            for data_batch in batches:
+                report.add("flow4", flow_4(data_batch, db, config_case))
+    """
+
+    def __init__(self, path, abnormal_only=True, max_rows=excel_max_rows, batch_size=None, engine=None):
+        self.path = str(path)
+        self.format = os.path.splitext(self.path)[1].lower().lstrip('.')
+        if self.format not in ('xlsx', 'csv'):
+            raise ValueError(f"Unsupported report file: {path}")
+        self.abnormal_only = abnormal_only
+        self.max_rows = max_rows
+        self.batch_size = batch_size
+        # Open sheet of each (flow, case code), with its columns and part
+        self.sheets = {}
+        self.rows_written = 0
+        self.files = {}
+        self.workbook = None
+        self.engine = None
+        if self.format == 'xlsx':
+            self.engine = engine or ('xlsxwriter' if importlib.util.find_spec('xlsxwriter') else 'openpyxl')
+            if self.engine == 'xlsxwriter':
+                import xlsxwriter
+                self.workbook = xlsxwriter.Workbook(self.path, {'constant_memory': True, 'default_date_format': 'yyyy-mm-dd hh:mm:ss'})
+            else:
+                from openpyxl import Workbook
+                self.workbook = Workbook(write_only=True)
+        self.summary = self.create_sheet('summary', summary_columns)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def create_sheet(self, name, columns) -> dict:
+        """
+        Start a sheet (or a CSV file) with its header row.
+
+        Returns:
+        - dict: 'sheet' (worksheet or CSV writer) and 'rows' (number of rows written, the header included).
+        """
+        if self.engine == 'xlsxwriter':
+            sheet = self.workbook.add_worksheet(name)
+        elif self.engine == 'openpyxl':
+            sheet = self.workbook.create_sheet(name)
+        else:
+            f = open(f"{os.path.splitext(self.path)[0]}_{name.replace(' ', '_')}.csv", 'w', encoding='utf-8', newline='')
+            self.files[name] = f
+            sheet = csv.writer(f)
+        state = {'sheet': sheet, 'rows': 0}
+        self.append_rows(state, [list(columns)])
+        return state
+
+    def append_rows(self, state, rows):
+        sheet = state['sheet']
+        if self.engine == 'xlsxwriter':
+            for i, row in enumerate(rows, start=state['rows']):
+                sheet.write_row(i, 0, row)
+        elif self.engine == 'openpyxl':
+            for row in rows:
+                sheet.append(row)
+        else:
+            sheet.writerows(rows)
+        state['rows'] += len(rows)
+
+    def write_rows(self, flow, case_code, frame):
+        """
+        Write rows to the sheet of a flow and case code, rolling over to a new sheet at `max_rows`.
+        """
+        key = (flow, case_code)
+        if key not in self.sheets:
+            columns = list(frame.columns)
+            self.sheets[key] = {**self.create_sheet(sheet_name(flow, case_code), columns), 'columns': columns, 'part': 1}
+        state = self.sheets[key]
+        # Columns missing from later rows are left empty, new ones are not written
+        frame = frame.reindex(columns=state['columns'])
+        start = 0
+        while start < len(frame):
+            if self.engine is not None and state['rows'] >= self.max_rows:
+                state['part'] += 1
+                state.update(self.create_sheet(sheet_name(flow, case_code, state['part']), state['columns']))
+            room = len(frame) - start if self.engine is None else self.max_rows - state['rows']
+            part = frame.iloc[start:start + room]
+            self.append_rows(state, list(cell_values(part)))
+            start += len(part)
+        self.rows_written += len(frame)
+
+    def add(self, flow, result, case=None) -> int:
+        """
+        Write a flow result to the report.
+
+        Parameters:
+        - flow (str): Name of the flow, e.g. "flow1", used in the sheet names.
+        - result (dict): Result of `flow_1`, `flow_2` or `flow_4`, or of their grouped variants
+          ('cases' and 'data' with the case key column).
+        - case (str, optional): Case of the result in the summary, e.g. the test case id.
+
+        Returns:
+        - int: Number of rows written to the sheets of the flow.
+        """
+        if 'cases' in result:
+            cases = result['cases']
+            case_key = cases.columns[0]
+            summary = cases.reindex(columns=summary_columns[2:]).assign(case=cases[case_key], flow=flow)
+        else:
+            summary = pd.DataFrame([{'flow': flow, 'case': case, **{key: result.get(key) for key in summary_columns[2:]}}])
+        self.append_rows(self.summary, list(cell_values(summary[summary_columns])))
+
+        rows = result['data'] if isinstance(result['data'], ResultRows) else ResultRows(pd.DataFrame(result['data']))
+        written = self.rows_written
+        for batch in rows.iter_batches(self.batch_size):
+            if self.abnormal_only:
+                batch = batch[batch['status'] == 'abnormal']
+            for case_code, part in batch.groupby('case_code', sort=False, dropna=False):
+                self.write_rows(flow, case_code, part)
+        return self.rows_written - written
+
+    def close(self):
+        """
+        Finish the report: save the workbook, or close the CSV files.
+        """
+        if self.engine == 'xlsxwriter':
+            self.workbook.close()
+        elif self.engine == 'openpyxl':
+            self.workbook.save(self.path)
+        self.engine = self.workbook = None
+        for f in self.files.values():
+            f.close()
+        self.files = {}
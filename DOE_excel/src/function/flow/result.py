@@ -0,0 +1,151 @@
+import os
+
+import pandas as pd
+
+from .instrumentation import instrumented
+from .snapshot_cache import to_arrow_table
+
+
+class ResultRows:
+    """
+    Columnar rows of a flow result (the 'data' of `flow_1`, `flow_2` and `flow_4`).
+
+    The rows stay in a DataFrame until they are needed in another form: they can be
+    streamed to Arrow IPC, Parquet or NDJSON batch by batch, and are only converted
+    to Python dicts on demand (`to_records`, iteration).
+
+    Parameters:
+    - frame (pd.DataFrame): Rows of the result with their 'status', 'abnormal_desc' and 'case_code' columns.
+
+    Example:
+        result = flow_4(data, db, config_case)
+        result["data"].write("result_flow4.parquet")
+        records = result["data"].to_records()
+    """
+
+    batch_size = 10_000
+
+    def __init__(self, frame: pd.DataFrame):
+        self.frame = frame.reset_index(drop=True)
+
+    def __len__(self):
+        return len(self.frame)
+
+    def __iter__(self):
+        for batch in self.iter_batches():
+            yield from batch.to_dict(orient='records')
+
+    def __getitem__(self, i):
+        return self.frame.iloc[[i]].to_dict(orient='records')[0]
+
+    def __repr__(self):
+        return f"ResultRows({len(self.frame)} rows, columns={list(self.frame.columns)})"
+
+    def to_frame(self) -> pd.DataFrame:
+        return self.frame
+
+    @instrumented
+    def to_records(self) -> list:
+        """
+        Convert the rows to a list of dicts, as `to_dict(orient='records')`.
+        """
+        return self.frame.to_dict(orient='records')
+
+    def iter_batches(self, batch_size=None):
+        """
+        Get the rows as consecutive DataFrame slices of `batch_size` rows.
+        """
+        batch_size = batch_size or self.batch_size
+        for start in range(0, len(self.frame), batch_size):
+            yield self.frame.iloc[start:start + batch_size]
+
+    def iter_arrow_tables(self, batch_size=None):
+        """
+        Get the rows as Arrow tables with one schema for all batches (text for object columns).
+        """
+        import pyarrow as pa
+
+        schema = None
+        for batch in self.iter_batches(batch_size):
+            table = to_arrow_table(batch)
+            if schema is None:
+                schema = table.schema
+                # Columns that are empty in the first batch are stored as text
+                for i, field in enumerate(schema):
+                    if pa.types.is_null(field.type):
+                        schema = schema.set(i, field.with_type(pa.string()))
+            yield table.cast(schema)
+
+    def write_arrow(self, path, batch_size=None) -> int:
+        """
+        Stream the rows to an Arrow IPC file.
+
+        Returns:
+        - int: Number of rows written.
+        """
+        import pyarrow as pa
+
+        writer = None
+        try:
+            for table in self.iter_arrow_tables(batch_size):
+                if writer is None:
+                    writer = pa.ipc.new_file(str(path), table.schema)
+                writer.write_table(table)
+        finally:
+            if writer is not None:
+                writer.close()
+        if writer is None:
+            pa.ipc.new_file(str(path), to_arrow_table(self.frame).schema).close()
+        return len(self.frame)
+
+    def write_parquet(self, path, batch_size=None) -> int:
+        """
+        Stream the rows to a Parquet file, one row group per batch.
+
+        Returns:
+        - int: Number of rows written.
+        """
+        import pyarrow.parquet as pq
+
+        writer = None
+        try:
+            for table in self.iter_arrow_tables(batch_size):
+                if writer is None:
+                    writer = pq.ParquetWriter(str(path), table.schema)
+                writer.write_table(table)
+        finally:
+            if writer is not None:
+                writer.close()
+        if writer is None:
+            pq.write_table(to_arrow_table(self.frame), str(path))
+        return len(self.frame)
+
+    def write_ndjson(self, path, batch_size=None) -> int:
+        """
+        Stream the rows to a newline-delimited JSON file, one record per line.
+
+        Returns:
+        - int: Number of rows written.
+        """
+        with open(path, 'w', encoding='utf-8') as f:
+            for batch in self.iter_batches(batch_size):
+                lines = batch.to_json(orient='records', lines=True, force_ascii=False, date_format='iso')
+                f.write(lines if lines.endswith('\n') else lines + '\n')
+        return len(self.frame)
+
+    @instrumented
+    def write(self, path, batch_size=None) -> int:
+        """
+        Stream the rows to a file, the format follows the extension: '.arrow', '.parquet' or '.ndjson'/'.jsonl'.
+
+        Returns:
+        - int: Number of rows written.
+        """
+        extension = os.path.splitext(str(path))[1].lower()
+        if extension in ('.arrow', '.feather', '.ipc'):
+            return self.write_arrow(path, batch_size)
+        if extension == '.parquet':
+            return self.write_parquet(path, batch_size)
+        if extension in ('.ndjson', '.jsonl'):
+            return self.write_ndjson(path, batch_size)
+        raise ValueError(f"Unsupported result file: {path}")
@@ -0,0 +1,240 @@
+import hashlib
+import os
+import pickle
+from collections import OrderedDict, defaultdict
+
+import pandas as pd
+
+from .lookup import key_values
+from .result import ResultRows
+from .snapshot_cache import short_hash
+
+# History columns each flow depends on: its result only changes when history rows of the aliens
+# (latest status, exits, expiry) or of the employers (relocation windows) of its case change
+history_keys = {
+    'flow_1': ['ALIEN_ID'],
+    'flow_2': ['ALIEN_ID'],
+    'flow_4': ['ALIEN_ID', 'EMPLOYER_NO'],
+}
+
+
+def frame_hash(df: pd.DataFrame) -> str:
+    """
+    Hash the content of a frame (columns and values, not the index), the same for plain and typed frames of the same rows.
+    """
+    digest = hashlib.sha1(repr(list(df.columns)).encode('utf-8'))
+    digest.update(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+    return digest.hexdigest()[:16]
+
+
+def result_bytes(result) -> int:
+    """
+    Estimate the memory held by a flow result: its frames and result rows.
+    """
+    total = 0
+    for value in result.values():
+        frame = value.to_frame() if isinstance(value, ResultRows) else value
+        if isinstance(frame, pd.DataFrame):
+            total += int(frame.memory_usage(index=False, deep=True).sum())
+    return total + 1024
+
+
+class ResultCache:
+    """
+    Memoized results of `flow_1`, `flow_2` and `flow_4`, keyed by the case rows, the config and the employer pair.
+
+    The key is a content hash of the case rows (`frame_hash`) with the flow, its `config_case` and its
+    other arguments (employer pair, case key). Entries are stamped with the version of the history they
+    were computed on. When rows are added to the history (`update_history`), only the entries of the
+    aliens and employers of those rows are dropped, through an index of the ALIEN_IDs and EMPLOYER_NOs
+    of each entry (`history_keys`), and the other entries stay valid for the new version.
+
+    Entries are evicted in least recently used order when there are more than `max_entries` or
+    they hold more than `max_bytes`. With `cache_dir`, every entry is also written to disk, so it
+    outlives the memory eviction and the process; an entry read back from disk is checked against
+    the history changes made since its version, and the disk tier is kept under `max_disk_bytes`
+    like `SnapshotCache`.
+
+    Results are shared between calls, they must not be modified (the returned dict is a copy).
+
+    Parameters:
+    - history_version (str): Version stamp of the history, e.g. the 'sha256' of its `file_fingerprint`.
+      Entries on disk from another history are not used.
+    - max_entries (int): Number of entries kept in memory.
+    - max_bytes (int): Memory budget of the entries, estimated with `result_bytes`.
+    - cache_dir (str, optional): Directory of the on-disk tier.
+    - max_disk_bytes (int): Disk budget of the on-disk tier.
+
+    Example:
+        cache = ResultCache(file_fingerprint(history_path)['sha256'], cache_dir=".result_cache")
+        result = cache.run(flow_2, data_case, db, config_case, EMPLOYER_NO_A, EMPLOYER_NO_B)
+        db = pd.concat([db, new_rows])
+        cache.update_history(new_rows)
+    """
+
+    suffix = '.pkl'
+
+    def __init__(self, history_version, max_entries=1024, max_bytes=256 << 20, cache_dir=None, max_disk_bytes=1 << 30):
+        self.version = str(history_version)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.max_disk_bytes = max_disk_bytes
+        # Aliens and employers of each history change, and the number of changes made before each version
+        self.changes = []
+        self.versions = {self.version: 0}
+        self.entries = OrderedDict()
+        self.index = {'ALIEN_ID': defaultdict(set), 'EMPLOYER_NO': defaultdict(set)}
+        self.bytes = 0
+        self.hits = self.disk_hits = self.misses = 0
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def key(self, flow_name, data, config_case, args) -> str:
+        if isinstance(config_case, pd.DataFrame):
+            config_case = config_case.to_dict(orient='records')
+        return short_hash([flow_name, frame_hash(data), config_case, list(args)])
+
+    def entry_path(self, key):
+        return os.path.join(self.cache_dir, f"{key}{self.suffix}")
+
+    def run(self, flow, data, db, config_case, *args, **kwargs) -> dict:
+        """
+        Get the result of `flow(data, db, config_case, *args, **kwargs)`, from the cache when the same case was run before.
+
+        `db` must be the history of the current version. Keyword arguments other than `case_key`
+        (status_index, plan, engine) do not change the result and are not part of the key.
+
+        Returns:
+        - dict: Result of the flow.
+        """
+        name = flow.__name__.replace('_cases', '')
+        case_key = kwargs.get('case_key')
+        key = self.key(name, data, config_case, args + ((case_key,) if case_key is not None else ()))
+        result = self.get(key)
+        if result is None:
+            self.misses += 1
+            result = flow(data, db, config_case, *args, **kwargs)
+            columns = history_keys.get(name, ['ALIEN_ID', 'EMPLOYER_NO'])
+            self.put(key, result, {column: set(key_values(data[column].unique())) for column in columns})
+        return dict(result)
+
+    def get(self, key):
+        """
+        Get a valid entry from memory, or from disk, None if there is none.
+        """
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]['result']
+        if self.cache_dir is None or not os.path.exists(self.entry_path(key)):
+            return None
+        with open(self.entry_path(key), 'rb') as f:
+            entry = pickle.load(f)
+        if entry['version'] not in self.versions:
+            # Another history, or a version this cache has not reached
+            return None
+        if not self.is_current(entry):
+            os.remove(self.entry_path(key))
+            return None
+        # Mark as recently used for the LRU eviction of the disk tier
+        os.utime(self.entry_path(key))
+        self.disk_hits += 1
+        self.add(key, entry)
+        return entry['result']
+
+    def is_current(self, entry) -> bool:
+        """
+        Check that no history change since the version of an entry (a version of this cache) touches its aliens or employers.
+        """
+        for change in self.changes[self.versions[entry['version']]:]:
+            if any(not values.isdisjoint(change.get(column, ())) for column, values in entry['keys'].items()):
+                return False
+        return True
+
+    def put(self, key, result, keys):
+        """
+        Store a result with the ALIEN_IDs and EMPLOYER_NOs it depends on (see `history_keys`).
+        """
+        entry = {'version': self.version, 'keys': keys, 'result': result}
+        if self.cache_dir is not None:
+            tmp_path = f"{self.entry_path(key)}.{os.getpid()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self.entry_path(key))
+            self.evict_disk_to_budget()
+        self.add(key, entry)
+
+    def add(self, key, entry):
+        entry['bytes'] = result_bytes(entry['result'])
+        self.entries[key] = entry
+        self.bytes += entry['bytes']
+        for column, values in entry['keys'].items():
+            for value in values:
+                self.index[column][value].add(key)
+        while len(self.entries) > 1 and (len(self.entries) > self.max_entries or self.bytes > self.max_bytes):
+            self.discard(next(iter(self.entries)))
+
+    def discard(self, key):
+        """
+        Remove an entry from memory (the disk copy is kept).
+        """
+        entry = self.entries.pop(key)
+        self.bytes -= entry['bytes']
+        for column, values in entry['keys'].items():
+            for value in values:
+                keys = self.index[column][value]
+                keys.discard(key)
+                if not keys:
+                    del self.index[column][value]
+
+    def update_history(self, rows: pd.DataFrame, version=None) -> int:
+        """
+        Move to a new history version after `rows` were added to the history, dropping the entries of their aliens and employers.
+
+        Parameters:
+        - rows (pd.DataFrame): New history rows, with 'ALIEN_ID' and 'EMPLOYER_NO'.
+        - version (str, optional): Stamp of the new version, derived from the previous one and the rows if omitted.
+
+        Returns:
+        - int: Number of entries dropped from memory.
+        """
+        change = {column: set(key_values(rows[column].unique())) for column in self.index}
+        stale = set()
+        for column, values in change.items():
+            for value in values & self.index[column].keys():
+                stale |= self.index[column][value]
+        for key in stale:
+            self.discard(key)
+            if self.cache_dir is not None and os.path.exists(self.entry_path(key)):
+                os.remove(self.entry_path(key))
+
+        # Entries on disk only are checked against the changes when they are read
+        self.changes.append(change)
+        self.version = str(version) if version is not None else short_hash([self.version, frame_hash(rows)])
+        self.versions[self.version] = len(self.changes)
+        return len(stale)
+
+    def disk_entries(self):
+        return [os.path.join(self.cache_dir, name) for name in os.listdir(self.cache_dir) if name.endswith(self.suffix)]
+
+    def evict_disk_to_budget(self):
+        """
+        Remove least recently used disk entries until the disk tier fits in `max_disk_bytes`.
+        """
+        entries = sorted(self.disk_entries(), key=os.path.getmtime)
+        total = sum(os.path.getsize(entry) for entry in entries)
+        while entries and total > self.max_disk_bytes:
+            entry = entries.pop(0)
+            total -= os.path.getsize(entry)
+            os.remove(entry)
+
+    def clear(self):
+        for key in list(self.entries):
+            self.discard(key)
+        if self.cache_dir is not None:
+            for entry in self.disk_entries():
+                os.remove(entry)
@@ -0,0 +1,128 @@
+import numpy as np
+import pandas as pd
+
+from .module import check_job_limits, check_relocate_condition_from_B
+from .plan import ExecutionPlan
+from .relocation import TransitionMatrix
+
+# Case code of each rule, the position is its bit in the rule matrix
+rule_codes = ['R1/1', 'R1/2', 'R2/2', 'R2/3', 'R4/1', 'R4/2']
+rule_bits = {code: np.uint16(1 << i) for i, code in enumerate(rule_codes)}
+
+
+def rule_frame(bits) -> pd.DataFrame:
+    """
+    Unpack rule bits into one boolean column per case code.
+
+    Parameters:
+    - bits (array-like of uint16): Rule bits, e.g. the 'bits' or 'aliens' 'RULES' of `evaluate_all_rules`.
+
+    Returns:
+    - pd.DataFrame: One column per code of `rule_codes`, True where the rule is violated.
+    """
+    bits = np.asarray(bits, dtype=np.uint16)
+    return pd.DataFrame({code: (bits & bit) > 0 for code, bit in rule_bits.items()})
+
+
+def pack_rules(violations: pd.DataFrame) -> np.ndarray:
+    """
+    Pack boolean columns named by case code (see `rule_frame`) into rule bits.
+    """
+    bits = np.zeros(len(violations), dtype=np.uint16)
+    for code, bit in rule_bits.items():
+        bits[violations[code].to_numpy(dtype=bool)] |= bit
+    return bits
+
+
+def relocated_rows(data, exits, pairs) -> np.ndarray:
+    """
+    Get the mask of the MT_59 rows of `data` whose alien left employer A and applied at employer B for a pair of `pairs`.
+    """
+    if pairs.empty:
+        return np.zeros(len(data), dtype=bool)
+    moves = pd.merge(
+        pd.DataFrame({'ALIEN_ID': exits['ALIEN_ID'].to_numpy(), 'EMPLOYER_NO_A': exits['EMPLOYER_NO'].astype(object).to_numpy()}),
+        pairs[['EMPLOYER_NO_A', 'EMPLOYER_NO_B']].astype(object), on='EMPLOYER_NO_A',
+    )
+    keys = pd.MultiIndex.from_arrays([moves['ALIEN_ID'].astype(object), moves['EMPLOYER_NO_B']])
+    rows = pd.MultiIndex.from_arrays([data['ALIEN_ID'].astype(object), data['EMPLOYER_NO'].astype(object)])
+    return (data['MASTER_FORM_TYPE'] == 'MT_59').to_numpy() & rows.isin(keys)
+
+
+def evaluate_all_rules(plan: ExecutionPlan, config) -> dict:
+    """
+    Evaluate every rule of flow 1, 2 and 4 on a batch, without stopping at the first failing check.
+
+    The flows stop at the first abnormal check and report one status for the whole batch. Here each
+    rule is evaluated on the rows the flow would give it if the previous checks had passed, and the
+    violations are reported per row, as one bit per rule (`rule_bits`):
+    - R1/1 and R4/1: the alien has not reported the exit from the previous employer (same check).
+    - R1/2: the (employer, job) of the application is over the limit of the job.
+    - R2/2: the permit of the alien expires within 30 days of the application.
+    - R2/3: the alien moved from A to B for an (A, B) pair over the relocation limit, every pair being
+      checked at once (see `TransitionMatrix`) instead of the single pair given to flow 2.
+    - R4/2: the employer of the row has a relocation window over the limit.
+
+    The intermediates come from `plan` (inform exit check, expiry index, relocation counts), so the
+    cost is about the one of a flow call plus the transition matrix, not the sum of the flows.
+
+    Parameters:
+    - plan (ExecutionPlan): Plan of the batch and its history.
+    - config (dict): Config case of each flow, keyed by "flow1", "flow2" and "flow4" (as `run_flows`).
+      The rules of a flow without config are not evaluated, their bits are never set.
+
+    Returns:
+    - dict: 'bits' (np.ndarray of uint16, the rule bits of each row of `data`), 'aliens' (pd.DataFrame of
+      'ALIEN_ID' and 'RULES', the bits of all the rows of the alien) and 'employers' (pd.DataFrame of
+      'EMPLOYER_NO', 'ALIEN_COUNT' and, per case code, the number of aliens violating the rule).
+    """
+    data = plan.get('data')
+    bits = np.zeros(len(data), dtype=np.uint16)
+
+    # Same inform exit check for flow 1 and flow 4, each code is only set for a flow with config
+    inform_bits = np.uint16(0)
+    if 'flow1' in config:
+        inform_bits |= rule_bits['R1/1']
+    if 'flow4' in config:
+        inform_bits |= rule_bits['R4/1']
+    if inform_bits:
+        bits[plan.get('inform_exit')['rows']] |= inform_bits
+
+    # The following rules are evaluated on data_case, position i of data_case is row case_rows[i] of data
+    data_case = plan.get('data_case')
+    case_rows = np.flatnonzero(~data['ALIEN_ID'].isin(plan.get('dropped_aliens')).to_numpy())
+
+    if 'flow1' in config:
+        job_limits = check_job_limits(data_case, config['flow1'], engine=plan.get('engine'))
+        bits[case_rows[job_limits['rows'][job_limits['abnormal']]]] |= rule_bits['R1/2']
+
+    if 'flow2' in config:
+        expire = plan.get('expire')
+        bits[case_rows[expire['rows']]] |= rule_bits['R2/2']
+
+        # As flow 2, the aliens of the expire check are left out of the relocations
+        expired = data_case['ALIEN_ID'].take(expire['rows']).unique()
+        kept = ~data_case['ALIEN_ID'].isin(expired).to_numpy()
+        exits = plan.get('engine').exit_records()
+        exits = exits[~exits['ALIEN_ID'].isin(np.concatenate([plan.get('dropped_aliens'), expired]))]
+        data_case_2 = data_case[kept]
+        pairs = TransitionMatrix(data_case_2, exits).find_violating_pairs(config['flow2']['number'], config['flow2']['day'])
+        bits[case_rows[np.flatnonzero(kept)[relocated_rows(data_case_2, exits, pairs)]]] |= rule_bits['R2/3']
+
+    if 'flow4' in config:
+        concat_df = pd.concat([plan.get('db_case_counts'), plan.get('data_case_counts')], axis=0).reset_index(drop=True)
+        relocate = check_relocate_condition_from_B(data_case, concat_df, config['flow4']['number'], config['flow4']['day'],
+                                                   by=['EMPLOYER_NO'], groups=data_case['EMPLOYER_NO'].unique())
+        over = data_case['EMPLOYER_NO'].isin(relocate['windows']['EMPLOYER_NO']).to_numpy()
+        bits[case_rows[over]] |= rule_bits['R4/2']
+
+    # Rules of each alien at each employer, then per alien and per employer
+    violations = rule_frame(bits)
+    keys = [data['EMPLOYER_NO'].to_numpy(), data['ALIEN_ID'].to_numpy()]
+    per_pair = violations.groupby(keys, sort=False, dropna=False).any().rename_axis(['EMPLOYER_NO', 'ALIEN_ID']).reset_index()
+
+    per_alien = per_pair.groupby('ALIEN_ID', sort=False, dropna=False)[rule_codes].any().reset_index()
+    aliens = pd.DataFrame({'ALIEN_ID': per_alien['ALIEN_ID'], 'RULES': pack_rules(per_alien)})
+
+    employers = per_pair.groupby('EMPLOYER_NO', sort=False, dropna=False).agg(ALIEN_COUNT=('ALIEN_ID', 'size'), **{code: (code, 'sum') for code in rule_codes})
+    return {'bits': bits, 'aliens': aliens, 'employers': employers.reset_index()}
@@ -0,0 +1,85 @@
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+from .prep_data import parse_dates, selected_cols
+
+# Type of each column of `selected_cols`:
+# - 'datetime': parsed once at ingestion with `date_formats`
+# - 'id': dictionary-encoded, the codes are shared between `data` and `db` so merges are integer joins
+# - 'category': low-cardinality text (form types, statuses, job descriptions)
+column_types = {
+    'CREATED_TIMESTAMP': 'datetime',
+    'FORM_ID': 'id',
+    'ALIEN_ID': 'id',
+    'JOB_DESCRIPTION': 'category',
+    'EMPLOYER_NO': 'id',
+    'MASTER_FORM_TYPE': 'category',
+    'MASTER_FORM_STATUS': 'category',
+    'VALID_UNTIL': 'datetime',
+}
+
+def apply_schema(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Convert a prepped frame to the typed schema: `selected_cols` only, dates parsed,
+    ids and text columns as categoricals.
+
+    Use `share_categories` afterwards so the codes of `data` and `db` match.
+
+    Parameters:
+    - df (pd.DataFrame): Output of `prep_data`.
+
+    Returns:
+    - pd.DataFrame: Typed frame.
+    """
+    typed = df.reindex(columns=selected_cols)
+    for column, column_type in column_types.items():
+        if column_type == 'datetime':
+            typed[column] = parse_dates(typed[column])
+        elif not isinstance(typed[column].dtype, pd.CategoricalDtype):
+            typed[column] = typed[column].astype(pd.CategoricalDtype(typed[column].dropna().unique()))
+    return typed
+
+
+def share_categories(*frames):
+    """
+    Give the categorical columns of several typed frames the same categories,
+    so their codes can be compared and joined directly.
+
+    Parameters:
+    - frames (pd.DataFrame): Typed frames, e.g. `data` and `db`.
+
+    Returns:
+    - list of pd.DataFrame: The frames with shared categorical dtypes.
+    """
+    frames = [frame.copy() for frame in frames]
+    for column in selected_cols:
+        values = [frame[column] for frame in frames if column in frame.columns]
+        if not values or not all(isinstance(v.dtype, pd.CategoricalDtype) for v in values):
+            continue
+        categories = union_categoricals([v.array for v in values], sort_categories=True).categories
+        dtype = pd.CategoricalDtype(categories)
+        for frame in frames:
+            if column in frame.columns:
+                frame[column] = frame[column].astype(dtype)
+    return frames
+
+
+def concat_typed(frames) -> pd.DataFrame:
+    """
+    Concatenate typed chunks without falling back to object columns for the categoricals.
+    """
+    frames = list(frames)
+    if not frames:
+        return apply_schema(pd.DataFrame(columns=selected_cols))
+    return pd.concat(share_categories(*frames), ignore_index=True)
+
+
+def decode(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Convert the categorical columns of a typed frame back to plain text columns.
+    """
+    df = df.copy()
+    for column in df.columns:
+        if isinstance(df[column].dtype, pd.CategoricalDtype):
+            df[column] = df[column].astype(object)
+    return df
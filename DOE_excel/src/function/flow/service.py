@@ -0,0 +1,455 @@
+import argparse
+import asyncio
+import json
+import signal
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from . import instrumentation
+from .cases import case_history
+from .incremental import HistoryStore
+from .partitioned_store import PartitionedHistory
+from .plan import ExecutionPlan
+from .prep_data import parse_dates, prep_data, selected_cols
+
+# Endpoints of the service, flow 2 also needs the employers A and B of the request
+flow_paths = {'/flow1': 'flow1', '/flow2': 'flow2', '/flow4': 'flow4'}
+
+# Config case of each flow when a request or a command does not give one
+default_config = {
+    "flow1": [{"job": "กรรมกร", "number": 10}, {"job": "งานขายของหน้าร้าน", "number": 10},
+              {"job": "งานทํามือ", "number": 10}, {"job": "N/A", "number": 10}],
+    "flow2": {"number": 20, "day": 14},
+    "flow4": {"number": 50, "day": 20},
+}
+
+# Case key column of the grouped flows, the position of the request of each row in its batch
+request_key = 'REQUEST_ID'
+
+reasons = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 500: 'Internal Server Error'}
+
+# History of the worker, set once per worker by `init_worker`
+worker_history = None
+
+
+def init_worker(history):
+    global worker_history
+    worker_history = history
+
+
+def json_value(value):
+    """
+    Convert the numpy and pandas scalars of a flow result to JSON values.
+    """
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, pd.Timestamp):
+        return value.isoformat()
+    return str(value)
+
+
+def batch_frame(requests) -> tuple:
+    """
+    Build one frame with the applications of all requests of a batch.
+
+    Requests give their applications either as prepped rows ("data", one row per alien) or as
+    raw form rows ("forms", workbook or normalized headers with comma separated aliens). The raw
+    forms of the whole batch go through `prep_data` at once, and the dates are parsed once.
+
+    Returns:
+    - tuple: (frame (pd.DataFrame) with the columns of the requests and at least `selected_cols`,
+      request (np.ndarray) position of the request of each row).
+    """
+    frames, positions = [], []
+    forms = [(i, request['forms']) for i, request in enumerate(requests) if request.get('forms')]
+    if forms:
+        raw = pd.DataFrame.from_records([form for _, request_forms in forms for form in request_forms])
+        raw['REQUEST'] = np.repeat([i for i, _ in forms], [len(request_forms) for _, request_forms in forms])
+        prepped = prep_data(raw)
+        frames.append(prepped.drop(columns='REQUEST'))
+        positions.append(prepped['REQUEST'].to_numpy())
+
+    rows = [(i, request['data']) for i, request in enumerate(requests) if request.get('data')]
+    if rows:
+        frames.append(pd.DataFrame.from_records([row for _, request_rows in rows for row in request_rows]))
+        positions.append(np.repeat([i for i, _ in rows], [len(request_rows) for _, request_rows in rows]))
+
+    if not frames:
+        return pd.DataFrame(columns=selected_cols), np.array([], dtype=np.int64)
+    frame = pd.concat(frames, ignore_index=True)
+    frame = frame.reindex(columns=list(frame.columns) + [c for c in selected_cols if c not in frame.columns])
+    for column in ['CREATED_TIMESTAMP', 'VALID_UNTIL']:
+        frame[column] = parse_dates(frame[column])
+    return frame, np.concatenate(positions).astype(np.int64)
+
+
+def run_request(request, data, db_rows) -> dict:
+    """
+    Run the flow of one request on its applications and the history rows they can affect.
+    """
+    from .flow1 import flow_1
+    from .flow2 import flow_2
+    from .flow4 import flow_4
+
+    plan = ExecutionPlan(data, db_rows)
+    if request['flow'] == 'flow1':
+        return flow_1(data, db_rows, request['config'], plan=plan)
+    if request['flow'] == 'flow2':
+        return flow_2(data, db_rows, request['config'], request['employer_no_a'], request['employer_no_b'], plan=plan)
+    return flow_4(data, db_rows, request['config'], plan=plan)
+
+
+def run_requests(flow, requests, positions, data, history) -> dict:
+    """
+    Run the grouped flow (`flow_1_cases`, `flow_2_cases` or `flow_4_cases`) of several requests of a batch at once,
+    each request being a case of `request_key`.
+
+    Parameters:
+    - flow (str): "flow1", "flow2" or "flow4".
+    - requests (list of dict): Requests of the batch.
+    - positions (list of int): Positions of the requests of `flow` in the batch.
+    - data (pd.DataFrame): Applications of the batch with their `request_key`.
+    - history (pd.DataFrame): History rows of the requests, see `case_history`.
+
+    Returns:
+    - dict: 'cases' and 'data' of the grouped flow.
+    """
+    from .flow1 import flow_1_cases
+    from .flow2 import flow_2_cases
+    from .flow4 import flow_4_cases
+
+    if flow == 'flow1':
+        config = [{**entry, request_key: i} for i in positions for entry in requests[i]['config']]
+        return flow_1_cases(data, history, pd.DataFrame(config), request_key)
+    if flow == 'flow2':
+        config = [{**requests[i]['config'], request_key: i, 'EMPLOYER_NO_A': requests[i]['employer_no_a'],
+                   'EMPLOYER_NO_B': requests[i]['employer_no_b']} for i in positions]
+        return flow_2_cases(data, history, pd.DataFrame(config), request_key)
+    config = [{**requests[i]['config'], request_key: i} for i in positions]
+    return flow_4_cases(data, history, pd.DataFrame(config), request_key)
+
+
+def rows_body(summary, frame) -> bytes:
+    """
+    Serialize the summary and the rows of a flow result to JSON, the rows are written by pandas without going through dicts.
+    """
+    rows = frame.to_json(orient='records', date_format='iso', force_ascii=False) if len(frame) else '[]'
+    return (json.dumps(summary, ensure_ascii=False, default=json_value)[:-1] + f', "data": {rows}}}').encode('utf-8')
+
+
+def result_body(result) -> bytes:
+    """
+    Serialize a flow result to JSON, see `rows_body`.
+    """
+    return rows_body({key: value for key, value in result.items() if key != 'data'}, result['data'].to_frame())
+
+
+def error_body(error) -> bytes:
+    return json.dumps({'error': f"{type(error).__name__}: {error}"}).encode('utf-8')
+
+
+def evaluate_batch(requests) -> list:
+    """
+    Evaluate a micro-batch of requests in a worker.
+
+    The applications of the batch are built and prepped as one frame, and the history rows of all
+    their aliens (and employers, for flow 4) are found with a single `HistoryStore.rows_for` lookup.
+    The requests of each flow are then evaluated at once by its grouped flow, with the request as
+    the case key, so the result of a request is the same as a request sent alone. When a grouped
+    evaluation fails, its requests are run one by one, so only the failing request gets an error.
+
+    Parameters:
+    - requests (list of dict): Requests with 'flow', 'config', 'data' or 'forms', and for flow 2 'employer_no_a' and 'employer_no_b'.
+
+    Returns:
+    - list of tuple: (HTTP status (int), JSON body (bytes)) of each request, in order.
+    """
+    try:
+        data, request_of_row = batch_frame(requests)
+    except Exception as error:
+        # A malformed request fails the batch, each request is retried alone to isolate it
+        if len(requests) > 1:
+            return [response for request in requests for response in evaluate_batch([request])]
+        return [(400, json.dumps({'error': f"Invalid applications: {error}"}).encode('utf-8'))]
+
+    flows = {flow: [i for i, request in enumerate(requests) if request['flow'] == flow] for flow in flow_paths.values()}
+    employers = data.loc[np.isin(request_of_row, flows['flow4']), 'EMPLOYER_NO']
+    db_rows = worker_history.rows_for(alien_ids=data['ALIEN_ID'].unique(), employers=employers.unique())
+
+    # Columns only sent by other requests of the batch are left out of the rows of a request
+    columns = data.notna().groupby(request_of_row).any() | data.columns.isin(selected_cols)
+    data[request_key] = request_of_row
+    history = case_history(data, db_rows, request_key, flows['flow4'])
+
+    responses = [None] * len(requests)
+    for flow, positions in flows.items():
+        if not positions:
+            continue
+        try:
+            result = run_requests(flow, requests, positions, data, history)
+        except Exception:
+            for i in positions:
+                request_data = data.loc[request_of_row == i, columns.columns[columns.loc[i].to_numpy()]].reset_index(drop=True)
+                request_rows = history[history[request_key].to_numpy() == i].drop(columns=request_key).reset_index(drop=True)
+                try:
+                    responses[i] = (200, result_body(run_request(requests[i], request_data, request_rows)))
+                except Exception as error:
+                    responses[i] = (500, error_body(error))
+            continue
+
+        frame = result['data'].to_frame()
+        rows_of_request = frame.groupby(request_key, sort=False).indices
+        result_columns = ['status', 'abnormal_desc', 'case_code']
+        for summary in result['cases'].to_dict(orient='records'):
+            i = summary.pop(request_key)
+            rows = frame.take(rows_of_request.get(i, []))
+            responses[i] = (200, rows_body(summary, rows[list(columns.columns[columns.loc[i].to_numpy()]) + result_columns]))
+    return responses
+
+
+class EvaluationService:
+    """
+    Long-running HTTP service evaluating applications with flow 1, 2 and 4 against a preloaded history.
+
+    The history is loaded and indexed once at startup (`HistoryStore`). Concurrent requests are
+    queued and grouped into micro-batches of up to `max_batch` requests, waiting at most `max_wait`
+    seconds after the first one; each batch is evaluated in a worker pool with `evaluate_batch`,
+    so the event loop only parses requests and writes responses. The history is not modified by
+    the requests.
+
+    Endpoints:
+    - POST /flow1, /flow2, /flow4: JSON body with "data" (prepped rows) or "forms" (raw form rows),
+      optional "config" (the default config of the flow otherwise) and, for flow 2, "employer_no_a" and "employer_no_b".
+    - GET /health: number of history rows and queued requests.
+    - GET /metrics: service counters, and the totals of flow/instrumentation.py when it is enabled, in the Prometheus text format.
+
+    Parameters:
+    - db (pd.DataFrame, HistoryStore or PartitionedHistory): Historical data. A `PartitionedHistory` stays on disk,
+      the workers read the partitions of each batch.
+    - config (dict): Default config case of each flow, keyed by "flow1", "flow2" and "flow4".
+    - workers (int): Number of worker processes, 0 evaluates in one thread of the service process (no copy of the history).
+    - max_batch (int): Maximum number of requests per batch.
+    - max_wait (float): Seconds to wait for more requests after the first one of a batch.
+
+    Example:
+        service = EvaluationService(db, {"flow1": config_flow1, "flow2": config_flow2, "flow4": config_flow4})
+        asyncio.run(service.serve("127.0.0.1", 8080))
+    """
+
+    def __init__(self, db, config, workers=1, max_batch=64, max_wait=0.005):
+        self.history = db if isinstance(db, (HistoryStore, PartitionedHistory)) else HistoryStore(db)
+        self.config = config
+        self.workers = workers
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.stats = {'requests': 0, 'batches': 0, 'errors': 0, 'batch_seconds': 0.0}
+        self.queue = None
+        self.executor = None
+
+    def start(self):
+        """
+        Start the worker pool, the workers get their copy of the history once.
+        """
+        if self.workers > 0:
+            self.executor = ProcessPoolExecutor(self.workers, initializer=init_worker, initargs=(self.history,))
+        else:
+            self.executor = ThreadPoolExecutor(1, initializer=init_worker, initargs=(self.history,))
+        self.queue = asyncio.Queue()
+        # One batch in flight per worker, the next batch fills up meanwhile
+        self.slots = asyncio.Semaphore(max(self.workers, 1))
+        self.batcher = asyncio.get_running_loop().create_task(self.run_batcher())
+
+    def close(self):
+        if self.executor is not None:
+            self.batcher.cancel()
+            self.executor.shutdown(cancel_futures=True)
+            self.executor = None
+
+    def parse_request(self, path, body) -> dict:
+        """
+        Check a request body and complete it with the default config of its flow.
+        """
+        request = json.loads(body or b'{}')
+        if not isinstance(request, dict) or not (request.get('data') or request.get('forms')):
+            raise ValueError('The body must be a JSON object with "data" or "forms" rows.')
+        request['flow'] = flow_paths[path]
+        request.setdefault('config', self.config.get(request['flow']))
+        if request['config'] is None:
+            raise ValueError(f"No config for {request['flow']}.")
+        if request['flow'] == 'flow2' and (request.get('employer_no_a') is None or request.get('employer_no_b') is None):
+            raise ValueError('flow2 needs "employer_no_a" and "employer_no_b".')
+        return request
+
+    async def submit(self, request) -> tuple:
+        """
+        Queue a request for the next batch and wait for its response.
+
+        Returns:
+        - tuple: (HTTP status (int), JSON body (bytes)).
+        """
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((request, future))
+        return await future
+
+    async def run_batcher(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self.slots.acquire()
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                if not self.queue.empty():
+                    batch.append(self.queue.get_nowait())
+                    continue
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            loop.create_task(self.run_batch(batch))
+
+    async def run_batch(self, batch):
+        start = time.perf_counter()
+        try:
+            responses = await asyncio.get_running_loop().run_in_executor(self.executor, evaluate_batch, [request for request, _ in batch])
+        except Exception as error:
+            responses = [(500, error_body(error))] * len(batch)
+        finally:
+            self.slots.release()
+        self.stats['batches'] += 1
+        self.stats['requests'] += len(batch)
+        self.stats['batch_seconds'] += time.perf_counter() - start
+        for (_, future), (status, body) in zip(batch, responses):
+            self.stats['errors'] += status != 200
+            if not future.done():
+                future.set_result((status, body))
+
+    def metrics_text(self) -> str:
+        lines = []
+        for name, help_text in [('requests', 'Requests evaluated.'), ('batches', 'Micro-batches evaluated.'),
+                                ('errors', 'Requests answered with an error.'), ('batch_seconds', 'Wall time of the batches.')]:
+            lines += [f"# HELP doe_service_{name}_total {help_text}", f"# TYPE doe_service_{name}_total counter",
+                      f"doe_service_{name}_total {self.stats[name]}"]
+        lines += ["# HELP doe_service_queued Requests waiting for a batch.", "# TYPE doe_service_queued gauge",
+                  f"doe_service_queued {self.queue.qsize()}"]
+        return '\n'.join(lines) + '\n' + (instrumentation.prometheus_text() if instrumentation.totals else '')
+
+    async def respond(self, method, path, body) -> tuple:
+        if path == '/health' and method == 'GET':
+            health = {'status': 'ok', 'history_rows': len(self.history), 'queued': self.queue.qsize()}
+            return 200, json.dumps(health).encode('utf-8'), 'application/json'
+        if path == '/metrics' and method == 'GET':
+            return 200, self.metrics_text().encode('utf-8'), 'text/plain; version=0.0.4'
+        if path not in flow_paths:
+            return 404, json.dumps({'error': f"Unknown path {path}"}).encode('utf-8'), 'application/json'
+        if method != 'POST':
+            return 405, json.dumps({'error': 'Use POST'}).encode('utf-8'), 'application/json'
+        try:
+            request = self.parse_request(path, body)
+        except ValueError as error:
+            return 400, json.dumps({'error': str(error)}, ensure_ascii=False).encode('utf-8'), 'application/json'
+        status, body = await self.submit(request)
+        return status, body, 'application/json'
+
+    async def handle_connection(self, reader, writer):
+        """
+        Serve the HTTP/1.1 requests of one connection (keep-alive, Content-Length bodies).
+        """
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, target, version = request_line.decode('latin-1').split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+                status, response, content_type = await self.respond(method, target.split('?')[0], body)
+                keep_alive = headers.get('connection', '').lower() != 'close' and version == 'HTTP/1.1'
+                writer.write((
+                    f"HTTP/1.1 {status} {reasons[status]}\r\n"
+                    f"Content-Type: {content_type}\r\n"
+                    f"Content-Length: {len(response)}\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+                ).encode('latin-1') + response)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host='127.0.0.1', port=8080):
+        """
+        Start the workers and serve requests until cancelled.
+        """
+        self.start()
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            self.close()
+
+
+def load_history(args) -> pd.DataFrame:
+    """
+    Load the history of the service: a partitioned store, a prepped sheet of a CSV/XLSX source, or generated data.
+    """
+    if args.store:
+        return PartitionedHistory(args.store)
+    if args.generate:
+        from .generator import generate
+        _, db = generate(args.generate, max(args.generate // 10, 1), seed=args.seed)
+        return db
+
+    from .ingest import read_prepped
+    db = read_prepped(args.db, selected_cols, sheet_name=args.sheet)
+    db['VALID_UNTIL'] = parse_dates(db['VALID_UNTIL'])
+    return db
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Evaluation service for flow 1, 2 and 4 (run from the function directory: python -m flow.service).")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--db", help="CSV or XLSX source of the history")
+    source.add_argument("--store", help="directory of a PartitionedHistory (flow/partitioned_store.py)")
+    source.add_argument("--generate", type=int, help="generate a history of this number of aliens (flow/generator.py)")
+    parser.add_argument("--sheet", default="Prerequisite", help="sheet of the history for XLSX sources")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the generated history")
+    parser.add_argument("--config", help="JSON file with the default config of each flow")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--workers", type=int, default=1, help="worker processes, 0 to evaluate in a thread")
+    parser.add_argument("--max-batch", type=int, default=64)
+    parser.add_argument("--max-wait", type=float, default=0.005, help="seconds to wait for more requests in a batch")
+    parser.add_argument("--instrument", action="store_true", help="enable flow/instrumentation.py (the flows run in the service process with --workers 0)")
+    args = parser.parse_args()
+    # SIGTERM stops the service like Ctrl-C, so the worker processes are shut down too
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    config = dict(default_config)
+    if args.config:
+        with open(args.config, encoding='utf-8') as f:
+            config.update(json.load(f))
+    if args.instrument:
+        instrumentation.enable()
+
+    service = EvaluationService(load_history(args), config, args.workers, args.max_batch, args.max_wait)
+    print(json.dumps({'listening': f"http://{args.host}:{args.port}", 'history_rows': len(service.history)}), flush=True)
+    try:
+        asyncio.run(service.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
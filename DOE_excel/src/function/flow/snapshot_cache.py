@@ -0,0 +1,222 @@
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from .ingest import read_prepped
+
+
+def file_fingerprint(path, known=None, block_size=1 << 20) -> dict:
+    """
+    Identify the content of a source file by path, size, mtime and SHA-256 hash.
+
+    The file is only read and hashed when its size or mtime differ from the `known` fingerprint,
+    so checking an unchanged file costs one `stat`.
+
+    Parameters:
+    - path (str): Source file.
+    - known (dict, optional): Previous fingerprint of the file, whose hash is reused if the file did not change.
+    - block_size (int): Read size used while hashing.
+
+    Returns:
+    - dict: 'path', 'size', 'mtime_ns' and 'sha256' of the file.
+    """
+    stat = os.stat(path)
+    fingerprint = {'path': os.path.abspath(path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    if known and all(known.get(key) == value for key, value in fingerprint.items()) and known.get('sha256'):
+        return {**fingerprint, 'sha256': known['sha256']}
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return {**fingerprint, 'sha256': digest.hexdigest()}
+
+
+def short_hash(value) -> str:
+    return hashlib.sha1(json.dumps(value, sort_keys=True, default=str).encode('utf-8')).hexdigest()[:16]
+
+
+def to_arrow_table(df: pd.DataFrame):
+    """
+    Convert a prepped frame to an Arrow table, object columns are stored as text.
+    """
+    import pyarrow as pa
+
+    df = df.copy()
+    for column in df.columns:
+        if df[column].dtype == object:
+            df[column] = df[column].where(df[column].isna(), df[column].astype(str))
+    return pa.Table.from_pandas(df, preserve_index=False)
+
+
+def write_snapshot(df: pd.DataFrame, cache_path):
+    """
+    Write a frame as an uncompressed Arrow IPC file.
+    """
+    import pyarrow as pa
+
+    table = to_arrow_table(df)
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    with pa.OSFile(tmp_path, 'wb') as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(tmp_path, cache_path)
+
+
+def read_snapshot(cache_path) -> pd.DataFrame:
+    """
+    Read an Arrow IPC snapshot.
+
+    The file is read through a memory map, without a parse, but the frame is a pandas copy of the
+    table (text columns become Python strings), not a view of the file.
+    """
+    import pyarrow as pa
+
+    with pa.memory_map(str(cache_path), 'r') as source:
+        table = pa.ipc.open_file(source).read_all()
+    return table.to_pandas()
+
+
+def parse_sheet_to_cache(path, sheet_name, columns, typed, cache_path):
+    """
+    Parse one sheet with `prep_data` and store it in the cache (run in worker processes).
+    """
+    write_snapshot(read_prepped(path, columns, sheet_name=sheet_name, typed=typed), cache_path)
+    return cache_path
+
+
+class SnapshotCache:
+    """
+    Cache of post-`prep_data` frames per workbook sheet, stored as Arrow IPC files.
+
+    Entries are keyed by the source path, size, mtime and content hash, plus the sheet
+    and the selected columns. Later loads are Arrow IPC reads instead of an openpyxl
+    parse, and the source file is only hashed again when its size or mtime change (the
+    fingerprints are kept in 'fingerprints.json'). Sheets missing from the cache are parsed
+    concurrently in worker processes. When the cache grows beyond `max_bytes`, least recently used entries are evicted.
+
+    Parameters:
+    - cache_dir (str): Directory of the cache files.
+    - max_bytes (int): Disk budget of the cache.
+    - max_workers (int, optional): Number of processes used to parse missing sheets.
+
+    Example:
+        cache = SnapshotCache(".snapshot_cache")
+        sheets = cache.load_sheets("Testcase_DOE_2-7-2024.xlsx", ["Test_Case", "Prerequisite"], selected_cols)
+    """
+
+    suffix = '.arrow'
+
+    def __init__(self, cache_dir, max_bytes=1 << 30, max_workers=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_workers = max_workers
+        self.fingerprints_path = os.path.join(cache_dir, 'fingerprints.json')
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def fingerprint(self, path) -> dict:
+        """
+        Get the fingerprint of a source file, reusing its last hash when its size and mtime did not change.
+        """
+        try:
+            with open(self.fingerprints_path, encoding='utf-8') as f:
+                fingerprints = json.load(f)
+        except (OSError, ValueError):
+            fingerprints = {}
+        known = fingerprints.get(os.path.abspath(path))
+        fingerprint = file_fingerprint(path, known)
+        if fingerprint != known:
+            fingerprints[fingerprint['path']] = fingerprint
+            tmp_path = f"{self.fingerprints_path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(fingerprints, f)
+            os.replace(tmp_path, self.fingerprints_path)
+        return fingerprint
+
+    def entry_path(self, fingerprint, sheet_name, columns, typed=False):
+        """
+        Get the cache file of a sheet. The name starts with a key of the source and sheet,
+        so entries of older versions of the same file can be found and evicted.
+        """
+        source_key = short_hash([fingerprint['path'], sheet_name, columns, typed])
+        content_key = short_hash(fingerprint)
+        return os.path.join(self.cache_dir, f"{source_key}-{content_key}{self.suffix}")
+
+    def entries(self):
+        return [
+            os.path.join(self.cache_dir, name)
+            for name in os.listdir(self.cache_dir) if name.endswith(self.suffix)
+        ]
+
+    def evict_stale(self, cache_path):
+        """
+        Remove the entries of the same source and sheet built from another version of the file.
+        """
+        source_key = os.path.basename(cache_path).split('-')[0]
+        for entry in self.entries():
+            if entry != cache_path and os.path.basename(entry).startswith(source_key + '-'):
+                os.remove(entry)
+
+    def evict_to_budget(self):
+        """
+        Remove least recently used entries until the cache fits in `max_bytes`.
+        """
+        entries = sorted(self.entries(), key=os.path.getmtime)
+        total = sum(os.path.getsize(entry) for entry in entries)
+        while entries and total > self.max_bytes:
+            entry = entries.pop(0)
+            total -= os.path.getsize(entry)
+            os.remove(entry)
+
+    def load_sheets(self, path, sheet_names, columns=None, typed=False) -> dict:
+        """
+        Load the prepped frames of several sheets of a workbook.
+
+        Parameters:
+        - path (str): Workbook (or CSV file, with a single sheet name of 0).
+        - sheet_names (list): Sheets to load.
+        - columns (list of str, optional): Normalized columns to keep, e.g. `selected_cols`.
+        - typed (bool): Store the sheets in the typed schema of `flow/schema.py`.
+
+        Returns:
+        - dict: Sheet name to prepped pd.DataFrame.
+        """
+        fingerprint = self.fingerprint(path)
+        cache_paths = {sheet: self.entry_path(fingerprint, sheet, columns, typed) for sheet in sheet_names}
+        missing = [sheet for sheet, cache_path in cache_paths.items() if not os.path.exists(cache_path)]
+
+        max_workers = self.max_workers or min(len(missing), os.cpu_count() or 1)
+        if len(missing) == 1 or max_workers <= 1:
+            for sheet in missing:
+                parse_sheet_to_cache(path, sheet, columns, typed, cache_paths[sheet])
+        elif missing:
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                futures = [
+                    executor.submit(parse_sheet_to_cache, path, sheet, columns, typed, cache_paths[sheet])
+                    for sheet in missing
+                ]
+                for future in futures:
+                    future.result()
+
+        sheets = {}
+        for sheet, cache_path in cache_paths.items():
+            sheets[sheet] = read_snapshot(cache_path)
+            # Mark as recently used for the LRU eviction
+            os.utime(cache_path)
+        for sheet in missing:
+            self.evict_stale(cache_paths[sheet])
+        if missing:
+            self.evict_to_budget()
+        return sheets
+
+    def load_sheet(self, path, sheet_name, columns=None, typed=False) -> pd.DataFrame:
+        """
+        Load the prepped frame of one sheet, see `load_sheets`.
+        """
+        return self.load_sheets(path, [sheet_name], columns, typed)[sheet_name]
+
+    def clear(self):
+        for entry in self.entries():
+            os.remove(entry)
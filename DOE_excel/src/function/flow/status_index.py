@@ -0,0 +1,89 @@
+import pandas as pd
+
+
+class AlienStatusIndex:
+    """
+    Latest record per ALIEN_ID for one snapshot of the historical data.
+
+    The index is built once in a single sorted pass over `db` and then answers
+    "latest MASTER_FORM_TYPE / CREATED_TIMESTAMP for these ALIEN_IDs" as a
+    vectorized lookup, so checks do not need to re-filter and re-sort `db`
+    for every alien.
+
+    Parameters:
+    - db (pd.DataFrame): Historical data with 'ALIEN_ID', 'MASTER_FORM_TYPE' and 'CREATED_TIMESTAMP' columns.
+
+    Example:
+        index = AlienStatusIndex(db)
+        index.latest_form_type(data["ALIEN_ID"])
+    """
+
+    columns = ['MASTER_FORM_TYPE', 'CREATED_TIMESTAMP']
+
+    def __init__(self, db: pd.DataFrame):
+        # Stable sort so that ties on CREATED_TIMESTAMP keep the first row, like idxmax
+        latest = db[['ALIEN_ID'] + self.columns].sort_values(
+            by=['ALIEN_ID', 'CREATED_TIMESTAMP'], ascending=[True, False], kind='mergesort'
+        )
+        latest = latest.drop_duplicates(subset='ALIEN_ID', keep='first')
+        self.table = latest.set_index('ALIEN_ID')
+
+    def append(self, rows: pd.DataFrame):
+        """
+        Add the records of `rows`, which come after the indexed records in the history, as if the index was built again on both.
+
+        Only the aliens of `rows` are updated: as in a build, a later CREATED_TIMESTAMP replaces the
+        latest record, an equal one does not, and records without CREATED_TIMESTAMP come last.
+        """
+        if rows.empty:
+            return
+        new = AlienStatusIndex(rows).table
+        known = new.index.isin(self.table.index)
+        old = self.table['CREATED_TIMESTAMP'].reindex(new.index)
+        newer = ~known | (new['CREATED_TIMESTAMP'] > old).to_numpy() | (old.isna() & new['CREATED_TIMESTAMP'].notna()).to_numpy()
+        self.table = pd.concat([self.table.drop(new.index[newer & known]), new[newer]]).sort_index(kind='mergesort')
+
+    def __len__(self):
+        return len(self.table)
+
+    def __contains__(self, alien_id):
+        return alien_id in self.table.index
+
+    def latest(self, alien_ids=None) -> pd.DataFrame:
+        """
+        Get the latest record for each requested ALIEN_ID.
+
+        Parameters:
+        - alien_ids (list-like, optional): ALIEN_IDs to look up. All aliens in the index if omitted.
+
+        Returns:
+        - pd.DataFrame: 'MASTER_FORM_TYPE' and 'CREATED_TIMESTAMP' indexed by ALIEN_ID, in the order requested.
+          Aliens without any record in the history get NaN values.
+        """
+        if alien_ids is None:
+            return self.table
+        return self.table.reindex(pd.Index(alien_ids, name='ALIEN_ID'))
+
+    def latest_form_type(self, alien_ids=None) -> pd.Series:
+        """
+        Get the latest MASTER_FORM_TYPE for each requested ALIEN_ID.
+
+        Parameters:
+        - alien_ids (list-like, optional): ALIEN_IDs to look up. All aliens in the index if omitted.
+
+        Returns:
+        - pd.Series: MASTER_FORM_TYPE indexed by ALIEN_ID (NaN for aliens without history).
+        """
+        return self.latest(alien_ids)['MASTER_FORM_TYPE']
+
+    def latest_timestamp(self, alien_ids=None) -> pd.Series:
+        """
+        Get the latest CREATED_TIMESTAMP for each requested ALIEN_ID.
+
+        Parameters:
+        - alien_ids (list-like, optional): ALIEN_IDs to look up. All aliens in the index if omitted.
+
+        Returns:
+        - pd.Series: CREATED_TIMESTAMP indexed by ALIEN_ID (NaT for aliens without history).
+        """
+        return self.latest(alien_ids)['CREATED_TIMESTAMP']
@@ -0,0 +1,164 @@
+import numpy as np
+import pandas as pd
+
+from .expiry_index import ExpiryIndex
+from .lookup import find_positions, key_values, sorted_lookup
+from .plan import ExecutionPlan, run_flows
+from .status_index import AlienStatusIndex
+
+
+def to_datetime64(value) -> np.datetime64:
+    return np.datetime64(pd.Timestamp(value), 'ns')
+
+
+class TemporalIndex:
+    """
+    History sorted by CREATED_TIMESTAMP, with the rows of each alien and employer as offsets in that order.
+
+    The history as of a date is the prefix of the rows created up to that date: its end is found
+    with a `searchsorted` on the sorted timestamps and the snapshot is a slice, not a filtered copy.
+    In the lookup of each key (see `sorted_lookup`), the rows of an alien or an employer are a run of
+    increasing offsets, so its rows as of a date are the offsets of the run below the end of the snapshot.
+    Rows with the same CREATED_TIMESTAMP keep their order in `db`. Rows without CREATED_TIMESTAMP are
+    at the end and in no snapshot, as when `db` is filtered on CREATED_TIMESTAMP <= date.
+
+    Parameters:
+    - db (pd.DataFrame): Historical data with 'CREATED_TIMESTAMP', 'ALIEN_ID' and 'EMPLOYER_NO' columns.
+
+    Example:
+        index = TemporalIndex(db)
+        index.as_of("2024-05-01 23:59:59")
+        index.rows_for(alien_ids=data["ALIEN_ID"].unique(), as_of="2024-05-01 23:59:59")
+    """
+
+    keys = ['ALIEN_ID', 'EMPLOYER_NO']
+
+    def __init__(self, db: pd.DataFrame):
+        times = pd.to_datetime(db['CREATED_TIMESTAMP']).to_numpy(dtype='datetime64[ns]')
+        order = np.argsort(times, kind='mergesort')
+        self.db = db.take(order).reset_index(drop=True)
+        self.times = times[order]
+        self.lookups = {key: sorted_lookup(key_values(self.db[key])) for key in self.keys}
+
+    def __len__(self):
+        return len(self.db)
+
+    def cutoff(self, as_of=None) -> int:
+        """
+        Get the number of rows created up to `as_of` (included), every row if omitted.
+        """
+        if as_of is None:
+            return len(self.db)
+        return int(np.searchsorted(self.times, to_datetime64(as_of), side='right'))
+
+    def as_of(self, as_of) -> pd.DataFrame:
+        """
+        Get the history as it was at `as_of`: the rows created up to that time, in time order.
+        """
+        return self.db.iloc[:self.cutoff(as_of)]
+
+    def positions_for(self, alien_ids=(), employers=(), as_of=None) -> np.ndarray:
+        """
+        Get the offsets of the rows of some aliens or employers created up to `as_of`, in time order.
+        """
+        positions = [
+            find_positions(self.lookups[key], key_values(values))
+            for key, values in [('ALIEN_ID', alien_ids), ('EMPLOYER_NO', employers)] if len(values)
+        ]
+        positions = np.unique(np.concatenate(positions)) if positions else np.array([], dtype=np.int64)
+        return positions[:np.searchsorted(positions, self.cutoff(as_of))]
+
+    def rows_for(self, alien_ids=(), employers=(), as_of=None) -> pd.DataFrame:
+        """
+        Get the rows of some aliens or employers created up to `as_of`, in time order.
+
+        Parameters:
+        - alien_ids (list-like): ALIEN_IDs to look up.
+        - employers (list-like): EMPLOYER_NOs to look up.
+        - as_of (str or pd.Timestamp, optional): Date of the history, the whole history if omitted.
+
+        Returns:
+        - pd.DataFrame: Rows matching any of the aliens or employers.
+        """
+        return self.db.take(self.positions_for(alien_ids, employers, as_of)).reset_index(drop=True)
+
+
+class AsOfEvaluator:
+    """
+    Evaluate applications against the history as it was at a past date, e.g. to answer what a flow would have returned then.
+
+    As in `IncrementalEvaluator`, the flows only get the history rows the applications can affect:
+    the rows of their aliens and, for flow 4, of their employers, here only those created up to the
+    date (see `TemporalIndex`). The results are the same as running the flows on the applications
+    with `db` filtered on CREATED_TIMESTAMP <= date.
+
+    `backfill` evaluates the same applications at a range of dates. Their history rows are looked up
+    once, and each date takes a prefix of them. The latest-status index and the expiry index of the exits
+    are extended with the rows created between two dates instead of being rebuilt, and when no row of the applications was
+    created between two dates, the results of the previous date are reused.
+
+    Parameters:
+    - db (pd.DataFrame or TemporalIndex): Historical data.
+    - config (dict): Config case of each flow to run, keyed by "flow1", "flow2" and "flow4"
+      (same format as the `config_case` of `flow_1`, `flow_2` and `flow_4`). Flows without config are skipped.
+
+    Example:
+        evaluator = AsOfEvaluator(db, {"flow1": config_flow1, "flow4": {"number": 50, "day": 20}})
+        results = evaluator.evaluate(data, "2024-05-01 23:59:59")
+        for date, results in evaluator.backfill(data, pd.date_range("2024-04-01", "2024-04-30 23:59:59", freq="D")):
+            ...
+    """
+
+    def __init__(self, db, config):
+        self.index = db if isinstance(db, TemporalIndex) else TemporalIndex(db)
+        self.config = config
+
+    def positions_for(self, data: pd.DataFrame, as_of=None) -> np.ndarray:
+        # Rows of the batch aliens (status, exits, expiry, A to B) and, for flow 4, of the batch employers
+        employers = data['EMPLOYER_NO'].unique() if 'flow4' in self.config else ()
+        return self.index.positions_for(alien_ids=data['ALIEN_ID'].unique(), employers=employers, as_of=as_of)
+
+    def evaluate(self, data: pd.DataFrame, as_of, EMPLOYER_NO_A=None, EMPLOYER_NO_B=None) -> dict:
+        """
+        Run the configured flows on a batch against the history as of a date.
+
+        Parameters:
+        - data (pd.DataFrame): Batch of applications.
+        - as_of (str or pd.Timestamp): Date of the history, rows created at that exact time included.
+        - EMPLOYER_NO_A (str, optional): Employer number for location A, flow 2 is only run when both employers are given.
+        - EMPLOYER_NO_B (str, optional): Employer number for location B.
+
+        Returns:
+        - dict: Result of each flow that was run, keyed by "flow1", "flow2" and "flow4".
+        """
+        db_rows = self.index.db.take(self.positions_for(data, as_of)).reset_index(drop=True)
+        return run_flows(ExecutionPlan(data, db_rows), self.config, EMPLOYER_NO_A, EMPLOYER_NO_B)
+
+    def backfill(self, data: pd.DataFrame, dates, EMPLOYER_NO_A=None, EMPLOYER_NO_B=None):
+        """
+        Run the configured flows on a batch against the history as of each of several dates.
+
+        Parameters:
+        - data (pd.DataFrame): Batch of applications.
+        - dates (list-like): Dates of the history, evaluated in increasing order.
+        - EMPLOYER_NO_A (str, optional): Employer number for location A, flow 2 is only run when both employers are given.
+        - EMPLOYER_NO_B (str, optional): Employer number for location B.
+
+        Returns:
+        - generator of tuple: (date (pd.Timestamp), results (dict) keyed by "flow1", "flow2" and "flow4"). Dates
+          with the same history rows as the previous date share its results, which must not be modified.
+        """
+        positions = self.positions_for(data)
+        rows = self.index.db.take(positions).reset_index(drop=True)
+        times = self.index.times[positions]
+        status_index, expiry_index = AlienStatusIndex(rows.iloc[:0]), ExpiryIndex(rows.iloc[:0])
+        cutoff, results = 0, None
+        for date in sorted(pd.to_datetime(list(dates))):
+            date_cutoff = int(np.searchsorted(times, to_datetime64(date), side='right'))
+            if results is None or date_cutoff != cutoff:
+                status_index.append(rows.iloc[cutoff:date_cutoff])
+                expiry_index.append(rows.iloc[cutoff:date_cutoff])
+                cutoff = date_cutoff
+                plan = ExecutionPlan(data, rows.iloc[:cutoff], status_index=status_index, expiry_index=expiry_index)
+                results = run_flows(plan, self.config, EMPLOYER_NO_A, EMPLOYER_NO_B)
+            yield date, results
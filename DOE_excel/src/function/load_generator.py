@@ -0,0 +1,182 @@
+"""
+Load generator for the evaluation service of flow/service.py.
+
+The applications are the current data of flow/generator.py with the same --aliens and --seed
+as the history of the service (`python -m flow.service --generate N --seed S`), one request
+per form. --concurrency connections send the requests with keep-alive, and the latency
+percentiles, the throughput and the batches seen by the service are printed as one JSON object.
+
+Usage:
+    python -m flow.service --generate 100000 --port 8080 &
+    python load_generator.py --aliens 100000 --url http://127.0.0.1:8080 --flow flow4 --concurrency 32
+    python load_generator.py --aliens 100000 --spawn --max-batch 1   # without micro-batching
+"""
+import argparse
+import asyncio
+import json
+import subprocess
+import sys
+import time
+from urllib.parse import urlsplit
+
+import numpy as np
+
+from flow.generator import generate
+
+
+def make_requests(data, db, flow, n_requests) -> list:
+    """
+    Build the JSON bodies of `n_requests` requests, one form of `data` each (cycled if needed).
+    """
+    forms = list(data.groupby('FORM_ID', sort=False).indices.values())
+    rows = json.loads(data.to_json(orient='records', date_format='iso', force_ascii=False))
+    if flow == 'flow2':
+        # Employer A is the employer of the latest application of the first alien of the form
+        applications = db[db['MASTER_FORM_TYPE'] == 'MT_59'].sort_values('CREATED_TIMESTAMP')
+        employer_a = applications.drop_duplicates('ALIEN_ID', keep='last').set_index('ALIEN_ID')['EMPLOYER_NO']
+
+    bodies = []
+    for i in range(n_requests):
+        positions = forms[i % len(forms)]
+        request = {'data': [rows[p] for p in positions]}
+        if flow == 'flow2':
+            first = data.iloc[positions[0]]
+            request['employer_no_a'] = employer_a.get(first['ALIEN_ID'], first['EMPLOYER_NO'])
+            request['employer_no_b'] = first['EMPLOYER_NO']
+        bodies.append(json.dumps(request, ensure_ascii=False).encode('utf-8'))
+    return bodies
+
+
+async def http_request(reader, writer, host, method, path, body=b'') -> tuple:
+    writer.write((
+        f"{method} {path} HTTP/1.1\r\nHost: {host}\r\n"
+        f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n"
+    ).encode('latin-1') + body)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    return status, await reader.readexactly(int(headers.get('content-length', 0)))
+
+
+async def get(url, path) -> tuple:
+    parts = urlsplit(url)
+    reader, writer = await asyncio.open_connection(parts.hostname, parts.port)
+    try:
+        return await http_request(reader, writer, parts.hostname, 'GET', path)
+    finally:
+        writer.close()
+
+
+async def run_load(url, path, bodies, concurrency) -> dict:
+    """
+    Send the bodies over `concurrency` keep-alive connections and measure each request.
+
+    Returns:
+    - dict: 'seconds' of the whole run, 'latencies' (seconds of each request) and number of 'errors'.
+    """
+    parts = urlsplit(url)
+    pending = iter(bodies)
+    latencies, errors = [], 0
+
+    async def client():
+        nonlocal errors
+        reader, writer = await asyncio.open_connection(parts.hostname, parts.port)
+        try:
+            for body in pending:
+                start = time.perf_counter()
+                status, _ = await http_request(reader, writer, parts.hostname, 'POST', path, body)
+                latencies.append(time.perf_counter() - start)
+                errors += status != 200
+        finally:
+            writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client() for _ in range(concurrency)])
+    return {'seconds': time.perf_counter() - start, 'latencies': latencies, 'errors': errors}
+
+
+def service_counters(metrics_text) -> dict:
+    counters = {}
+    for line in metrics_text.splitlines():
+        if line.startswith('doe_service_') and line.split()[0].endswith('_total'):
+            name, value = line.split()
+            counters[name[len('doe_service_'):-len('_total')]] = float(value)
+    return counters
+
+
+async def wait_ready(url, timeout):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            status, _ = await get(url, '/health')
+            if status == 200:
+                return
+        except OSError:
+            pass
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"The service at {url} is not ready after {timeout}s")
+        await asyncio.sleep(0.5)
+
+
+async def main(args):
+    data, db = generate(args.aliens, max(args.aliens // 10, 1), seed=args.seed)
+    bodies = make_requests(data, db, args.flow, args.requests)
+    await wait_ready(args.url, args.ready_timeout)
+
+    _, before = await get(args.url, '/metrics')
+    run = await run_load(args.url, f"/{args.flow}", bodies, args.concurrency)
+    _, after = await get(args.url, '/metrics')
+    before, after = service_counters(before.decode('utf-8')), service_counters(after.decode('utf-8'))
+    batches = after['batches'] - before['batches']
+
+    latencies_ms = np.array(run['latencies']) * 1000
+    return {
+        'flow': args.flow,
+        'requests': len(latencies_ms),
+        'concurrency': args.concurrency,
+        'errors': run['errors'],
+        'seconds': round(run['seconds'], 3),
+        'throughput_rps': round(len(latencies_ms) / run['seconds'], 1),
+        'p50_ms': round(float(np.percentile(latencies_ms, 50)), 1),
+        'p95_ms': round(float(np.percentile(latencies_ms, 95)), 1),
+        'p99_ms': round(float(np.percentile(latencies_ms, 99)), 1),
+        'batches': int(batches),
+        'mean_batch': round((after['requests'] - before['requests']) / batches, 1) if batches else None,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://127.0.0.1:8080")
+    parser.add_argument("--aliens", type=int, default=100_000, help="--generate size of the service history")
+    parser.add_argument("--seed", type=int, default=0, help="--seed of the service history")
+    parser.add_argument("--flow", choices=["flow1", "flow2", "flow4"], default="flow4")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--spawn", action="store_true", help="start the service for the run")
+    parser.add_argument("--workers", type=int, default=1, help="--workers of the spawned service")
+    parser.add_argument("--max-batch", type=int, default=64, help="--max-batch of the spawned service")
+    parser.add_argument("--max-wait", type=float, default=0.005, help="--max-wait of the spawned service")
+    parser.add_argument("--ready-timeout", type=float, default=300)
+    args = parser.parse_args()
+
+    service = None
+    if args.spawn:
+        port = urlsplit(args.url).port
+        service = subprocess.Popen([
+            sys.executable, "-m", "flow.service", "--generate", str(args.aliens), "--seed", str(args.seed),
+            "--port", str(port), "--workers", str(args.workers),
+            "--max-batch", str(args.max_batch), "--max-wait", str(args.max_wait),
+        ], stdout=subprocess.DEVNULL)
+    try:
+        print(json.dumps(asyncio.run(main(args))), flush=True)
+    finally:
+        if service is not None:
+            service.terminate()
+            service.wait()
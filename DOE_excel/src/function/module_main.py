@@ -3,45 +3,32 @@ import numpy as np
 import datetime
 from datetime import datetime, timedelta
 
+from .flow.status_index import AlienStatusIndex
+
 #Test ID 01
-def check_inform_exit(data: pd.DataFrame, db: pd.DataFrame) -> dict:
+def check_inform_exit(data: pd.DataFrame, db: pd.DataFrame, status_index: AlienStatusIndex = None) -> dict:
     """
     Check A group of aliens has not yet reported their departure from the company.
     
     Parameters:
     - data (pd.DataFrame): Current data.
     - db (pd.DataFrame): Historical data.
+    - status_index (AlienStatusIndex, optional): Latest-status index built from `db`. Built on the fly if omitted.
     
     Returns:
-    - dict: A dictionary with ALIEN_ID as keys and a boolean indicating if 'MT_13_EXIT' is present in the latest record.
+    - str: 'abnormal' if an alien is not registered as MT_59 or its latest record is not 'MT_13_EXIT', 'normal' otherwise.
     """
-    results = {}
-
-    # Create a set of unique ALIEN_IDs for efficiency
-    alien_ids = set(data["ALIEN_ID"])
-
-    for alien_id in alien_ids:
-        # Check if the status register is MT_59
-        if "MT_59" in data[data["ALIEN_ID"] == alien_id]["MASTER_FORM_TYPE"].values:
-            # Filter and sort the db for the given ALIEN_ID
-            db_filtered = db[db["ALIEN_ID"] == alien_id].sort_values(by="CREATED_TIMESTAMP", ascending=False)
-            
-            if not db_filtered.empty:
-                # Get the latest record
-                latest_record = db_filtered.iloc[0]
-                # Check for 'MT_13_EXIT' in 'MASTER_FORM_TYPE'
-                check_anomaly = 'MT_13_EXIT' in latest_record['MASTER_FORM_TYPE']
-                results[alien_id] = check_anomaly
-
-                # print(f'ALIEN_ID {alien_id}: {"normal" if check_anomaly else "abnormal"}')
-            else:
-                # print(f'ALIEN_ID {alien_id}: No records found')
-                results[alien_id] = None  # Indicates no data found for this ALIEN_ID
-        else:
-            # print(f'ALIEN_ID {alien_id}: Master form type not correct')
-            results[alien_id] = False  # Indicates the master form type is not correct
+    if status_index is None:
+        status_index = AlienStatusIndex(db)
+
+    # Check if the status register is MT_59 for each unique ALIEN_ID
+    is_mt_59 = (data["MASTER_FORM_TYPE"] == "MT_59").groupby(data["ALIEN_ID"], dropna=False, observed=True).any()
+
+    # Check for 'MT_13_EXIT' in the latest record, aliens without records are not counted
+    latest_form_type = status_index.latest_form_type(is_mt_59.index[is_mt_59.values])
+    check_anomaly = latest_form_type.str.contains('MT_13_EXIT', regex=False, na=True)
 
-    return 'abnormal' if False in results.values() else 'normal'
+    return 'abnormal' if not (is_mt_59.all() and check_anomaly.all()) else 'normal'
     
     
 #Test ID 02-05
@@ -60,7 +47,7 @@ def check_job_limits(data, config_case):
     data_case = data[data['MASTER_FORM_TYPE'] == 'MT_59']
     
     # Group by relevant columns and count the number of aliens per job
-    data_case = data_case.groupby(['EMPLOYER_NO', 'FORM_ID', 'JOB_DESCRIPTION']).agg(ALIEN_COUNT=('ALIEN_ID', 'count')).reset_index()
+    data_case = data_case.groupby(['EMPLOYER_NO', 'FORM_ID', 'JOB_DESCRIPTION'], observed=True).agg(ALIEN_COUNT=('ALIEN_ID', 'count')).reset_index()
     
     # Check each job configuration
     for job_config in config_case:
@@ -225,7 +212,7 @@ def check_relocate_condition_from_A_to_B(data, db, config_case, EMPLOYER_NO_A, E
     merged_alien_id = pd.merge(db_exit_filter, db_access_filter, on='ALIEN_ID', how='inner', suffixes=('_A', '_B'))
 
     # Group by date and employer numbers
-    count_alien_date = merged_alien_id.groupby(['CREATED_TIMESTAMP_A', "EMPLOYER_NO_A", "EMPLOYER_NO_B"]).agg(
+    count_alien_date = merged_alien_id.groupby(['CREATED_TIMESTAMP_A', "EMPLOYER_NO_A", "EMPLOYER_NO_B"], observed=True).agg(
         ALIEN_COUNT=('ALIEN_ID', 'count')
     ).reset_index().rename(columns={'CREATED_TIMESTAMP_A': 'CREATED_TIMESTAMP'})
         
@@ -1,59 +1,33 @@
-import pandas as pd
-
-def prep_data(df):
-
-    #Rename columns
-    df.rename(columns={
-                'CREATED_TIMESTAMP\n(วันที่ยื่นคำขอ)': 'CREATED_TIMESTAMP',
-                'FORM_ID\n(รหัสฟอร์ม)': 'FORM_ID',
-                'FORM_ID_SEQ\n(ลำดับรหัสฟอร์ม)': 'FORM_ID_SEQ',
-                'ALIEN_ID\n(รหัสคนต่างด้าว)': 'ALIEN_ID',
-                'ALIEN_SEQ\n(ลำดับรหัสคนต่างด้าว)': 'ALIEN_SEQ',
-                'EMPLOYER_ID\n(รหัสนายจ้าง)': 'EMPLOYER_ID',
-                'COMPANYNAME_TH\n(ชื่อนายจ้างไทย/สถานประกอบการ)': 'COMPANYNAME_TH',
-                'COMPANYNAME_EN\n(ชื่อบริษัท (อังกฤษ))': 'COMPANYNAME_EN',
-                'BUS_TYPE_ID\n(รหัสประเภทกิจการ)': 'BUS_TYPE_ID',
-                'Job Description\n(ตำแหน่งงานลูกจ้าง)': 'Job_Description',
-                'EMPLOYER_NO\n(เลขปชช./นิติบุคคล)': 'EMPLOYER_NO',
-                'Master_Form_Type\n(FORM_TYPE_ID)': 'Master_Form_Type',
-                'Master_Form_Status\n(Tracking_Status)': 'Master_Form_Status',
-                   }, inplace=True)
-    df.columns = [x.upper() for x in df.columns]
-
-    # Convert columns to datetime
-    df['CREATED_TIMESTAMP'] = pd.to_datetime(df['CREATED_TIMESTAMP'])
-    # df['CREATED_TIMESTAMP'] = df['CREATED_TIMESTAMP'].dt.date
-
-    # Split and explode columns ALIEN_ID, ALIEN_SEQ, Job Description
-    df['ALIEN_ID'] = df['ALIEN_ID'].str.split(',')
-    df['ALIEN_SEQ'] = df['ALIEN_SEQ'].apply(lambda x: x.split(',') if isinstance(x, str) and ',' in x else [x])
-    df['JOB_DESCRIPTION'] = df['JOB_DESCRIPTION'].str.split(',')
-
-    # Explode the columns
-    exploded_A = df.explode('ALIEN_ID').reset_index(drop=True)
-    exploded_B = df.explode('ALIEN_SEQ').reset_index(drop=True)
-    exploded_C = df.explode('JOB_DESCRIPTION').reset_index(drop=True)
-    
-    # Combine the exploded columns back into a single DataFrame
-    exploded_df = exploded_A.copy()
-    exploded_df['ALIEN_SEQ'] = exploded_B['ALIEN_SEQ']
-    exploded_df['JOB_DESCRIPTION'] = exploded_C['JOB_DESCRIPTION']
-
-    # Fill NaN values with previous values
-    exploded_df = exploded_df.ffill()
-
-    def remove_quote(x):
-        return x.replace('"', '') if isinstance(x, str) else x
-
-    # List of columns to process
-    columns_to_process = [
-        'ALIEN_ID', 'FORM_ID', 'EMPLOYER_ID', 
-        'COMPANYNAME_TH', 'COMPANYNAME_EN', 
-        'BUS_TYPE_ID', 'EMPLOYER_NO', 'JOB_DESCRIPTION'
-    ]
-
-    # Apply remove_quote function to each column in the list
-    for column in columns_to_process:
-        exploded_df[column] = exploded_df[column].apply(remove_quote)
-
-    return exploded_df
\ No newline at end of file
+"""
+Prep a raw CSV or XLSX export into the normalized shape (one row per alien) on disk.
+
+The source goes through the ingestion path of flow/ingest.py (column projection by the reader,
+chunked `prep_data`), so this script and the flows share one normalizer. To load the prepped
+data in memory instead, use `read_prepped` of flow/ingest.py.
+
+Usage:
+    python prep_data_main.py Testcase_DOE_2-7-2024.xlsx --sheet Prerequisite --out prerequisite.parquet
+    python prep_data_main.py export.csv --out export_prepped.csv --all-columns
+"""
+import argparse
+
+from flow.ingest import write_prepped
+from flow.prep_data import selected_cols
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Prep a raw CSV or XLSX export with flow.ingest.")
+    parser.add_argument('path', help="CSV or XLSX source.")
+    parser.add_argument('--out', required=True, help="Output store, '.parquet' or '.csv'.")
+    parser.add_argument('--sheet', default=0, help="Sheet to read for XLSX sources (first sheet by default).")
+    parser.add_argument('--chunksize', type=int, default=100_000, help="Number of source (form) rows per chunk.")
+    parser.add_argument('--all-columns', action='store_true', help="Keep every column instead of `selected_cols`.")
+    args = parser.parse_args(argv)
+
+    columns = None if args.all_columns else selected_cols
+    n_rows = write_prepped(args.path, args.out, columns, args.chunksize, args.sheet)
+    print(f"{n_rows} rows written to {args.out}")
+
+
+if __name__ == '__main__':
+    main()
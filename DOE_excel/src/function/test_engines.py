@@ -0,0 +1,40 @@
+import pytest
+
+from flow.engine import PandasEngine, SQLiteEngine
+from flow.engine_parity import comparable, engine_cases
+from flow.generator import generate
+from flow.schema import apply_schema, share_categories
+
+# Lookups and flows of `engine_cases`, each one compared between the engines
+functions = ['latest', 'permits', 'exit_records', 'case_counts', 'job_counts', 'flow_1', 'flow_2', 'flow_4']
+
+config = {
+    'flow1': [{"job": "กรรมกร", "number": 10}, {"job": "งานขายของหน้าร้าน", "number": 10}, {"job": "N/A", "number": 10}],
+    'flow2': {"number": 20, "day": 14},
+    'flow4': {"number": 50, "day": 20},
+}
+
+
+@pytest.fixture(scope='module', params=['plain', 'typed'])
+def engine_results(request):
+    """
+    Run the lookups and the flows of `engine_cases` on generated data with the pandas and the SQLite engine.
+
+    Returns:
+    - dict: Engine name to the comparable result (see `comparable`) of each function.
+    """
+    data, db = generate(2000, 200, seed=0)
+    if request.param == 'typed':
+        data, db = share_categories(apply_schema(data), apply_schema(db))
+    engines = {'pandas': PandasEngine(db), 'sqlite': SQLiteEngine.from_frame(db)}
+    return {
+        name: {function: comparable(case()) for function, case in engine_cases(data, db, engine, config)}
+        for name, engine in engines.items()
+    }
+
+
+@pytest.mark.parametrize('function', functions)
+def test_sqlite_engine_matches_pandas_engine(engine_results, function):
+    expected = engine_results['pandas'][function]
+    assert expected, f"{function} has no result to compare"
+    assert engine_results['sqlite'][function] == expected
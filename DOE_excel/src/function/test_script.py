@@ -1,10 +1,15 @@
+import os
+
 import pandas as pd
 # from flow import *
 from flow.prep_data import *
+from flow.snapshot_cache import SnapshotCache
+from flow.schema import share_categories
 
 from flow.flow1 import flow_1
 from flow.flow2 import flow_2
 from flow.flow4 import flow_4
+from flow.result import ResultRows
 
 
 flow_id_config = {
@@ -36,73 +41,62 @@ flow_id_config = {
         }
 }
 
-df_data = pd.read_excel("/opt/project/src/DOE/src/function/Testcase_DOE_2-7-2024.xlsx", sheet_name="Test_Case")
-df_db = pd.read_excel("/opt/project/src/DOE/src/function/Testcase_DOE_2-7-2024.xlsx", sheet_name="Prerequisite")
-data = prep_data(df_data)
-db = prep_data(df_db)
-
-selected_cols = [
-    'CREATED_TIMESTAMP',
-    'FORM_ID',
-    'ALIEN_ID',
-    'JOB_DESCRIPTION',
-    'EMPLOYER_NO',
-    'MASTER_FORM_TYPE',
-    'MASTER_FORM_STATUS',
-    'VALID_UNTIL'
-    ]
-db = db[selected_cols]
-data = data[selected_cols]
-
-def test_case(data, db):
+# Workbook of the test cases, next to this script
+function_dir = os.path.dirname(os.path.abspath(__file__))
+workbook_path = os.path.join(function_dir, "Testcase_DOE_2-7-2024.xlsx")
+
+
+def load_test_data():
+    # Only selected_cols are read from the workbook, the prepped sheets are cached until the workbook changes
+    snapshot_cache = SnapshotCache(os.path.join(function_dir, ".snapshot_cache"))
+    sheets = snapshot_cache.load_sheets(workbook_path, ["Test_Case", "Prerequisite"], selected_cols, typed=True)
+    # Typed frames share their id codes, so the checks merge on integers
+    return share_categories(sheets["Test_Case"], sheets["Prerequisite"])
+
+
+def run_case(data, db):
     result_list = []
     for flow_key, tc_dict in flow_id_config.items():
-        # print(f"\nFlow: {flow_key}")
-        for tc_key, tc_list in tc_dict.items():
-            # print(f"  {tc_key}: {tc_list}")
-            
-            data_case = data[data["FORM_ID"].isin(tc_list)]
-            db_case = db[db["FORM_ID"].isin(tc_list)]
-            
-            if flow_key == "flow1":
-                config_case = [
-                    {"job": "กรรมกร", "number": 10},
-                    {"job": "งานขายของหน้าร้าน", "number": 10},
-                    {"job": "งานทํามือ", "number": 10},
-                    {"job": "N/A", "number": 10}
-                ]
-                result = flow_1(data_case, db_case, config_case)
-                # result["tc"] = tc_key 
-                # result["form_id"] = tc_list
-                result_list.append(result)
-            
-                
-            if flow_key == "flow2":
-                config_case = {
-                "number": 20,
-                "day": 14
-                }
-                EMPLOYER_NO_A = db_case["EMPLOYER_NO"].to_list()[0]
-                EMPLOYER_NO_B = data_case["EMPLOYER_NO"].to_list()[0]
-                result = flow_2(data_case, db_case, config_case, EMPLOYER_NO_A, EMPLOYER_NO_B)
-                # result["tc"] = tc_key 
-                # result["form_id"] = tc_list
-                result_list.append(result)
-                
-            if flow_key == "flow4":
-                config_case = {
-                "number": 50,
-                "day": 20
-                }
-                result = flow_4(data_case, db_case, config_case)
-                # result["tc"] = tc_key 
-                # result["form_id"] = tc_list
-                result_list.append(result)
-    
-    return result_list     
-        
-result_list = test_case(data, db)
-for i in result_list:
-    print("\n",i)
+        # Each form gets the id of its test case, and all the test cases of the flow are checked in one grouped pass
+        case_of_form = {form_id: tc_key for tc_key, tc_list in tc_dict.items() for form_id in tc_list}
+        data_flow = data.assign(CASE_ID=data["FORM_ID"].astype(object).map(case_of_form))
+        db_flow = db.assign(CASE_ID=db["FORM_ID"].astype(object).map(case_of_form))
+        cases = pd.DataFrame({"CASE_ID": list(tc_dict)})
+
+        if flow_key == "flow1":
+            # Limits of each test case, as a lookup table
+            config_case = pd.merge(cases, pd.DataFrame([
+                {"job": "กรรมกร", "number": 10},
+                {"job": "งานขายของหน้าร้าน", "number": 10},
+                {"job": "งานทํามือ", "number": 10},
+                {"job": "N/A", "number": 10}
+            ]), how="cross")
+            result = flow_1(data_flow, db_flow, config_case, case_key="CASE_ID")
+
+        if flow_key == "flow2":
+            # Employer A is the one of the first history row of the test case, employer B the one of its first current row
+            first_a = db_flow.drop_duplicates("CASE_ID").set_index("CASE_ID")["EMPLOYER_NO"].astype(object)
+            first_b = data_flow.drop_duplicates("CASE_ID").set_index("CASE_ID")["EMPLOYER_NO"].astype(object)
+            config_case = cases.assign(number=20, day=14, EMPLOYER_NO_A=cases["CASE_ID"].map(first_a), EMPLOYER_NO_B=cases["CASE_ID"].map(first_b))
+            result = flow_2(data_flow, db_flow, config_case, case_key="CASE_ID")
+
+        if flow_key == "flow4":
+            config_case = cases.assign(number=50, day=20)
+            result = flow_4(data_flow, db_flow, config_case, case_key="CASE_ID")
+
+        # One result per test case, with its own rows
+        rows = result["data"].to_frame()
+        for case in result["cases"].to_dict("records"):
+            case_rows = rows[rows["CASE_ID"] == case["CASE_ID"]].drop(columns="CASE_ID")
+            result_list.append({**{key: value for key, value in case.items() if key != "CASE_ID"}, "data": ResultRows(case_rows)})
+
+    return result_list
+
+
+if __name__ == "__main__":
+    data, db = load_test_data()
+    result_list = run_case(data, db)
+    for i in result_list:
+        print("\n", {**i, "data": i["data"].to_records()})
 # df_result = pd.DataFrame(result_list)
 # df_result.to_csv("result_test_script.csv", index=False)
\ No newline at end of file